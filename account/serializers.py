@@ -7,7 +7,7 @@ from rest_framework import serializers
 from account.models import Staff, Member
 from grizzly.lib import constants
 from grizzly.utils import create_otp_device
-from promotion.models import PromotionBetLevel
+from promotion.ladder import get_ladder
 
 
 class StaffSerializer(serializers.ModelSerializer):
@@ -180,12 +180,12 @@ class MemberSerializer(serializers.ModelSerializer):
                 }
 
         if instance.promotion_bet_level:
-            bet_level = PromotionBetLevel.objects.filter(
-                total_bet__gt=instance.promotion_bet_level.total_bet)
+            level = instance.promotion_bet_level
+            bet_level = get_ladder(level.game_type).get_next_level(
+                level.total_bet)
 
-            if bet_level.exists():
-                bet_diff = bet_level.first().total_bet - \
-                    instance.total_promotion_bet
+            if bet_level:
+                bet_diff = bet_level.total_bet - instance.total_promotion_bet
                 ret['bets_to_next_level'] = bet_diff
 
         return ret
@@ -3,6 +3,7 @@ from django.contrib import admin
 from envelope.models import (EnvelopeClaim,
                              EnvelopeLevel,
                              EnvelopeDeposit,
+                             EnvelopeDepositRollup,
                              EnvelopeAmountSetting,
                              EventType,
                              RequestLog,
@@ -21,6 +22,30 @@ class EnvelopeLevelAdmin(admin.ModelAdmin):
 class EnvelopeDepositAdmin(admin.ModelAdmin):
     list_display = ('username', 'amount', 'event_type', 'created_by')
 
+    # Keep the daily deposit rollup in step, as the deposit viewset does.
+    # The admin views already run in a transaction.
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            EnvelopeDepositRollup.objects.add_deposit(
+                EnvelopeDeposit.objects.get(id=obj.id), sign=-1)
+
+        super().save_model(request, obj, form, change)
+        EnvelopeDepositRollup.objects.add_deposit(obj)
+
+    def delete_model(self, request, obj):
+        EnvelopeDepositRollup.objects.add_deposit(obj, sign=-1)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for deposit in queryset:
+            EnvelopeDepositRollup.objects.add_deposit(deposit, sign=-1)
+        super().delete_queryset(request, queryset)
+
+
+class EnvelopeDepositRollupAdmin(admin.ModelAdmin):
+    list_display = ('username', 'amount', 'event_type', 'business_date')
+
 
 class EnvelopeAmountSettingAdmin(admin.ModelAdmin):
     list_display = ('name', 'threshold_amount', 'min_amount', 'max_amount',
@@ -28,7 +53,7 @@ class EnvelopeAmountSettingAdmin(admin.ModelAdmin):
 
 
 class RewardAdmin(admin.ModelAdmin):
-    list_display = ('name', 'event_type', 'chance')
+    list_display = ('name', 'event_type', 'chance', 'stock', 'stock_left')
 
 
 class EventTypeAdmin(admin.ModelAdmin):
@@ -44,6 +69,7 @@ class RequestLogAdmin(admin.ModelAdmin):
 admin.site.register(EnvelopeClaim, EnvelopeClaimAdmin)
 admin.site.register(EnvelopeLevel, EnvelopeLevelAdmin)
 admin.site.register(EnvelopeDeposit, EnvelopeDepositAdmin)
+admin.site.register(EnvelopeDepositRollup, EnvelopeDepositRollupAdmin)
 admin.site.register(EnvelopeAmountSetting, EnvelopeAmountSettingAdmin)
 admin.site.register(Reward, RewardAdmin)
 admin.site.register(EventType, EventTypeAdmin)
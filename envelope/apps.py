@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class EnvelopeConfig(AppConfig):
     name = 'envelope'
+
+    def ready(self):
+        import envelope.signals  # noqa: F401
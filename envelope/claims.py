@@ -0,0 +1,194 @@
+import uuid
+
+from collections import Counter
+from django.utils import timezone
+
+from grizzly.lib import constants
+from envelope.models import EnvelopeClaim
+from envelope.writebehind import WriteBehindQueue
+
+
+class ClaimDraw(object):
+    '''
+    One member's claim request on an event: takes the claims from the
+    member's claim window, draws their rewards or amounts and gives back
+    whatever was not used, whichever server saves the claims.
+    '''
+
+    def __init__(self, username, event_type):
+        self.username = username
+        self.event_type = event_type
+        # Whether the claims were popped from a pre-split deck, or their
+        # amounts are held as pending in the pool ledger
+        self.drawn_from_deck = False
+        self.pool_reserved = False
+
+    def run(self, quantity, save):
+        '''
+        Make `quantity` claims (one, answered as a single claim, when None)
+        and persist them with `save(claims, many)`. Returns the saved data
+        and an error code, one of which is None.
+        '''
+
+        username, event_type = self.username, self.event_type
+
+        # Count the claims against the user's claim window
+        user_claim_left = EnvelopeClaim.objects.take_claim(
+            username, event_type, quantity or 1)
+        if user_claim_left is None:
+            return None, constants.CANNOT_CLAIM_YET
+        elif user_claim_left == 0:
+            return None, constants.NO_CLAIM_LEFT
+
+        taken = min(quantity or 1, user_claim_left)
+
+        try:
+            claims, error = self.draw(taken)
+            if claims:
+                try:
+                    data = save(claims, quantity is not None)
+                except Exception:
+                    self.release(claims)
+                    raise
+        except Exception:
+            EnvelopeClaim.objects.release_claim(username, event_type, taken)
+            raise
+
+        if len(claims) < taken:
+            EnvelopeClaim.objects.release_claim(username, event_type,
+                                                taken - len(claims))
+
+        if not claims:
+            return None, error
+
+        EnvelopeClaim.objects.invalidate_event_state(username, event_type)
+        EnvelopeClaim.objects.publish_claims(event_type, claims)
+
+        return data, None
+
+    def draw(self, quantity):
+        '''
+        Draw the rewards or amounts of `quantity` claims, reserving the
+        amounts from the pool. Returns the claims data and an error code
+        for when none could be drawn.
+        '''
+
+        username, event_type = self.username, self.event_type
+        claim = {
+            'username': username,
+            'amount': 0.0,
+            'status': 0,
+            'event_type': event_type.id
+        }
+
+        if event_type.is_reward:
+            rewards = [EnvelopeClaim.objects.get_reward(event_type)
+                       for _ in range(quantity)]
+            # Limited rewards may run out midway through a batch
+            claims = [dict(claim, reward=reward.id)
+                      for reward in rewards if reward]
+
+            if EnvelopeClaim.objects.get_snapshot(event_type).rewards:
+                return claims, constants.NO_REWARD_LEFT
+
+            return claims, constants.CANNOT_CLAIM_YET
+
+        if event_type.is_presplit:
+            claim_amounts = EnvelopeClaim.objects.pop_deck(event_type,
+                                                           quantity)
+            # Not loaded yet (or redis unavailable), draw as usual
+            if claim_amounts is not None:
+                self.drawn_from_deck = True
+                claims = [dict(claim, amount=claim_amount)
+                          for claim_amount in claim_amounts]
+                return claims, constants.NO_POOL_AMOUNT_LEFT
+
+        remaining_amount = EnvelopeClaim.objects.remaining_pool_amount(
+            event_type)
+        if round(remaining_amount, 2) <= 0:
+            # No remaining pool
+            return [], constants.NO_POOL_AMOUNT_LEFT
+
+        amount_threshold = EnvelopeClaim.objects.get_threshold_range(
+            username, event_type)
+
+        if amount_threshold[0] == amount_threshold[1]:
+            return [], constants.CANNOT_CLAIM_YET
+
+        claim_amounts = [
+            EnvelopeClaim.objects.get_claim_amount(event_type,
+                                                   amount_threshold)
+            for _ in range(quantity)
+        ]
+
+        # Reserve the amounts before writing the claims so concurrent
+        # claims cannot overdraw the pool
+        granted_amount, self.pool_reserved = \
+            EnvelopeClaim.objects.reserve_pool_amount(
+                event_type, round(sum(claim_amounts), 2))
+
+        claims = []
+        for claim_amount in claim_amounts:
+            claim_amount = round(min(claim_amount, granted_amount), 2)
+            if claim_amount <= 0:
+                break
+
+            granted_amount = round(granted_amount - claim_amount, 2)
+            claims.append(dict(claim, amount=claim_amount))
+
+        return claims, constants.NO_POOL_AMOUNT_LEFT
+
+    def release(self, claims):
+        '''
+        Give back the rewards or amounts of claims that were not saved.
+        '''
+
+        event_type = self.event_type
+        claim_amounts = [claim['amount'] for claim in claims]
+
+        if event_type.is_reward:
+            EnvelopeClaim.objects.release_reward_stock(
+                Counter(claim['reward'] for claim in claims))
+        elif self.drawn_from_deck:
+            EnvelopeClaim.objects.release_deck(event_type, claim_amounts)
+        elif self.pool_reserved:
+            EnvelopeClaim.objects.release_pool_amount(
+                event_type, round(sum(claim_amounts), 2))
+
+    def settle(self, claims):
+        '''
+        Tell the pool ledger the claims' amounts are written.
+        '''
+
+        if self.pool_reserved:
+            EnvelopeClaim.objects.settle_pool_amount(
+                self.event_type,
+                round(sum(claim['amount'] for claim in claims), 2))
+
+    def queue(self, claims, many=False):
+        '''
+        Hand the claims to the write-behind queue and answer with what they
+        will be once written (without an id yet). Returns None when the
+        queue is unavailable so the claims are saved directly.
+        '''
+
+        created_at = timezone.now().isoformat()
+        queued = [dict(claim,
+                       uuid=str(uuid.uuid4()),
+                       reward=claim.get('reward'),
+                       created_at=created_at,
+                       # Settled by the flush once written
+                       pool_reserved=self.pool_reserved)
+                  for claim in claims]
+
+        if not WriteBehindQueue().push(queued):
+            return None
+
+        claim_left = EnvelopeClaim.objects.get_quantity_left(
+            self.username, self.event_type)
+        data = [dict(claim, id=None, claim_left=claim_left)
+                for claim in queued]
+        for claim in data:
+            del claim['pool_reserved']
+
+        return data if many else data[0]
@@ -0,0 +1,528 @@
+'''
+Standalone asyncio server for the envelope claim hot path:
+
+    python -m envelope.gateway --port 8001
+
+It answers the member claim, batch claim, claim_left and state endpoints
+at the same paths and with the same payloads as the Django views, so a
+proxy can route just these requests to it (claim_left is the GET of the
+claim path with a claim_left parameter, other GETs of it are not served).
+It also streams event statuses as server-sent events (STREAM_PATH), pushed
+when claims change them, which Django only serves for polling.
+Claims are handed to the write-behind queue (ENVELOPE_WRITE_BEHIND),
+configuration is read from the event snapshots and limits from the shared
+redis counters.
+
+The database and redis clients are blocking, so requests are parsed and
+answered on the event loop and the claim logic runs on a thread pool.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'grizzly.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import close_old_connections  # noqa: E402
+from redis.exceptions import RedisError  # noqa: E402
+from rest_framework.utils.encoders import JSONEncoder  # noqa: E402
+
+from grizzly.idempotency import (build_idempotency_cache_key,  # noqa: E402
+                                 run_once)
+from grizzly.lib import constants  # noqa: E402
+from grizzly.utils import GrizzlyRenderer  # noqa: E402
+from envelope.claims import ClaimDraw  # noqa: E402
+from envelope.ledger import STATUS_CHANNEL, get_redis  # noqa: E402
+from envelope.models import EnvelopeClaim  # noqa: E402
+from envelope.status import STATUS_TICK, get_status_payload  # noqa: E402
+from envelope.views import EnvelopeClaimMemberViewset  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+
+CLAIM_PATH = '/v1/member/envelopeclaim/'
+BATCH_PATH = '/v1/member/envelopeclaim/batch/'
+STATE_PATH = '/v1/member/envelopeclaim/state/'
+STREAM_PATH = '/v1/member/envelope/status/stream/'
+# Share idempotency keys with the Django view, a retry may land on either
+IDEMPOTENCY_SCOPE = EnvelopeClaimMemberViewset.__name__
+
+KEEPALIVE_TIMEOUT = 15
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 64 * 1024
+
+# Statuses are also rebuilt without a claim, for what changes with time
+# (the event opening, a reconciled pool) or when redis is unreachable
+STATUS_REFRESH = 15
+# Comment line sent on idle streams so proxies keep them open
+STREAM_KEEPALIVE = 15
+# Streams are closed after a while, EventSource clients reconnect by
+# themselves
+STREAM_MAX_AGE = 60 * 5
+
+renderer = GrizzlyRenderer()
+
+
+class BadRequest(Exception):
+    pass
+
+
+def serialize_claim(envelope_claim, claim_left):
+    '''
+    A saved claim as EnvelopeClaimMemberSerializer renders it.
+    '''
+
+    return {
+        'id': envelope_claim.id,
+        'uuid': str(envelope_claim.uuid),
+        'username': envelope_claim.username,
+        'amount': envelope_claim.amount,
+        'reward': envelope_claim.reward_id,
+        'event_type': envelope_claim.event_type_id,
+        'status': envelope_claim.status,
+        'created_at': envelope_claim.created_at,
+        'claim_left': claim_left,
+    }
+
+
+def save_claims(draw, claims, many):
+    if settings.ENVELOPE_WRITE_BEHIND:
+        data = draw.queue(claims, many=many)
+        if data is not None:
+            return data
+
+    # Write-behind off or redis unavailable, write them now
+    envelope_claims = EnvelopeClaim.objects.bulk_create([
+        EnvelopeClaim(username=claim['username'],
+                      amount=claim['amount'],
+                      status=claim['status'],
+                      event_type=draw.event_type,
+                      reward_id=claim.get('reward'))
+        for claim in claims
+    ])
+    draw.settle(claims)
+    claim_left = EnvelopeClaim.objects.get_quantity_left(draw.username,
+                                                         draw.event_type)
+    data = [serialize_claim(envelope_claim, claim_left)
+            for envelope_claim in envelope_claims]
+
+    return data if many else data[0]
+
+
+def claim(data, quantity=None):
+    event_type = EnvelopeClaim.objects.get_event_type(
+        data.get('event_type', 0))
+    if not event_type:
+        return constants.INVALID_EVENT_TYPE, 400
+
+    draw = ClaimDraw(data.get('username', ''), event_type)
+    data, error = draw.run(quantity,
+                           lambda claims, many: save_claims(draw, claims,
+                                                            many))
+    if error:
+        return error, 400
+
+    return data, 200
+
+
+def batch(data):
+    try:
+        quantity = int(data.get('quantity', 0))
+    except (TypeError, ValueError):
+        quantity = 0
+
+    if not 0 < quantity <= EnvelopeClaimMemberViewset.MAX_BATCH_CLAIMS:
+        return constants.FIELD_ERROR, 400
+
+    return claim(data, quantity=quantity)
+
+
+def claim_left(params):
+    event_type = EnvelopeClaim.objects.get_event_type(
+        params.get('event_type', 0))
+    if not event_type:
+        return constants.INVALID_EVENT_TYPE, 400
+
+    quantity_left = EnvelopeClaim.objects.get_quantity_left(
+        params.get('username', ''), event_type)
+    if quantity_left is None:
+        return constants.CANNOT_CLAIM_YET, 400
+
+    return {'claim_left': quantity_left}, 200
+
+
+def state(params):
+    event_type = EnvelopeClaim.objects.get_event_type(
+        params.get('event_type', 0))
+    if not event_type:
+        return constants.INVALID_EVENT_TYPE, 400
+
+    return EnvelopeClaim.objects.get_event_state(params.get('username', ''),
+                                                 event_type), 200
+
+
+def handle(method, path, params, headers, data):
+    '''
+    Answer a request with (data, status), or None for paths the gateway
+    does not serve.
+    '''
+
+    if method == 'GET' and path == CLAIM_PATH and params.get('claim_left'):
+        return claim_left(params)
+    elif method == 'GET' and path == STATE_PATH:
+        return state(params)
+    elif method != 'POST' or path not in (CLAIM_PATH, BATCH_PATH):
+        return None
+
+    def handler():
+        return batch(data) if path == BATCH_PATH else claim(data)
+
+    key = headers.get('idempotency-key')
+    if not key:
+        return handler()
+
+    result = run_once(build_idempotency_cache_key(
+        IDEMPOTENCY_SCOPE, data.get('username', ''), key), handler)
+    if result is None:
+        return constants.ACTION_TOO_FREQUENT, 400
+
+    return result[:2]
+
+
+def call_in_thread(func, *args):
+    # What Django does around each request
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def handle_in_thread(*args):
+    try:
+        return call_in_thread(handle, *args)
+    except Exception as exc:
+        logger.exception(exc)
+        return constants.NOT_OK_UNKNOWN, 500
+
+
+def get_stream_event_type(params):
+    return EnvelopeClaim.objects.get_event_type(params.get('event_type', 0))
+
+
+def render(data, status):
+    content = renderer.get_response_content(data, status)
+
+    return json.dumps(content, cls=JSONEncoder, ensure_ascii=False,
+                      separators=(',', ':')).encode()
+
+
+def parse_body(headers, body):
+    if not body:
+        return {}
+
+    content_type = headers.get('content-type', '')
+    try:
+        if content_type.startswith('application/json'):
+            data = json.loads(body.decode())
+            if not isinstance(data, dict):
+                raise BadRequest('JSON body is not an object')
+            return data
+
+        return dict(parse_qsl(body.decode()))
+    except ValueError as exc:
+        raise BadRequest(exc)
+
+
+async def read_request(reader):
+    '''
+    (method, target, headers, body) of the next request on the connection,
+    or None when the client is done with it.
+    '''
+
+    try:
+        line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+
+    if not line.strip():
+        return None
+
+    try:
+        method, target, _version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest('Invalid request line')
+
+    headers = {}
+    for _i in range(MAX_HEADERS):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+        name, _sep, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise BadRequest('Too many headers')
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise BadRequest('Invalid Content-Length')
+
+    if not 0 <= length <= MAX_BODY_SIZE:
+        raise BadRequest('Body too large')
+
+    body = await reader.readexactly(length) if length else b''
+
+    return method, target, headers, body
+
+
+def write_response(writer, status, reason, body=b'', keep_alive=True):
+    writer.write(
+        f'HTTP/1.1 {status} {reason}\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+        f'\r\n'.encode('latin-1') + body)
+
+
+class StatusHub(object):
+    '''
+    The status streams of the gateway by event. An event's status is built
+    at most once per STATUS_TICK, only when a claim changed it (or every
+    STATUS_REFRESH seconds), and pushed to all of its streams when it
+    differs from the last one.
+    '''
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.streams = defaultdict(set)
+        self.event_types = {}
+        self.payloads = {}
+        self.changed = set()
+
+    def subscribe(self, event_type):
+        queue = asyncio.Queue()
+        self.streams[event_type.id].add(queue)
+        self.event_types[event_type.id] = event_type
+
+        cached = self.payloads.get(event_type.id)
+        if cached is not None:
+            queue.put_nowait(cached[1])
+
+        return queue
+
+    def unsubscribe(self, event_type, queue):
+        streams = self.streams.get(event_type.id)
+        if streams is None:
+            return
+
+        streams.discard(queue)
+        if not streams:
+            del self.streams[event_type.id]
+            self.payloads.pop(event_type.id, None)
+
+    def notify(self, event_type_id):
+        if event_type_id in self.streams:
+            self.changed.add(event_type_id)
+
+    async def update(self, event_type_id, now):
+        loop = asyncio.get_event_loop()
+        cached = self.payloads.get(event_type_id)
+        if cached is not None and event_type_id not in self.changed and \
+                now - cached[0] < STATUS_REFRESH:
+            return
+
+        self.changed.discard(event_type_id)
+        try:
+            payload = await loop.run_in_executor(
+                self.executor, call_in_thread, get_status_payload,
+                self.event_types[event_type_id])
+        except Exception as exc:
+            logger.exception(exc)
+            return
+
+        if event_type_id not in self.streams:
+            return
+
+        self.payloads[event_type_id] = (now, payload)
+        if cached is None or cached[1] != payload:
+            for queue in self.streams[event_type_id]:
+                queue.put_nowait(payload)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await asyncio.sleep(STATUS_TICK)
+            now = loop.time()
+            for event_type_id in list(self.streams):
+                await self.update(event_type_id, now)
+
+    def listen(self, loop):
+        '''
+        Mark the events published on STATUS_CHANNEL as changed, from a
+        thread since the redis client blocks.
+        '''
+
+        while True:
+            client = get_redis()
+            if client is None:
+                logger.warning('Status streams refresh without redis')
+                return
+
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(STATUS_CHANNEL)
+                for message in pubsub.listen():
+                    loop.call_soon_threadsafe(self.notify,
+                                              int(message['data']))
+            except (RedisError, ValueError) as exc:
+                logger.error(exc)
+                time.sleep(STATUS_REFRESH)
+
+
+def write_stream_headers(writer):
+    writer.write(b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'X-Accel-Buffering: no\r\n'
+                 b'Connection: close\r\n'
+                 b'\r\n')
+
+
+class Gateway(object):
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.hub = StatusHub(self.executor)
+
+    async def stream(self, writer, event_type):
+        '''
+        Server-sent events of an event's status until STREAM_MAX_AGE, with a
+        keepalive comment when idle.
+        '''
+
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        queue = self.hub.subscribe(event_type)
+        write_stream_headers(writer)
+
+        try:
+            while loop.time() - started_at < STREAM_MAX_AGE:
+                try:
+                    payload = await asyncio.wait_for(queue.get(),
+                                                     STREAM_KEEPALIVE)
+                    writer.write(
+                        f'event: status\ndata: {payload}\n\n'.encode())
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+
+                await writer.drain()
+        finally:
+            self.hub.unsubscribe(event_type, queue)
+
+    async def serve(self, reader, writer):
+        loop = asyncio.get_event_loop()
+
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+
+                    method, target, headers, body = request
+                    url = urlsplit(target)
+                    params = dict(parse_qsl(url.query))
+                    data = parse_body(headers, body)
+                except BadRequest as exc:
+                    logger.info(f'Bad request: {exc}')
+                    write_response(writer, 400, 'Bad Request',
+                                   keep_alive=False)
+                    break
+
+                if method == 'GET' and url.path == STREAM_PATH:
+                    event_type = await loop.run_in_executor(
+                        self.executor, call_in_thread,
+                        get_stream_event_type, params)
+                    if event_type:
+                        await self.stream(writer, event_type)
+                    else:
+                        write_response(writer, 200, 'OK',
+                                       render(constants.INVALID_EVENT_TYPE,
+                                              400),
+                                       keep_alive=False)
+                    break
+
+                result = await loop.run_in_executor(
+                    self.executor, handle_in_thread,
+                    method, url.path, params, headers, data)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if result is None:
+                    write_response(writer, 404, 'Not Found',
+                                   keep_alive=keep_alive)
+                else:
+                    # GrizzlyRenderer always answers 200, errors are coded
+                    write_response(writer, 200, 'OK', render(*result),
+                                   keep_alive=keep_alive)
+
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def run(self, host, port):
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(
+            asyncio.start_server(self.serve, host, port))
+        hub = loop.create_task(self.hub.run())
+        threading.Thread(target=self.hub.listen, args=(loop,),
+                         daemon=True).start()
+        logger.info(f'Envelope gateway listening on {host}:{port}')
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            hub.cancel()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
+            loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--workers', type=int, default=32,
+                        help='threads running the claim logic')
+    args = parser.parse_args()
+
+    if not settings.ENVELOPE_WRITE_BEHIND:
+        logger.warning('ENVELOPE_WRITE_BEHIND is off, claims are written '
+                       'to the database before answering')
+
+    Gateway(args.workers).run(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,898 @@
+import json
+import logging
+
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
+
+# Keep a day's keys around long enough to survive the day boundary
+LEDGER_KEY_TTL = 60 * 60 * 48
+
+# Amounts are kept in cents so every ledger operation is integer arithmetic.
+# What is taken is also counted as pending (KEYS[2]) until it is written.
+RESERVE_SCRIPT = '''
+local remaining = redis.call('GET', KEYS[1])
+if not remaining then
+    return -1
+end
+remaining = tonumber(remaining)
+if remaining <= 0 then
+    return 0
+end
+local amount = math.min(tonumber(ARGV[1]), remaining)
+redis.call('DECRBY', KEYS[1], amount)
+redis.call('INCRBY', KEYS[2], amount)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return amount
+'''
+
+# Adjust a counter only if it is still there; a missing key must stay cold
+INCRBY_IF_EXISTS_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], ARGV[1])
+return 1
+'''
+
+COMPARE_AND_SET_SCRIPT = '''
+local current = redis.call('GET', KEYS[1])
+if current ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+'''
+
+# Take one unit of stock; returns the stock before, -1 when not seeded
+TAKE_STOCK_SCRIPT = '''
+local stock = redis.call('GET', KEYS[1])
+if not stock then
+    return -1
+end
+stock = tonumber(stock)
+if stock > 0 then
+    redis.call('DECR', KEYS[1])
+end
+return stock
+'''
+
+
+def get_redis():
+    '''
+    Raw redis client behind the default cache, or None when the cache
+    is not redis-backed (e.g. tests) or redis cannot be reached.
+    '''
+
+    try:
+        return get_redis_connection('default')
+    except (NotImplementedError, RedisError) as exc:
+        logger.warning(f'Redis unavailable: {exc}')
+        return None
+
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+
+def from_cents(cents):
+    return round(int(cents) / 100, 2)
+
+
+class PoolLedger(object):
+    '''
+    Per-event, per-day counter of the pool amount left to claim.
+
+    The ledger is seeded from the database on a cold start and every claim
+    reserves its amount atomically before the claim row is written, so
+    concurrent claims can never take more than the pool holds.
+    '''
+
+    def __init__(self, event_type, business_date=None):
+        self.event_type = event_type
+        self.business_date = business_date or \
+            timezone.localtime(timezone.now()).date()
+        self.client = get_redis()
+
+    @property
+    def key(self):
+        return (f'envelope:pool:{self.event_type.id}:'
+                f'{self.business_date:%Y%m%d}')
+
+    @staticmethod
+    def get_pending_key(event_type_id, business_date):
+        return f'envelope:pool:{event_type_id}:{business_date:%Y%m%d}:pending'
+
+    @property
+    def pending_key(self):
+        return self.get_pending_key(self.event_type.id, self.business_date)
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def remaining(self):
+        '''
+        Return the remaining pool amount, or None when the ledger has not
+        been seeded yet or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            value = self.client.get(self.key)
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        return from_cents(value) if value is not None else None
+
+    def seed(self, amount, force=False):
+        '''
+        Initialize the ledger with the remaining pool amount computed from
+        the database. Unless forced, an existing ledger is left untouched.
+        '''
+
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.set(self.key, to_cents(amount),
+                                        ex=LEDGER_KEY_TTL, nx=not force))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def reserve(self, amount):
+        '''
+        Atomically take up to `amount` from the pool.
+
+        Returns the amount granted (0 when the pool is empty), or None when
+        the ledger is not seeded or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            reserve = self.client.register_script(RESERVE_SCRIPT)
+            granted = reserve(keys=[self.key, self.pending_key],
+                              args=[to_cents(amount), LEDGER_KEY_TTL])
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        if granted < 0:
+            return None
+
+        return from_cents(granted)
+
+    def release(self, amount):
+        '''
+        Give back an amount reserved for a claim that was not written.
+        '''
+
+        if not self.is_available or not amount:
+            return
+
+        try:
+            incrby = self.client.register_script(INCRBY_IF_EXISTS_SCRIPT)
+            incrby(keys=[self.key], args=[to_cents(amount)])
+            self.client.decrby(self.pending_key, to_cents(amount))
+        except RedisError as exc:
+            logger.error(exc)
+
+    def settle(self, amount):
+        '''
+        Drop a reserved amount from the pending ones once its claims are
+        written to the database.
+        '''
+
+        if not self.is_available or not amount:
+            return
+
+        try:
+            self.client.decrby(self.pending_key, to_cents(amount))
+        except RedisError as exc:
+            logger.error(exc)
+
+    def get_pending(self):
+        value = self.client.get(self.pending_key)
+
+        return max(int(value or 0), 0)
+
+    def reconcile(self, get_remaining_amount):
+        '''
+        Reset the ledger to the remaining amount computed from the database
+        by `get_remaining_amount`, less the amounts reserved for claims not
+        written yet, which the database cannot see.
+
+        The value read before the database aggregate is compared and swapped
+        atomically, so a reservation landing in between skips this round
+        instead of being lost. The pending amounts are read after the
+        aggregate, so a claim written in between counts twice rather than
+        not at all.
+        '''
+
+        if not self.is_available:
+            return False
+
+        try:
+            current = self.client.get(self.key)
+            expected = to_cents(get_remaining_amount()) - self.get_pending()
+            if current is None:
+                return self.seed(from_cents(expected))
+
+            if int(current) == expected:
+                return True
+
+            compare_and_set = self.client.register_script(
+                COMPARE_AND_SET_SCRIPT)
+            swapped = compare_and_set(
+                keys=[self.key],
+                args=[current, expected, LEDGER_KEY_TTL])
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+        if swapped:
+            logger.info(f'Pool ledger {self.key} reconciled: '
+                        f'{from_cents(current)} -> {from_cents(expected)}')
+
+        return bool(swapped)
+
+
+# Check-and-increment a member's claim count against the allowed quantity,
+# taking up to ARGV[2] claims at once
+TAKE_CLAIM_SCRIPT = '''
+local count = redis.call('GET', KEYS[1])
+if not count then
+    return -1
+end
+local left = tonumber(ARGV[1]) - tonumber(count)
+if left <= 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], math.min(tonumber(ARGV[2]), left))
+return left
+'''
+
+CLAIM_WINDOW_TTLS = {
+    'minute': 60 * 2,
+    'hour': 60 * 60 * 2,
+}
+
+
+class ClaimCounter(object):
+    '''
+    Per-member, per-event count of claims made in the current claim window.
+
+    The window is the day, or the `{code}_claim_frequency` unit within the
+    day (e.g. the hour), and the key expires with it. A cold counter is
+    seeded from the database count.
+    '''
+
+    def __init__(self, username, event_type, unit=None, now=None):
+        self.username = username
+        self.event_type = event_type
+        self.unit = unit
+        self.now = now or timezone.localtime(timezone.now())
+        self.client = get_redis()
+
+    @staticmethod
+    def get_key(username, event_type, unit, now):
+        window = f'{now:%Y%m%d}'
+        if unit:
+            window = f'{window}:{unit}{getattr(now, unit)}'
+
+        return f'envelope:claims:{event_type.id}:{username}:{window}'
+
+    @property
+    def key(self):
+        return self.get_key(self.username, self.event_type, self.unit,
+                            self.now)
+
+    @property
+    def ttl(self):
+        return CLAIM_WINDOW_TTLS.get(self.unit, LEDGER_KEY_TTL)
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def count(self):
+        '''
+        Return the claims made in the window, or None when the counter has
+        not been seeded yet or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            value = self.client.get(self.key)
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        return int(value) if value is not None else None
+
+    @classmethod
+    def count_many(cls, usernames, event_type, unit=None, now=None):
+        '''
+        {username: claims made in the window} of the seeded counters among
+        `usernames`, in one round trip.
+        '''
+
+        client = get_redis()
+        if client is None or not usernames:
+            return {}
+
+        now = now or timezone.localtime(timezone.now())
+        try:
+            values = client.mget([cls.get_key(username, event_type, unit, now)
+                                  for username in usernames])
+        except RedisError as exc:
+            logger.error(exc)
+            return {}
+
+        return {username: int(value)
+                for username, value in zip(usernames, values)
+                if value is not None}
+
+    def seed(self, count):
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.set(self.key, count,
+                                        ex=self.ttl, nx=True))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def take(self, allowed, count=1):
+        '''
+        Atomically count up to `count` claims if fewer than `allowed` were
+        made.
+
+        Returns the claims left before these (0 when none are left), or
+        None when the counter is not seeded or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            take = self.client.register_script(TAKE_CLAIM_SCRIPT)
+            claim_left = take(keys=[self.key], args=[allowed, count])
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        return claim_left if claim_left >= 0 else None
+
+    def release(self, count=1):
+        if not self.is_available or not count:
+            return
+
+        try:
+            incrby = self.client.register_script(INCRBY_IF_EXISTS_SCRIPT)
+            incrby(keys=[self.key], args=[-count])
+        except RedisError as exc:
+            logger.error(exc)
+
+
+# Pop up to ARGV[1] envelopes and take them off the pool ledger too
+POP_DECK_SCRIPT = '''
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return -1
+end
+local amounts = {}
+for i = 1, tonumber(ARGV[1]) do
+    local amount = redis.call('LPOP', KEYS[1])
+    if not amount then
+        break
+    end
+    table.insert(amounts, amount)
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        redis.call('DECRBY', KEYS[3], amount)
+    end
+end
+return amounts
+'''
+
+
+class EnvelopeDeck(object):
+    '''
+    Queue of envelope amounts the day's pool was split into before the
+    event opened. A claim pops the next envelope, so the pool total is
+    exact by construction and the claim path draws nothing.
+    '''
+
+    def __init__(self, event_type, business_date=None):
+        self.event_type = event_type
+        self.business_date = business_date or \
+            timezone.localtime(timezone.now()).date()
+        self.client = get_redis()
+        self.pool = PoolLedger(event_type, self.business_date)
+
+    @property
+    def key(self):
+        return (f'envelope:deck:{self.event_type.id}:'
+                f'{self.business_date:%Y%m%d}')
+
+    @property
+    def loaded_key(self):
+        # The list key disappears once empty, this one tells it was loaded
+        return f'{self.key}:loaded'
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def is_loaded(self):
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.exists(self.loaded_key))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def size(self):
+        if not self.is_available:
+            return None
+
+        try:
+            return self.client.llen(self.key)
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+    def load(self, amounts):
+        '''
+        Replace the deck with `amounts` and reset the pool ledger to their
+        total in one transaction.
+        '''
+
+        if not self.is_available:
+            return False
+
+        cents = [to_cents(amount) for amount in amounts]
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.delete(self.key)
+            for index in range(0, len(cents), 1000):
+                pipe.rpush(self.key, *cents[index:index + 1000])
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.set(self.loaded_key, 1, ex=LEDGER_KEY_TTL)
+            pipe.set(self.pool.key, sum(cents), ex=LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+        return True
+
+    def pop(self, count=1):
+        '''
+        Pop up to `count` envelope amounts, fewer when the deck runs out.
+        Returns None when the deck is not loaded or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            pop = self.client.register_script(POP_DECK_SCRIPT)
+            amounts = pop(keys=[self.key, self.loaded_key, self.pool.key],
+                          args=[count])
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        if not isinstance(amounts, list):
+            return None
+
+        return [from_cents(amount) for amount in amounts]
+
+    def release(self, amounts):
+        '''
+        Put back the envelopes of claims that were not written.
+        '''
+
+        if not self.is_available or not amounts:
+            return
+
+        cents = [to_cents(amount) for amount in amounts]
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.lpush(self.key, *cents)
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.execute()
+
+            # Popped envelopes are never counted as pending, so only the
+            # pool gets them back
+            incrby = self.client.register_script(INCRBY_IF_EXISTS_SCRIPT)
+            incrby(keys=[self.pool.key], args=[sum(cents)])
+        except RedisError as exc:
+            logger.error(exc)
+
+
+class Leaderboard(object):
+    '''
+    Sorted set of each member's claimed amount for one event and day,
+    kept up to date by the claim path.
+    '''
+
+    def __init__(self, event_type, business_date=None):
+        self.event_type = event_type
+        self.business_date = business_date or \
+            timezone.localtime(timezone.now()).date()
+        self.client = get_redis()
+
+    @property
+    def key(self):
+        return (f'envelope:leaderboard:{self.event_type.id}:'
+                f'{self.business_date:%Y%m%d}')
+
+    @property
+    def loaded_key(self):
+        return f'{self.key}:loaded'
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def is_loaded(self):
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.exists(self.loaded_key))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def add(self, amounts):
+        '''
+        Add `amounts` ({username: amount}) to the members' totals.
+        '''
+
+        if not self.is_available or not amounts:
+            return
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            for username, amount in amounts.items():
+                pipe.zincrby(self.key, to_cents(amount), username)
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+
+    def load(self, amounts):
+        '''
+        Replace the leaderboard with `amounts` ({username: amount}).
+        '''
+
+        if not self.is_available:
+            return False
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.delete(self.key)
+            if amounts:
+                pipe.zadd(self.key, {username: to_cents(amount)
+                                     for username, amount in amounts.items()})
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.set(self.loaded_key, 1, ex=LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+        return True
+
+    def top(self, limit):
+        '''
+        [(username, amount)] of the `limit` highest totals, highest first.
+        '''
+
+        try:
+            members = self.client.zrevrange(self.key, 0, limit - 1,
+                                            withscores=True)
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        return [(username.decode(), from_cents(score))
+                for username, score in members]
+
+    def rank(self, username):
+        '''
+        (rank, amount) of a member, rank 1 being the highest total, or
+        None when the member has no claim yet.
+        '''
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.zrevrank(self.key, username)
+            pipe.zscore(self.key, username)
+            rank, score = pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        if rank is None:
+            return None
+
+        return rank + 1, from_cents(score)
+
+
+# Event ids whose status changed, for the gateway's status streams
+STATUS_CHANNEL = 'envelope:status'
+
+
+def publish_status_change(event_type):
+    client = get_redis()
+    if client is None:
+        return
+
+    try:
+        client.publish(STATUS_CHANNEL, event_type.id)
+    except RedisError as exc:
+        logger.error(exc)
+
+
+class RecentWinners(object):
+    '''
+    The last few claims of an event and day, newest first.
+    '''
+
+    SIZE = 20
+
+    def __init__(self, event_type, business_date=None):
+        self.event_type = event_type
+        self.business_date = business_date or \
+            timezone.localtime(timezone.now()).date()
+        self.client = get_redis()
+
+    @property
+    def key(self):
+        return (f'envelope:winners:{self.event_type.id}:'
+                f'{self.business_date:%Y%m%d}')
+
+    def add(self, winners):
+        if self.client is None or not winners:
+            return
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.lpush(self.key, *[json.dumps(winner) for winner in winners])
+            pipe.ltrim(self.key, 0, self.SIZE - 1)
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+
+    def list(self):
+        if self.client is None:
+            return []
+
+        try:
+            winners = self.client.lrange(self.key, 0, self.SIZE - 1)
+        except RedisError as exc:
+            logger.error(exc)
+            return []
+
+        return [json.loads(winner) for winner in winners]
+
+
+class EligibleMembers(object):
+    '''
+    Set of the members with a deposit for an event and day, so members
+    without one are turned away without a database query.
+
+    It may hold members whose deposits were since removed (they fall
+    through to the regular checks) but never misses one once loaded:
+    deposits add to it as they are written and a load only adds to it.
+    '''
+
+    # Usernames per SADD, keeps a large load from blocking redis
+    LOAD_CHUNK_SIZE = 5000
+
+    def __init__(self, event_type_id, business_date=None):
+        self.event_type_id = event_type_id
+        self.business_date = business_date or \
+            timezone.localtime(timezone.now()).date()
+        self.client = get_redis()
+
+    @property
+    def key(self):
+        return (f'envelope:eligible:{self.event_type_id}:'
+                f'{self.business_date:%Y%m%d}')
+
+    @property
+    def loaded_key(self):
+        return f'{self.key}:loaded'
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def is_loaded(self):
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.exists(self.loaded_key))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def contains(self, username):
+        '''
+        Whether the member may have a deposit: False only when the set is
+        loaded and the member is not in it, None when it is not loaded.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.exists(self.loaded_key)
+            pipe.sismember(self.key, username)
+            is_loaded, is_member = pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        if not is_loaded:
+            return None
+
+        return bool(is_member)
+
+    def add(self, usernames):
+        if not self.is_available or not usernames:
+            return
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.sadd(self.key, *usernames)
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            # A missed member would be turned away, stop trusting the set
+            try:
+                self.client.delete(self.loaded_key)
+            except RedisError:
+                pass
+
+    def load(self, usernames):
+        '''
+        Add `usernames` and mark the set as loaded. Members added by
+        deposits written meanwhile are kept.
+        '''
+
+        if not self.is_available:
+            return False
+
+        usernames = list(usernames)
+        try:
+            for i in range(0, len(usernames), self.LOAD_CHUNK_SIZE):
+                self.client.sadd(self.key,
+                                 *usernames[i:i + self.LOAD_CHUNK_SIZE])
+
+            pipe = self.client.pipeline(transaction=True)
+            pipe.expire(self.key, LEDGER_KEY_TTL)
+            pipe.set(self.loaded_key, 1, ex=LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+        return True
+
+
+class RewardStock(object):
+    '''
+    Counter of the units left of a limited reward, taken atomically by the
+    reward draw. Stock is not per day, so the key does not expire; it is
+    dropped when the reward is edited and seeded again from the database.
+    '''
+
+    def __init__(self, reward_id):
+        self.reward_id = reward_id
+        self.client = get_redis()
+
+    @staticmethod
+    def get_key(reward_id):
+        return f'envelope:reward_stock:{reward_id}'
+
+    @property
+    def key(self):
+        return self.get_key(self.reward_id)
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def seed(self, stock):
+        if not self.is_available:
+            return False
+
+        try:
+            return bool(self.client.set(self.key, max(int(stock), 0),
+                                        nx=True))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def take(self):
+        '''
+        Take one unit. Returns the units left before it (0 when out of
+        stock), or None when the counter is cold or redis is unavailable.
+        '''
+
+        if not self.is_available:
+            return None
+
+        try:
+            take = self.client.register_script(TAKE_STOCK_SCRIPT)
+            stock = take(keys=[self.key])
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+        return None if stock < 0 else stock
+
+    def release(self, count=1):
+        if not self.is_available or count <= 0:
+            return
+
+        try:
+            release = self.client.register_script(INCRBY_IF_EXISTS_SCRIPT)
+            release(keys=[self.key], args=[count])
+        except RedisError as exc:
+            logger.error(exc)
+
+    def reset(self):
+        if not self.is_available:
+            return
+
+        try:
+            self.client.delete(self.key)
+        except RedisError as exc:
+            logger.error(exc)
+
+    @classmethod
+    def get_many(cls, reward_ids):
+        '''
+        {reward_id: units left} of the seeded counters among `reward_ids`.
+        '''
+
+        client = get_redis()
+        if client is None or not reward_ids:
+            return {}
+
+        try:
+            values = client.mget([cls.get_key(reward_id)
+                                  for reward_id in reward_ids])
+        except RedisError as exc:
+            logger.error(exc)
+            return {}
+
+        return {reward_id: int(value)
+                for reward_id, value in zip(reward_ids, values)
+                if value is not None}
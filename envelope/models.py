@@ -2,14 +2,31 @@ from __future__ import unicode_literals
 
 import logging
 import random
+import uuid
 
-from datetime import datetime
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
-from django.db.models import Sum
+from django.utils.dateparse import parse_datetime
+from django.db.models import Count, F, Sum
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 from configsetting.models import GlobalPreference
+from envelope.ledger import (ClaimCounter,
+                             EligibleMembers,
+                             EnvelopeDeck,
+                             Leaderboard,
+                             PoolLedger,
+                             RecentWinners,
+                             RewardStock,
+                             publish_status_change,
+                             to_cents)
+from envelope.snapshot import (EventSnapshot,
+                               PREFERENCE_SUFFIXES,
+                               get_snapshot)
+from envelope.writebehind import WriteBehindQueue
 
 CLAIM_STATUS_OPTION = (
     (0, 'Pending'),
@@ -32,10 +49,14 @@ ENVELOPE_TYPE_OPTIONS = (
 
 TYPE_ENVELOPE_DEPOSIT_IMPORT = 0
 TYPE_ENVELOPE_CLAIM_EXPORT = 1
+TYPE_ENVELOPE_CLAIM_UPDATE = 2
+TYPE_EVENT_SIMULATION = 3
 
 REQUEST_TYPE_OPTIONS = (
     (TYPE_ENVELOPE_DEPOSIT_IMPORT, 'Import Member Deposits'),
     (TYPE_ENVELOPE_CLAIM_EXPORT, 'Export Member Claims'),
+    (TYPE_ENVELOPE_CLAIM_UPDATE, 'Bulk Update Member Claims'),
+    (TYPE_EVENT_SIMULATION, 'Simulate Event Pool'),
 )
 
 REQUEST_LOG_STATUS_OPTIONS = (
@@ -48,9 +69,40 @@ REQUEST_LOG_STATUS_OPTIONS = (
 logger = logging.getLogger(__name__)
 
 
+class EventTypeManager(models.Manager):
+    def get_snapshot(self, code):
+        '''
+        Compiled configuration of the event type, cached per process.
+        Returns None for an unknown code.
+        '''
+
+        return get_snapshot(code, self.compile_snapshot)
+
+    def compile_snapshot(self, code, version=0):
+        event_type = self.filter(code=code).order_by('id').first()
+        if not event_type:
+            return None
+
+        levels = EnvelopeLevel.objects.filter(event_type=event_type).\
+            values('name', 'amount', 'quantity')
+        amount_settings = EnvelopeAmountSetting.objects.filter(
+            event_type=event_type).values(
+                'threshold_amount',
+                'min_amount',
+                'max_amount'
+            )
+        rewards = Reward.objects.filter(event_type=event_type).order_by('id')
+        preferences = dict(GlobalPreference.objects.filter(key__in=[
+            f'{code}{suffix}' for suffix in PREFERENCE_SUFFIXES
+        ]).values_list('key', 'value'))
+
+        return EventSnapshot(event_type, levels, amount_settings, rewards,
+                             preferences, version=version)
+
+
 class EventType(models.Model):
     name = models.CharField(max_length=255, null=False, blank=False)
-    code = models.CharField(max_length=255)
+    code = models.CharField(max_length=255, db_index=True)
     is_active = models.BooleanField(default=1)
     date_from = models.DateField(null=True, blank=True)
     time_from = models.TimeField(default='00:00:00')
@@ -68,6 +120,10 @@ class EventType(models.Model):
                                    on_delete=models.SET_NULL)
     memo = models.TextField(null=True, blank=True)
     is_reward = models.BooleanField(default=0)
+    # Split the pool into envelopes before the event opens
+    is_presplit = models.BooleanField(default=0)
+
+    objects = EventTypeManager()
 
     def __str__(self):
         return self.name
@@ -87,21 +143,21 @@ class Reward(models.Model):
     updated_at = models.DateTimeField(auto_now=True,
                                       null=True, blank=True)
     chance = models.IntegerField(default=0)
+    # Units that can be won, None when unlimited
+    stock = models.IntegerField(null=True, blank=True)
+    # Units left as of the last stock reconciliation
+    stock_left = models.IntegerField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
 
 class EnvelopeClaimManager(models.Manager):
-    SMALL_AMOUNTS = 0
-    MEDIUM_AMOUNTS = 1
-    LARGE_AMOUNTS = 2
-    SMALL_CHANCE = 0.9
-    MEDIUM_CHANCE = 0.08
-    LARGE_CHANCE = 0.02
-
-    def get_claims_total_amount_today(self, event_type):
-        today = timezone.localtime(timezone.now()).date()
+    # Short enough for the state of an open event to look live
+    STATE_CACHE_TIMEOUT = 10
+
+    def get_claims_total_amount_today(self, event_type, business_date=None):
+        today = business_date or timezone.localtime(timezone.now()).date()
         amount = self.filter(created_at__date=today, event_type=event_type)
 
         if not amount.exists():
@@ -109,174 +165,640 @@ class EnvelopeClaimManager(models.Manager):
 
         return amount.aggregate(Sum('amount')).get('amount__sum', 0)
 
-    def remaining_pool_amount(self, event_type):
-        pool_amount = GlobalPreference.objects.\
-            get_value(f'{event_type.code}_pool_amount')
+    @staticmethod
+    def get_snapshot(event_type):
+        return EventType.objects.get_snapshot(event_type.code)
 
-        if pool_amount is None:
-            pool_amount = 0
+    def get_pool_amount(self, event_type):
+        return self.get_snapshot(event_type).pool_amount
 
+    def get_db_remaining_pool_amount(self, event_type, business_date=None):
         claims_total_amount_today = self.get_claims_total_amount_today(
-            event_type)
+            event_type, business_date)
 
-        return float(pool_amount) - claims_total_amount_today
+        return self.get_pool_amount(event_type) - claims_total_amount_today
 
-    @staticmethod
-    def get_deposit(username, event_type):
-        today = timezone.localtime(timezone.now()).date()
+    def remaining_pool_amount(self, event_type):
+        ledger = PoolLedger(event_type)
+        remaining_amount = ledger.remaining()
+
+        if remaining_amount is None:
+            remaining_amount = self.get_db_remaining_pool_amount(event_type)
+            ledger.seed(remaining_amount)
+
+        return remaining_amount
+
+    def reserve_pool_amount(self, event_type, amount):
+        '''
+        Take up to `amount` from today's pool before the claim is written.
+        Returns the amount granted (0 when the pool is empty) and whether
+        the ledger holds it as pending, to release or settle it later.
+        '''
+
+        ledger = PoolLedger(event_type)
+        granted = ledger.reserve(amount)
+
+        if granted is None and ledger.is_available:
+            # Cold start, seed from the database and try again
+            ledger.seed(self.get_db_remaining_pool_amount(event_type))
+            granted = ledger.reserve(amount)
+
+        if granted is None:
+            logger.warning(f'Pool ledger unavailable for {event_type.code}, '
+                           'falling back to database aggregate')
+            remaining_amount = self.get_db_remaining_pool_amount(event_type)
+            return round(max(min(amount, remaining_amount), 0), 2), False
+
+        return granted, True
+
+    def release_pool_amount(self, event_type, amount):
+        PoolLedger(event_type).release(amount)
+
+    def settle_pool_amount(self, event_type, amount):
+        PoolLedger(event_type).settle(amount)
+
+    def reconcile_pool_amount(self, event_type):
+        return PoolLedger(event_type).reconcile(
+            lambda: self.get_db_remaining_pool_amount(event_type))
+
+    def build_deck(self, event_type, business_date=None):
+        '''
+        Split the day's remaining pool into envelope amounts drawn from the
+        event's default claim range tiers. The last envelope takes what is
+        left, so the deck adds up to the pool exactly.
+        '''
+
+        snapshot = self.get_snapshot(event_type)
+        amount_threshold = snapshot.default_threshold_range
+        if int(amount_threshold[1]) <= 0:
+            logger.error(f'No claim amount range for {event_type.code}')
+            return []
+
+        sampler = snapshot.get_amount_sampler(amount_threshold)
+        remaining = to_cents(self.get_db_remaining_pool_amount(
+            event_type, business_date))
+        amounts = []
+
+        while remaining > 0:
+            amount = to_cents(sampler.sample())
+            if amount <= 0:
+                continue
 
-        deposit = EnvelopeDeposit.objects.filter(
-            username=username,
-            created_at__date=today,
-            event_type=event_type
-        ).aggregate(Sum('amount')).get('amount__sum', 0)
+            amount = min(amount, remaining)
+            amounts.append(amount / 100)
+            remaining -= amount
+
+        random.shuffle(amounts)
+
+        return amounts
+
+    def load_deck(self, event_type, business_date=None):
+        amounts = self.build_deck(event_type, business_date)
+        if not EnvelopeDeck(event_type, business_date).load(amounts):
+            return None
+
+        return amounts
+
+    def pop_deck(self, event_type, count=1):
+        return EnvelopeDeck(event_type).pop(count)
+
+    def release_deck(self, event_type, amounts):
+        EnvelopeDeck(event_type).release(amounts)
 
-        return deposit or 0
+    @staticmethod
+    def get_deposit(username, event_type):
+        return EnvelopeDepositRollup.objects.get_amount(username, event_type)
 
     def get_threshold_range(self, username, event_type):
         deposit = self.get_deposit(username, event_type)
 
-        claim_amount_from = GlobalPreference.objects.\
-            get_value(f'{event_type.code}_claim_amount_from')
-        claim_amount_to = GlobalPreference.objects.\
-            get_value(f'{event_type.code}_claim_amount_to')
+        return self.get_snapshot(event_type).get_threshold_range(deposit)
 
-        envelope_amount_setting = EnvelopeAmountSetting.objects.filter(
-            threshold_amount__lte=deposit,
-            event_type=event_type).values(
-                'threshold_amount',
-                'min_amount',
-                'max_amount'
-            ).order_by('-threshold_amount')
+    def get_claim_allowance(self, username, event_type, today=None):
+        '''
+        Return a (allowed, unit) tuple: the number of claims allowed in the
+        current claim window and the window unit (None for the whole day).
+        Returns None when the event is closed.
+        '''
 
-        if envelope_amount_setting.exists():
-            amount_treshold = envelope_amount_setting.first()
-            return (float(amount_treshold.get('min_amount', 0)),
-                    float(amount_treshold.get('max_amount', 0)))
+        today = today or timezone.localtime(timezone.now())
+        snapshot = self.get_snapshot(event_type)
 
-        return (float(claim_amount_from), float(claim_amount_to))
+        if not snapshot.is_open(today):
+            return None
 
-    def get_quantity_left(self, username, event_type):
-        quantity = 0
-        today = timezone.localtime(timezone.now())
-        start_date = event_type.date_from or today.date()
-        end_date = event_type.date_to or today.date()
-        start_time = event_type.time_from
-        end_time = event_type.time_to
+        # Get user's today deposit(s)
+        return snapshot.get_allowance(self.get_deposit(username, event_type))
 
-        if not event_type.is_active:
-            return None
-        elif event_type.is_daily:
-            date_check = start_date <= today.date() <= end_date
-            time_check = start_time <= today.time() <= end_time
+    def get_claim_count(self, username, event_type, unit=None, today=None):
+        '''
+        Claims made by the user in the current claim window, read from the
+        claim counter and seeded from the database when cold.
+        '''
 
-            if not (date_check and time_check):
-                return None
-        else:
-            event_from = datetime.strptime(
-                f'{start_date:%Y-%m-%d} {start_time:%H:%M:%S}',
-                '%Y-%m-%d %H:%M:%S')
+        today = today or timezone.localtime(timezone.now())
+        counter = ClaimCounter(username, event_type, unit=unit, now=today)
 
-            event_to = datetime.strptime(
-                f'{end_date:%Y-%m-%d} {end_time:%H:%M:%S}',
-                '%Y-%m-%d %H:%M:%S')
+        claim = counter.count()
+        if claim is None:
+            claim = self.get_db_claim_count(username, event_type,
+                                            unit=unit, today=today)
+            counter.seed(claim)
 
-            if not event_from <= today.replace(tzinfo=None) <= event_to:
-                return None
+        return claim
 
+    def get_db_claim_count(self, username, event_type, unit=None,
+                           today=None):
+        today = today or timezone.localtime(timezone.now())
         filters = {
             'created_at__date': today.date(),
             'username': username,
             'event_type': event_type,
         }
 
-        # Get user's today deposit(s)
-        user_deposit = self.get_deposit(username, event_type)
+        if unit:
+            filters.update({f'created_at__{unit}': getattr(today, unit)})
 
-        if user_deposit == 0:
-            return 0
+        # Read the unflushed claims first, a claim flushed in between is
+        # then found in both and counted once
+        unflushed = [
+            claim['uuid'] for claim in self.get_unflushed(username)
+            if self.in_window(claim, event_type, unit, today)
+        ]
 
-        # Get levels
-        levels = EnvelopeLevel.objects.filter(event_type=event_type).\
-            values('amount', 'quantity').order_by('-amount')
+        claim = self.filter(**filters).count()
+        if unflushed:
+            claim += len(unflushed) - self.filter(uuid__in=unflushed).count()
 
-        # Get X time to claim amount
-        quantity = 0
-        for level in levels:
-            if user_deposit < level['amount']:
-                continue
-            else:
-                quantity = level['quantity']
-                break
+        return claim
 
-        claim_frequency = GlobalPreference.objects.list(
-            f'{event_type.code}_claim_frequency')
-        if claim_frequency and quantity:
-            claim_frequency = claim_frequency[0].split('/')
-            claim_count_allow = int(claim_frequency[0])
-            claim_rate = claim_frequency[1].split('.')
+    def get_db_claim_counts(self, usernames, event_type, unit=None,
+                            today=None):
+        '''
+        {username: claims in the current window} of many members, with
+        their unflushed write-behind claims as get_db_claim_count counts
+        them. Members without claims are left out.
+        '''
 
-            _value = getattr(today, claim_rate[1])
-            filters.update({f'created_at__{claim_rate[1]}': _value})
+        today = today or timezone.localtime(timezone.now())
+        filters = {
+            'created_at__date': today.date(),
+            'username__in': usernames,
+            'event_type': event_type,
+        }
 
-            claim = self.filter(**filters).count()
-            if claim_count_allow <= claim:
-                return 0
-            return claim_count_allow - claim
+        if unit:
+            filters.update({f'created_at__{unit}': getattr(today, unit)})
 
-        claim = self.filter(**filters)
+        unflushed = {
+            username: [claim['uuid'] for claim in claims
+                       if self.in_window(claim, event_type, unit, today)]
+            for username, claims in self.get_unflushed_many(usernames).items()
+        }
 
-        if claim.exists():
-            claim = claim.count()
-        else:
-            claim = 0
+        counts = dict(self.filter(**filters).values_list('username').
+                      annotate(total=Count('id')).order_by())
+
+        unflushed_uuids = [claim_uuid for uuids in unflushed.values()
+                           for claim_uuid in uuids]
+        if unflushed_uuids:
+            flushed = set(str(claim_uuid) for claim_uuid in self.filter(
+                uuid__in=unflushed_uuids).values_list('uuid', flat=True))
+            for username, uuids in unflushed.items():
+                left = len([claim_uuid for claim_uuid in uuids
+                            if claim_uuid not in flushed])
+                if left:
+                    counts[username] = counts.get(username, 0) + left
+
+        return counts
+
+    @staticmethod
+    def in_window(claim, event_type, unit, today):
+        '''
+        Whether an unflushed claim counts in the `unit` window of `today`.
+        '''
+
+        return claim['event_type'] == event_type.id and \
+            claim['created_at'].date() == today.date() and \
+            (not unit or
+             getattr(claim['created_at'], unit) == getattr(today, unit))
+
+    def get_quantities_left(self, usernames, event_type):
+        '''
+        {username: claim left} of many members, as get_quantity_left but
+        with one query per metric. Values are None when the event is closed.
+        '''
+
+        today = timezone.localtime(timezone.now())
+        snapshot = self.get_snapshot(event_type)
+
+        if not snapshot.is_open(today):
+            return dict.fromkeys(usernames)
+
+        deposits = EnvelopeDepositRollup.objects.get_amounts(usernames,
+                                                             event_type)
+        allowances = {username: snapshot.get_allowance(
+            deposits.get(username, 0)) for username in usernames}
 
-        if claim < quantity:
+        quantities_left = {}
+        by_unit = defaultdict(list)
+        for username, (allowed, unit) in allowances.items():
+            if allowed:
+                by_unit[unit].append(username)
+            else:
+                quantities_left[username] = 0
+
+        for unit, unit_usernames in by_unit.items():
+            counts = ClaimCounter.count_many(unit_usernames, event_type,
+                                             unit=unit, now=today)
+            cold = [username for username in unit_usernames
+                    if username not in counts]
+            if cold:
+                counts.update(self.get_db_claim_counts(cold, event_type,
+                                                       unit=unit,
+                                                       today=today))
+
+            for username in unit_usernames:
+                allowed = allowances[username][0]
+                quantities_left[username] = \
+                    max(allowed - counts.get(username, 0), 0)
+
+        return quantities_left
+
+    def get_unflushed(self, username):
+        '''
+        The member's write-behind claims not yet in the database.
+        '''
+
+        if not settings.ENVELOPE_WRITE_BEHIND:
+            return []
+
+        claims = WriteBehindQueue().get_unflushed(username)
+        for claim in claims:
+            claim['created_at'] = timezone.localtime(
+                parse_datetime(claim['created_at']))
+
+        return claims
+
+    def get_unflushed_many(self, usernames):
+        '''
+        {username: write-behind claims not yet in the database} of many
+        members.
+        '''
+
+        if not settings.ENVELOPE_WRITE_BEHIND:
+            return {}
+
+        unflushed = WriteBehindQueue().get_unflushed_many(list(usernames))
+        for claims in unflushed.values():
+            for claim in claims:
+                claim['created_at'] = timezone.localtime(
+                    parse_datetime(claim['created_at']))
+
+        return unflushed
+
+    def write_claims(self, claims):
+        '''
+        Persist write-behind claims, skipping those already written by a
+        flush that crashed before acknowledging them.
+        '''
+
+        existing = set(str(claim_uuid) for claim_uuid in self.filter(
+            uuid__in=[claim['uuid'] for claim in claims]
+        ).values_list('uuid', flat=True))
+
+        envelope_claims = self.bulk_create([
+            EnvelopeClaim(uuid=claim['uuid'],
+                          username=claim['username'],
+                          amount=claim['amount'],
+                          status=claim['status'],
+                          event_type_id=claim['event_type'],
+                          reward_id=claim.get('reward'),
+                          created_at=parse_datetime(claim['created_at']))
+            for claim in claims
+            if claim['uuid'] not in existing
+        ])
+
+        return len(envelope_claims)
+
+    def get_quantity_left(self, username, event_type):
+        today = timezone.localtime(timezone.now())
+        allowance = self.get_claim_allowance(username, event_type, today)
+
+        if allowance is None:
+            return None
+
+        allowed, unit = allowance
+        if not allowed:
+            return 0
+
+        claim = self.get_claim_count(username, event_type, unit, today)
+        if claim < allowed:
             # return claim left
-            return quantity - claim
+            return allowed - claim
         else:
             return 0
 
-    def get_claim_amount(self, event_type, amount_threshold):
-        amount_sizes = [
-            self.SMALL_AMOUNTS,
-            self.MEDIUM_AMOUNTS,
-            self.LARGE_AMOUNTS
-        ]
-        chances = [
-            self.SMALL_CHANCE,
-            self.MEDIUM_CHANCE,
-            self.LARGE_CHANCE
-        ]
-        amount_size_choice = random.choices(amount_sizes, weights=chances)[0]
+    def take_claim(self, username, event_type, count=1):
+        '''
+        Atomically count up to `count` claims for the user in the current
+        window. Returns the claims left before these, 0 when none are left,
+        or None when the event is closed; min(count, claims left) are taken.
+        '''
+
+        today = timezone.localtime(timezone.now())
+        allowance = self.get_claim_allowance(username, event_type, today)
+
+        if allowance is None:
+            return None
 
-        min_claim, max_claim = amount_threshold
-        amounts = [n for n in range(int(min_claim), int(max_claim) + 1)]
+        allowed, unit = allowance
+        if not allowed:
+            return 0
+
+        counter = ClaimCounter(username, event_type, unit=unit, now=today)
+        claim_left = counter.take(allowed, count)
+
+        if claim_left is None and counter.is_available:
+            # Cold counter, seed from the database and try again
+            counter.seed(self.get_db_claim_count(username, event_type,
+                                                 unit=unit, today=today))
+            claim_left = counter.take(allowed, count)
+
+        if claim_left is None:
+            logger.warning(f'Claim counter unavailable for {event_type.code}, '
+                           'falling back to database count')
+            claim = self.get_db_claim_count(username, event_type,
+                                            unit=unit, today=today)
+            claim_left = max(allowed - claim, 0)
 
-        amount_count = len(amounts)
-        chunks = int(amount_count / len(amount_sizes))
+        return claim_left
 
-        chunk_amounts = [
-            amounts[x:x + chunks] for x in range(0, amount_count, chunks)]
-        claim_amounts = chunk_amounts[amount_size_choice]
+    def release_claim(self, username, event_type, count=1):
+        today = timezone.localtime(timezone.now())
+        allowance = self.get_claim_allowance(username, event_type, today)
+
+        if allowance:
+            ClaimCounter(username, event_type,
+                         unit=allowance[1], now=today).release(count)
+
+    def get_claim_amount(self, event_type, amount_threshold):
+        sampler = self.get_snapshot(event_type).get_amount_sampler(
+            tuple(amount_threshold))
 
-        return round(random.uniform(
-                claim_amounts[0], claim_amounts[-1]), 2)
+        return sampler.sample()
 
     def get_reward(self, event_type):
-        rewards = Reward.objects.filter(event_type=event_type)
-        chances = [reward.chance for reward in rewards]
+        '''
+        Draw a reward, taking a unit of stock of limited ones. Rewards out
+        of stock are dropped from the distribution and drawn again.
+        '''
+
+        snapshot = self.get_snapshot(event_type)
+        sampler = snapshot.reward_sampler
+        sold_out = set()
+
+        for _ in range(len(snapshot.rewards)):
+            reward = sampler.sample()
+            if reward is None or reward.stock is None:
+                return reward
+
+            if self.take_reward_stock(reward):
+                return reward
+
+            sold_out.add(reward.id)
+            sampler = snapshot.get_reward_sampler(sold_out)
+
+        return None
+
+    def get_reward_stock_left(self, reward):
+        used = self.filter(reward=reward).exclude(status=2).count()
+
+        return max(reward.stock - used, 0)
+
+    def take_reward_stock(self, reward):
+        stock = RewardStock(reward.id)
+
+        stock_left = stock.take()
+        if stock_left is None and \
+                stock.seed(self.get_reward_stock_left(reward)):
+            stock_left = stock.take()
+
+        if stock_left is None:
+            # Redis unavailable, nothing was reserved so the reward counts
+            # as sold out rather than being given past its stock
+            logger.warning(f'Reward {reward.id} stock unavailable')
+            return False
+
+        return stock_left > 0
+
+    def release_reward_stock(self, reward_counts):
+        '''
+        Put back `reward_counts` ({reward_id: count}) units of stock.
+        '''
+
+        for reward_id, count in reward_counts.items():
+            RewardStock(reward_id).release(count)
+
+    def release_claims(self, claims):
+        '''
+        Put back the stock of the limited rewards of rejected or deleted
+        `claims` and take them off their days' leaderboards.
+        '''
+
+        self.release_reward_stock(Counter(
+            claim.reward_id for claim in claims
+            if claim.reward_id and claim.reward.stock is not None))
+        self.rebuild_claims_leaderboards(claims)
+
+    def restore_claims(self, claims):
+        '''
+        Count `claims` no longer rejected again: their limited rewards'
+        stock is seeded again from the claims on the next draw.
+        '''
+
+        for reward_id in set(claim.reward_id for claim in claims
+                             if claim.reward_id and
+                             claim.reward.stock is not None):
+            RewardStock(reward_id).reset()
+        self.rebuild_claims_leaderboards(claims)
+
+    def rebuild_claims_leaderboards(self, claims):
+        days = set((claim.event_type, timezone.localtime(
+            claim.created_at).date()) for claim in claims
+            if claim.event_type_id)
+
+        for event_type, business_date in days:
+            self.rebuild_leaderboard(event_type, business_date)
+
+    def reconcile_reward_stock(self):
+        '''
+        Write the stock counters of limited rewards back to the database.
+        '''
+
+        rewards = Reward.objects.filter(stock__isnull=False)
+        stocks = RewardStock.get_many([reward.id for reward in rewards])
+
+        updated = 0
+        with transaction.atomic():
+            for reward in rewards:
+                if reward.id in stocks and \
+                        reward.stock_left != stocks[reward.id]:
+                    # update() so the snapshots are not invalidated
+                    Reward.objects.filter(id=reward.id).update(
+                        stock_left=stocks[reward.id])
+                    updated += 1
+
+        return updated
+
+    def get_db_leaderboard(self, event_type, business_date=None):
+        '''
+        {username: amount} of the day's claims that were not rejected.
+        '''
+
+        today = business_date or timezone.localtime(timezone.now()).date()
+        totals = self.filter(
+            created_at__date=today,
+            event_type=event_type,
+            amount__gt=0,
+        ).exclude(status=2).values('username').annotate(total=Sum('amount'))
+
+        return {total['username']: total['total'] for total in totals
+                if total['username']}
+
+    def rebuild_leaderboard(self, event_type, business_date=None):
+        leaderboard = Leaderboard(event_type, business_date)
+        return leaderboard.load(self.get_db_leaderboard(event_type,
+                                                        business_date))
+
+    def publish_claims(self, event_type, claims):
+        '''
+        Add new claims to the event's leaderboard and recent winners, and
+        tell the status streams.
+        '''
+
+        amounts = {}
+        for claim in claims:
+            if claim['amount'] > 0:
+                amounts[claim['username']] = \
+                    amounts.get(claim['username'], 0) + claim['amount']
+
+        Leaderboard(event_type).add(amounts)
+        RecentWinners(event_type).add([
+            {'username': claim['username'],
+             'amount': claim['amount'],
+             'reward': claim.get('reward')}
+            for claim in claims
+        ])
+        publish_status_change(event_type)
+
+    def get_leaderboard(self, event_type, limit=10, username=None):
+        '''
+        Today's top winners of the event and, given a username, that
+        member's rank. Loads the leaderboard from the database when cold.
+        '''
+
+        leaderboard = Leaderboard(event_type)
+        if not leaderboard.is_loaded():
+            self.rebuild_leaderboard(event_type)
+
+        top = rank = None
+        if leaderboard.is_loaded():
+            top = leaderboard.top(limit)
+            rank = leaderboard.rank(username) if username else None
+
+        if top is None:
+            # Redis unavailable, rank from the database
+            totals = sorted(self.get_db_leaderboard(event_type).items(),
+                            key=lambda total: total[1], reverse=True)
+            top = [(name, round(amount, 2)) for name, amount in totals]
+            rank = next(((index + 1, amount)
+                         for index, (name, amount) in enumerate(top)
+                         if name == username), None)
+            top = top[:limit]
+
+        data = {
+            'top': [{'rank': index + 1, 'username': name, 'amount': amount}
+                    for index, (name, amount) in enumerate(top)],
+        }
+
+        if username:
+            data['member'] = {
+                'username': username,
+                'rank': rank[0] if rank else None,
+                'amount': rank[1] if rank else 0,
+            }
+
+        return data
 
-        return random.choices(rewards, weights=chances)[0]
+    @staticmethod
+    def get_state_cache_key(username, event_type_id):
+        return f'envelope_state_{event_type_id}_{username}'
+
+    def get_accepted_total_today(self, username, event_type):
+        today = timezone.localtime(timezone.now()).date()
+
+        return self.filter(
+            username=username,
+            created_at__date=today,
+            status=1,
+            event_type=event_type
+        ).aggregate(total=Sum('amount')).get('total') or 0
+
+    def get_event_state(self, username, event_type):
+        '''
+        Everything a member's event page shows, cached per user and event
+        for STATE_CACHE_TIMEOUT seconds.
+        '''
+
+        cache_key = self.get_state_cache_key(username, event_type.id)
+        state = cache.get(cache_key)
+
+        if state is None:
+            now = timezone.localtime(timezone.now())
+            snapshot = self.get_snapshot(event_type)
+            state = {
+                'event': {
+                    'name': event_type.name,
+                    'date_from': event_type.date_from,
+                    'time_from': event_type.time_from,
+                    'date_to': event_type.date_to,
+                    'time_to': event_type.time_to,
+                    'memo': event_type.memo,
+                    'is_active': event_type.is_active,
+                    'is_open': snapshot.is_open(now),
+                },
+                'claim_left': self.get_quantity_left(username, event_type),
+                'deposit': self.get_deposit(username, event_type),
+                'total': self.get_accepted_total_today(username, event_type),
+                'levels': [{'name': level['name'],
+                            'amount': level['amount'],
+                            'quantity': level['quantity']}
+                           for level in snapshot.levels],
+            }
+
+            if not event_type.is_reward:
+                state['remaining_pool_amount'] = max(
+                    round(self.remaining_pool_amount(event_type), 2), 0)
+
+            cache.set(cache_key, state, self.STATE_CACHE_TIMEOUT)
+
+        return state
+
+    def invalidate_event_state(self, username, event_type):
+        cache.delete(self.get_state_cache_key(username, event_type.id))
 
     def get_event_type(self, event_type):
-        try:
-            return EventType.objects.get(code=event_type)
-        except EventType.DoesNotExist:
-            return None
+        snapshot = EventType.objects.get_snapshot(event_type)
+
+        return snapshot.event_type if snapshot else None
 
 
 class EnvelopeClaim(models.Model):
+    # Known before the row is written, write-behind claims are answered
+    # with it
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True,
+                            editable=False, null=True)
     username = models.CharField(max_length=255, null=True, blank=True)
     amount = models.FloatField(default=0.0)
     reward = models.ForeignKey(Reward, null=True, blank=True,
@@ -292,7 +814,8 @@ class EnvelopeClaim(models.Model):
     created_by = models.ForeignKey(User, null=True, blank=True,
                                    related_name='envelope_claim_created_by',
                                    on_delete=models.SET_NULL)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set by the claim path, write-behind claims are written later
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_by = models.ForeignKey(User,
                                    null=True, blank=True,
                                    related_name='envelope_claim_updated_by',
@@ -352,6 +875,236 @@ class EnvelopeDeposit(models.Model):
         return f'{self.username} - {self.amount:.2f} ({created_data})'
 
 
+class EnvelopeDepositRollupManager(models.Manager):
+    # Short enough to bound a stale read racing an invalidation
+    CACHE_TIMEOUT = 60 * 10
+
+    @staticmethod
+    def get_business_date(created_at=None):
+        return timezone.localtime(created_at or timezone.now()).date()
+
+    @staticmethod
+    def get_cache_key(username, event_type_id, business_date):
+        return (f'envelope_deposit_{event_type_id}_{username}_'
+                f'{business_date:%Y%m%d}')
+
+    def get_amount(self, username, event_type, business_date=None):
+        business_date = business_date or self.get_business_date()
+        if EligibleMembers(event_type.id, business_date).contains(
+                username) is False:
+            return 0
+
+        cache_key = self.get_cache_key(username, event_type.id, business_date)
+
+        amount = cache.get(cache_key)
+        if amount is None:
+            amount = self.filter(
+                username=username,
+                event_type=event_type,
+                business_date=business_date
+            ).values_list('amount', flat=True).first() or 0
+            cache.set(cache_key, amount, self.CACHE_TIMEOUT)
+
+        return amount
+
+    def get_amounts(self, usernames, event_type, business_date=None):
+        '''
+        {username: amount} of many members in one query, members without a
+        deposit are left out.
+        '''
+
+        business_date = business_date or self.get_business_date()
+
+        return dict(self.filter(
+            username__in=usernames,
+            event_type=event_type,
+            business_date=business_date
+        ).values_list('username', 'amount'))
+
+    def add_amounts(self, event_type_id, business_date, amounts):
+        '''
+        Add `amounts` ({username: amount}) to the rollup rows of the day.
+        Must run inside the transaction writing the deposits.
+        '''
+
+        existing = set(self.select_for_update().filter(
+            event_type_id=event_type_id,
+            business_date=business_date,
+            username__in=list(amounts.keys())
+        ).values_list('username', flat=True))
+
+        for username in existing:
+            self.filter(
+                username=username,
+                event_type_id=event_type_id,
+                business_date=business_date
+            ).update(amount=F('amount') + amounts[username])
+
+        new_rollups = [
+            EnvelopeDepositRollup(username=username,
+                                  event_type_id=event_type_id,
+                                  business_date=business_date,
+                                  amount=amount)
+            for username, amount in amounts.items()
+            if username not in existing
+        ]
+        try:
+            with transaction.atomic():
+                self.bulk_create(new_rollups)
+        except IntegrityError:
+            # Another writer inserted some of them meanwhile, add to those
+            for rollup in new_rollups:
+                try:
+                    with transaction.atomic():
+                        self.create(username=rollup.username,
+                                    event_type_id=event_type_id,
+                                    business_date=business_date,
+                                    amount=rollup.amount)
+                except IntegrityError:
+                    self.filter(
+                        username=rollup.username,
+                        event_type_id=event_type_id,
+                        business_date=business_date
+                    ).update(amount=F('amount') + rollup.amount)
+
+        cache_keys = [
+            self.get_cache_key(username, event_type_id, business_date)
+            for username in amounts.keys()
+        ] + [
+            EnvelopeClaimManager.get_state_cache_key(username, event_type_id)
+            for username in amounts.keys()
+        ]
+        eligible = [username for username, amount in amounts.items()
+                    if amount > 0]
+
+        def on_commit():
+            EligibleMembers(event_type_id, business_date).add(eligible)
+            cache.delete_many(cache_keys)
+
+        transaction.on_commit(on_commit)
+
+    def add_deposit(self, deposit, sign=1):
+        if not deposit.event_type_id or not deposit.username:
+            return
+
+        self.add_amounts(deposit.event_type_id,
+                         self.get_business_date(deposit.created_at),
+                         {deposit.username: sign * deposit.amount})
+
+    def rebuild(self, event_type_id, business_date):
+        '''
+        Recompute the rollup rows of the day from EnvelopeDeposit.
+        '''
+
+        deposits = list(EnvelopeDeposit.objects.filter(
+            event_type_id=event_type_id,
+            created_at__date=business_date,
+            username__isnull=False
+        ).values('username').annotate(total=Sum('amount')))
+
+        with transaction.atomic():
+            previous = self.filter(event_type_id=event_type_id,
+                                   business_date=business_date)
+            usernames = set(previous.values_list('username', flat=True))
+            usernames.update(deposit['username'] for deposit in deposits)
+            cache_keys = [
+                self.get_cache_key(username, event_type_id, business_date)
+                for username in usernames
+            ] + [
+                EnvelopeClaimManager.get_state_cache_key(username,
+                                                         event_type_id)
+                for username in usernames
+            ]
+            previous.delete()
+
+            rollups = self.bulk_create([
+                EnvelopeDepositRollup(username=deposit['username'],
+                                      event_type_id=event_type_id,
+                                      business_date=business_date,
+                                      amount=deposit['total'])
+                for deposit in deposits
+            ])
+            eligible = [deposit['username'] for deposit in deposits
+                        if deposit['total'] > 0]
+
+            def on_commit():
+                EligibleMembers(event_type_id, business_date).add(eligible)
+                cache.delete_many(cache_keys)
+
+            transaction.on_commit(on_commit)
+
+        return len(rollups)
+
+    def warm_cache(self, event_type_id, business_date=None):
+        '''
+        Cache the rollup amount of every member with a deposit on
+        `business_date`. Returns the number of members cached.
+        '''
+
+        CHUNK_SIZE = 1000
+        business_date = business_date or self.get_business_date()
+        rollups = self.filter(
+            event_type_id=event_type_id,
+            business_date=business_date
+        ).values_list('username', 'amount').iterator()
+
+        total = 0
+        chunk = {}
+        for username, amount in rollups:
+            chunk[self.get_cache_key(username, event_type_id,
+                                     business_date)] = amount
+            if len(chunk) >= CHUNK_SIZE:
+                cache.set_many(chunk, self.CACHE_TIMEOUT)
+                total += len(chunk)
+                chunk = {}
+
+        if chunk:
+            cache.set_many(chunk, self.CACHE_TIMEOUT)
+            total += len(chunk)
+
+        return total
+
+    def load_eligible_members(self, event_type_id, business_date=None):
+        '''
+        Load the set of members with a deposit on `business_date` so the
+        others are turned away without a query. Returns the number of
+        members, or None when redis is unavailable.
+        '''
+
+        business_date = business_date or self.get_business_date()
+        usernames = self.filter(
+            event_type_id=event_type_id,
+            business_date=business_date,
+            amount__gt=0
+        ).values_list('username', flat=True)
+
+        usernames = list(usernames.iterator())
+        if not EligibleMembers(event_type_id, business_date).load(usernames):
+            return None
+
+        return len(usernames)
+
+
+class EnvelopeDepositRollup(models.Model):
+    username = models.CharField(max_length=100)
+    event_type = models.ForeignKey(EventType,
+                                   on_delete=models.CASCADE,
+                                   related_name='deposit_rollup_event_type')
+    business_date = models.DateField()
+    amount = models.FloatField(default=0.0)
+    updated_at = models.DateTimeField(auto_now=True,
+                                      null=True, blank=True)
+
+    objects = EnvelopeDepositRollupManager()
+
+    class Meta:
+        db_table = 'envelope_depositrollup'
+        unique_together = (('username', 'event_type', 'business_date'),)
+
+    def __str__(self):
+        return f'{self.username} - {self.amount:.2f} ({self.business_date})'
+
+
 class EnvelopeAmountSetting(models.Model):
     name = models.CharField(max_length=255, null=False, blank=False)
     threshold_amount = models.FloatField(default=0.0)
@@ -392,6 +1145,8 @@ class RequestLog(models.Model):
     memo = models.TextField(null=True, blank=True)
     filename = models.CharField(max_length=255,
                                 null=True, blank=True)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
     created_by = models.ForeignKey(User, null=True, blank=True,
                                    related_name='requestlog_createdby',
                                    on_delete=models.SET_NULL)
@@ -0,0 +1,101 @@
+import random
+
+# Small, medium and large claim amounts
+DEFAULT_TIER_WEIGHTS = (0.9, 0.08, 0.02)
+
+
+class AliasSampler(object):
+    '''
+    Weighted choice over a fixed list of items using Vose's alias method:
+    O(n) to build, O(1) time and memory per draw.
+    '''
+
+    def __init__(self, items, weights):
+        self.items = list(items)
+        weights = [max(float(weight or 0), 0) for weight in weights]
+        total = sum(weights)
+        size = len(self.items)
+
+        self.probabilities = [1.0] * size
+        self.aliases = list(range(size))
+
+        if not size or total <= 0:
+            self.items = []
+            return
+
+        scaled = [weight * size / total for weight in weights]
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Whatever is left is 1 up to float rounding
+        for i in small + large:
+            self.probabilities[i] = 1.0
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def sample(self, rng=random):
+        '''
+        Draw one item, or None when there is nothing to draw from.
+        '''
+
+        if not self.items:
+            return None
+
+        i = rng.randrange(len(self.items))
+        if rng.random() < self.probabilities[i]:
+            return self.items[i]
+
+        return self.items[self.aliases[i]]
+
+
+class TieredAmountSampler(object):
+    '''
+    Draw a claim amount between `min_amount` and `max_amount`.
+
+    The whole-number range is split into as many equal tiers as there are
+    weights (small, medium, large amounts...). A tier is chosen by weight,
+    then an amount is drawn uniformly between the tier's first and last
+    whole number. Tier bounds are closed-form, so no range is materialized.
+    '''
+
+    def __init__(self, min_amount, max_amount, weights):
+        self.low = int(min_amount)
+        self.high = int(max_amount)
+        self.tiers = len(weights)
+        self.tier_size = int((self.high - self.low + 1) / self.tiers)
+        self.tier_sampler = AliasSampler(range(self.tiers), weights)
+
+    def get_tier_bounds(self, tier):
+        if self.tier_size <= 0:
+            # Fewer whole numbers than tiers, draw from the whole range
+            return self.low, self.high
+
+        first = self.low + tier * self.tier_size
+        return first, first + self.tier_size - 1
+
+    def sample(self, rng=random):
+        tier = self.tier_sampler.sample(rng) or 0
+        first, last = self.get_tier_bounds(tier)
+
+        return round(rng.uniform(first, last), 2)
+
+    def sample_tier(self, rng=random):
+        '''
+        Like sample, returning (tier, amount).
+        '''
+
+        tier = self.tier_sampler.sample(rng) or 0
+        first, last = self.get_tier_bounds(tier)
+
+        return tier, round(rng.uniform(first, last), 2)
@@ -1,3 +1,4 @@
+from django.db import models
 from rest_framework import serializers
 
 from envelope.models import (EnvelopeLevel,
@@ -9,20 +10,45 @@ from envelope.models import (EnvelopeLevel,
                              Reward)
 
 
+class EnvelopeClaimMemberListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        claims = data.all() if isinstance(data, models.Manager) else data
+        claims = list(claims)
+
+        # Every claim of a user and event shares the same claim left
+        claim_left = {}
+        for claim in claims:
+            key = (claim.username, claim.event_type_id)
+            if key not in claim_left:
+                claim_left[key] = EnvelopeClaim.objects.get_quantity_left(
+                    claim.username, claim.event_type)
+
+        self.context['claim_left'] = claim_left
+
+        return [self.child.to_representation(claim) for claim in claims]
+
+
 class EnvelopeClaimMemberSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = EnvelopeClaim
-        fields = ('id', 'username', 'amount', 'reward',
+        fields = ('id', 'uuid', 'username', 'amount', 'reward',
                   'event_type', 'status', 'created_at')
+        list_serializer_class = EnvelopeClaimMemberListSerializer
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
         request = self.context.get('request')
         fields_expand = request.GET.get('opt_expand', '')
 
-        ret['claim_left'] = EnvelopeClaim.objects.get_quantity_left(
-            instance.username, instance.event_type)
+        claim_left = self.context.get('claim_left', {})
+        key = (instance.username, instance.event_type_id)
+        if key in claim_left:
+            ret['claim_left'] = claim_left[key]
+        else:
+            ret['claim_left'] = EnvelopeClaim.objects.get_quantity_left(
+                instance.username, instance.event_type)
 
         if instance.reward and 'reward' in fields_expand:
             ret['reward'] = {
@@ -160,6 +186,9 @@ class EventTypeAdminSerializer(serializers.ModelSerializer):
         if 'memo' in validated_keys:
             instance.memo = validated_data.get('memo')
 
+        if 'is_presplit' in validated_keys:
+            instance.is_presplit = validated_data.get('is_presplit')
+
         instance.save()
 
         return instance
@@ -0,0 +1,64 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from configsetting.models import GlobalPreference
+from envelope.models import (EnvelopeAmountSetting,
+                             EnvelopeLevel,
+                             EventType,
+                             Reward)
+from envelope.ledger import RewardStock
+from envelope.snapshot import PREFERENCE_SUFFIXES, bump_version
+from envelope.tasks import reconcile_pool_ledger, warm_up_events
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SENDERS = (
+    EventType,
+    EnvelopeLevel,
+    EnvelopeAmountSetting,
+    Reward,
+    GlobalPreference,
+)
+
+
+def enqueue(task, **options):
+    '''
+    Queue `task` once the current transaction commits. A broker error is
+    only logged, the beat runs the same tasks on its own schedule.
+    '''
+
+    def apply():
+        try:
+            task.apply_async(queue='envelope_operations', **options)
+        except Exception:
+            logger.exception(f'Could not queue {task.name}')
+
+    transaction.on_commit(apply)
+
+
+def invalidate_event_snapshot(sender, instance, **kwargs):
+    if sender is GlobalPreference and \
+            not instance.key.endswith(PREFERENCE_SUFFIXES):
+        return
+
+    bump_version()
+
+    # Warm up open events again with the new configuration, once a burst
+    # of admin edits is over
+    enqueue(warm_up_events, countdown=5)
+
+    if sender is GlobalPreference and instance.key.endswith('_pool_amount'):
+        # Bring today's pool ledger in line with the new pool size
+        enqueue(reconcile_pool_ledger)
+
+    if sender is Reward and kwargs.get('update_fields') is None:
+        # Seeded again from the new stock and the claims on the next draw
+        RewardStock(instance.id).reset()
+
+
+for sender in SNAPSHOT_SENDERS:
+    post_save.connect(invalidate_event_snapshot, sender=sender)
+    post_delete.connect(invalidate_event_snapshot, sender=sender)
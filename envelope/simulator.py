@@ -0,0 +1,256 @@
+import math
+import random
+
+from datetime import datetime
+
+from envelope.ledger import from_cents, to_cents
+from envelope.samplers import AliasSampler
+
+
+# Claims drawn across all runs of one simulation, keeps a request bounded
+MAX_SIMULATED_CLAIMS = 5000000
+UNIT_SECONDS = {
+    'minute': 60,
+    'hour': 60 * 60,
+}
+DAY_SECONDS = 60 * 60 * 24
+
+
+def get_percentiles(values, percentiles=(50, 90, 99)):
+    '''
+    Nearest-rank percentiles of `values`, None for an empty list.
+    '''
+
+    values = sorted(values)
+    if not values:
+        return dict.fromkeys((f'p{p}' for p in percentiles))
+
+    return {f'p{p}': values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+            for p in percentiles}
+
+
+def get_synthetic_deposits(members, median, sigma, rng=random):
+    '''
+    Log-normally distributed deposits, the usual shape of deposit amounts.
+    '''
+
+    mu = math.log(median)
+    return [round(rng.lognormvariate(mu, sigma), 2) for _ in range(members)]
+
+
+class PoolSimulation(object):
+    '''
+    Monte Carlo replay of one event day: members with `deposits` claim
+    at random times of the event window as often as the event allows, and
+    every claim is drawn with the event snapshot's own samplers.
+    '''
+
+    def __init__(self, snapshot, deposits, participation=1.0,
+                 pool_amount=None, seed=None):
+        self.snapshot = snapshot
+        self.deposits = deposits
+        self.participation = participation
+        self.pool_amount = snapshot.pool_amount if pool_amount is None \
+            else pool_amount
+        self.rng = random.Random(seed)
+        self.window = self.get_window_seconds()
+
+    def get_window_seconds(self):
+        snapshot = self.snapshot
+        if snapshot.event_type.is_daily or \
+                not (snapshot.event_from and snapshot.event_to):
+            day = datetime.min.date()
+            window = datetime.combine(day, snapshot.time_to) - \
+                datetime.combine(day, snapshot.time_from)
+            seconds = window.total_seconds()
+        else:
+            seconds = (snapshot.event_to - snapshot.event_from).total_seconds()
+
+        # The pool is per day
+        return max(min(seconds, DAY_SECONDS), 1)
+
+    def get_claims(self):
+        '''
+        [(seconds after opening, member, (min, max) amount range)] of the
+        day's claims, in time order.
+        '''
+
+        rng = self.rng
+        snapshot = self.snapshot
+        claims = []
+
+        for member, deposit in enumerate(self.deposits):
+            if rng.random() >= self.participation:
+                continue
+
+            allowed, unit = snapshot.get_allowance(deposit)
+            if not allowed:
+                continue
+
+            if snapshot.event_type.is_presplit:
+                amount_threshold = snapshot.default_threshold_range
+            else:
+                amount_threshold = snapshot.get_threshold_range(deposit)
+
+            # Claims are allowed again in every window of the unit
+            unit_seconds = min(UNIT_SECONDS.get(unit, self.window),
+                               self.window)
+            for window in range(math.ceil(self.window / unit_seconds)):
+                window_start = window * unit_seconds
+                window_seconds = min(unit_seconds, self.window - window_start)
+                claims.extend(
+                    (window_start + rng.random() * window_seconds, member,
+                     amount_threshold)
+                    for _ in range(allowed))
+
+        claims.sort(key=lambda claim: claim[0])
+        return claims
+
+    def run_pool(self, claims):
+        rng = self.rng
+        snapshot = self.snapshot
+        remaining = to_cents(self.pool_amount)
+        result = {
+            'depleted_at': None,
+            'amounts': [],
+            'member_payouts': {},
+            'tiers': {},
+        }
+
+        for seconds, member, amount_threshold in claims:
+            if remaining <= 0:
+                break
+
+            if amount_threshold[0] == amount_threshold[1]:
+                continue
+
+            sampler = snapshot.get_amount_sampler(amount_threshold)
+            tier, amount = sampler.sample_tier(rng)
+            cents = min(to_cents(amount), remaining)
+            remaining -= cents
+
+            result['amounts'].append(from_cents(cents))
+            result['member_payouts'][member] = \
+                result['member_payouts'].get(member, 0) + cents
+            tiers = result['tiers'].setdefault(amount_threshold,
+                                               [0] * sampler.tiers)
+            tiers[tier] += 1
+
+            if remaining <= 0:
+                result['depleted_at'] = round(seconds)
+
+        return result
+
+    def run_rewards(self, claims):
+        rng = self.rng
+        rewards = [reward for reward in self.snapshot.rewards
+                   if reward.stock is None or reward.stock > 0]
+        sampler = AliasSampler(rewards,
+                               [reward.chance for reward in rewards])
+        result = {'hits': {}, 'sold_out_at': {}}
+
+        for seconds, member, amount_threshold in claims:
+            reward = sampler.sample(rng)
+            if reward is None:
+                break
+
+            hits = result['hits'][reward.id] = \
+                result['hits'].get(reward.id, 0) + 1
+
+            if reward.stock is not None and hits >= reward.stock:
+                # Out of stock, drawn from the other rewards from now on
+                result['sold_out_at'][reward.id] = round(seconds)
+                rewards.remove(reward)
+                sampler = AliasSampler(
+                    rewards, [reward.chance for reward in rewards])
+
+        return result
+
+    def run(self, runs=10):
+        '''
+        Simulate `runs` days and report the pool depletion time, payout
+        percentiles and tier hit rates (reward hit rates and stock-out
+        times on reward events).
+        '''
+
+        snapshot = self.snapshot
+        is_reward = snapshot.event_type.is_reward
+        report = {
+            'members': len(self.deposits),
+            'opens_at': snapshot.time_from,
+            'window_seconds': self.window,
+            'runs': 0,
+            'claims': [],
+        }
+        results = []
+
+        while report['runs'] < runs:
+            claims = self.get_claims()
+            if sum(report['claims']) + len(claims) > MAX_SIMULATED_CLAIMS \
+                    and report['runs']:
+                break
+
+            report['runs'] += 1
+            report['claims'].append(len(claims))
+            results.append(self.run_rewards(claims) if is_reward
+                           else self.run_pool(claims))
+
+        report['claims'] = get_percentiles(report['claims'])
+
+        if is_reward:
+            report.update(self.get_reward_report(results))
+        else:
+            report.update(self.get_pool_report(results))
+
+        return report
+
+    def get_pool_report(self, results):
+        depleted_at = [result['depleted_at'] for result in results
+                       if result['depleted_at'] is not None]
+        hits = {}
+        for result in results:
+            for amount_threshold, tiers in result['tiers'].items():
+                total = hits.setdefault(amount_threshold, [0] * len(tiers))
+                for tier, count in enumerate(tiers):
+                    total[tier] += count
+
+        return {
+            'pool_amount': self.pool_amount,
+            'depleted_runs': len(depleted_at) / len(results),
+            'depletion_seconds': get_percentiles(depleted_at, (10, 50, 90)),
+            'claim_amount': get_percentiles(
+                [amount for result in results
+                 for amount in result['amounts']]),
+            'member_payout': get_percentiles(
+                [from_cents(cents) for result in results
+                 for cents in result['member_payouts'].values()]),
+            'total_payout': get_percentiles(
+                [round(sum(result['amounts']), 2) for result in results]),
+            'tier_hit_rates': {
+                f'{amount_threshold[0]:g}-{amount_threshold[1]:g}':
+                    [round(count / sum(tiers), 4) for count in tiers]
+                for amount_threshold, tiers in hits.items()
+            },
+        }
+
+    def get_reward_report(self, results):
+        draws = sum(sum(result['hits'].values()) for result in results)
+        rewards = []
+
+        for reward in self.snapshot.rewards:
+            hits = sum(result['hits'].get(reward.id, 0)
+                       for result in results)
+            sold_out_at = [result['sold_out_at'][reward.id]
+                           for result in results
+                           if reward.id in result['sold_out_at']]
+            rewards.append({
+                'id': reward.id,
+                'name': reward.name,
+                'stock': reward.stock,
+                'hit_rate': round(hits / draws, 4) if draws else 0,
+                'sold_out_runs': len(sold_out_at) / len(results),
+                'sold_out_seconds': get_percentiles(sold_out_at,
+                                                    (10, 50, 90)),
+            })
+
+        return {'rewards': rewards}
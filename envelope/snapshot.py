@@ -0,0 +1,237 @@
+import logging
+import time
+
+from bisect import bisect_right
+from datetime import datetime
+from django.core.cache import cache
+
+from envelope.samplers import (AliasSampler,
+                               TieredAmountSampler,
+                               DEFAULT_TIER_WEIGHTS)
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION_KEY = 'envelope_snapshot_version'
+
+# Rebuild even without a version bump, in case the cache was unreachable
+# when the bump happened
+SNAPSHOT_MAX_AGE = 60
+
+# Global preferences of an event, each key being the event code followed by
+# one of these
+PREFERENCE_SUFFIXES = (
+    '_pool_amount',
+    '_claim_amount_from',
+    '_claim_amount_to',
+    '_claim_frequency',
+    '_claim_amount_weights',
+)
+
+_snapshots = {}
+
+
+def get_version():
+    return cache.get(SNAPSHOT_VERSION_KEY) or 0
+
+
+def bump_version():
+    if not cache.add(SNAPSHOT_VERSION_KEY, 1, None):
+        try:
+            cache.incr(SNAPSHOT_VERSION_KEY)
+        except ValueError:
+            cache.set(SNAPSHOT_VERSION_KEY, 1, None)
+
+
+def get_snapshot(code, loader):
+    '''
+    Return the compiled snapshot of event type `code` from the process
+    cache, rebuilding it with `loader(code, version)` when the version
+    stamp changed or it is older than SNAPSHOT_MAX_AGE.
+    '''
+
+    version = get_version()
+    cached = _snapshots.get(code)
+
+    if cached is not None:
+        cached_version, compiled_at, snapshot = cached
+        if cached_version == version and \
+                time.monotonic() - compiled_at < SNAPSHOT_MAX_AGE:
+            return snapshot
+
+    snapshot = loader(code, version)
+    if snapshot is not None:
+        # Unknown codes are not kept, clients can send any code
+        _snapshots[code] = (version, time.monotonic(), snapshot)
+
+    return snapshot
+
+
+class EventSnapshot(object):
+    '''
+    Compiled, read-only configuration of one EventType: its window, levels,
+    amount settings, rewards and global preferences, in sorted form so the
+    claim path answers eligibility without touching the database.
+    '''
+
+    def __init__(self, event_type, levels, amount_settings, rewards,
+                 preferences, version=0):
+        code = event_type.code
+
+        self.event_type = event_type
+        self.version = version
+        self.rewards = list(rewards)
+        self.reward_sampler = AliasSampler(
+            self.rewards, [reward.chance for reward in self.rewards])
+
+        # Sorted ascending so bisect finds the highest level reached
+        levels = sorted(levels, key=lambda level: level['amount'])
+        self.level_amounts = [level['amount'] for level in levels]
+        self.level_quantities = [level['quantity'] for level in levels]
+        self.levels = levels
+
+        amount_settings = sorted(
+            amount_settings, key=lambda setting: setting['threshold_amount'])
+        self.threshold_amounts = [
+            setting['threshold_amount'] for setting in amount_settings]
+        self.threshold_ranges = [
+            (float(setting['min_amount'] or 0),
+             float(setting['max_amount'] or 0))
+            for setting in amount_settings]
+
+        self.pool_amount = float(
+            preferences.get(f'{code}_pool_amount') or 0)
+        self.default_threshold_range = (
+            float(preferences.get(f'{code}_claim_amount_from') or 0),
+            float(preferences.get(f'{code}_claim_amount_to') or 0))
+
+        # e.g. '0.9,0.08,0.02' for small, medium and large amounts
+        self.amount_weights = DEFAULT_TIER_WEIGHTS
+        amount_weights = preferences.get(f'{code}_claim_amount_weights')
+        if amount_weights:
+            try:
+                self.amount_weights = tuple(
+                    float(weight) for weight in amount_weights.split(','))
+            except ValueError:
+                logger.error(f'Invalid {code}_claim_amount_weights: '
+                             f'{amount_weights}')
+
+        self.amount_samplers = {}
+
+        # e.g. '3/1.hour', 3 claims allowed per hour
+        self.claim_frequency = None
+        claim_frequency = preferences.get(f'{code}_claim_frequency')
+        if claim_frequency:
+            claim_count_allow, claim_rate = \
+                claim_frequency.split(',')[0].split('/')
+            self.claim_frequency = (int(claim_count_allow),
+                                    claim_rate.split('.')[1])
+
+        self.date_from = event_type.date_from
+        self.date_to = event_type.date_to
+        self.time_from = event_type.time_from
+        self.time_to = event_type.time_to
+        self.event_from = None
+        self.event_to = None
+        if self.date_from:
+            self.event_from = datetime.combine(self.date_from, self.time_from)
+        if self.date_to:
+            self.event_to = datetime.combine(self.date_to, self.time_to)
+
+    @property
+    def code(self):
+        return self.event_type.code
+
+    @property
+    def is_active(self):
+        return self.event_type.is_active
+
+    @property
+    def is_reward(self):
+        return self.event_type.is_reward
+
+    def is_open(self, now):
+        '''
+        Whether the event accepts claims at local time `now`.
+        '''
+
+        if not self.is_active:
+            return False
+
+        today = now.date()
+        if self.event_type.is_daily:
+            start_date = self.date_from or today
+            end_date = self.date_to or today
+
+            return start_date <= today <= end_date and \
+                self.time_from <= now.time() <= self.time_to
+
+        event_from = self.event_from or \
+            datetime.combine(today, self.time_from)
+        event_to = self.event_to or datetime.combine(today, self.time_to)
+
+        return event_from <= now.replace(tzinfo=None) <= event_to
+
+    def get_reward_sampler(self, sold_out):
+        '''
+        Reward sampler without the rewards whose ids are in `sold_out`,
+        built apart so the shared snapshot is left as it is.
+        '''
+
+        rewards = [reward for reward in self.rewards
+                   if reward.id not in sold_out]
+
+        return AliasSampler(rewards, [reward.chance for reward in rewards])
+
+    def get_quantity(self, deposit):
+        '''
+        Claim quantity of the highest level reached by `deposit`.
+        '''
+
+        index = bisect_right(self.level_amounts, deposit)
+        if not index:
+            return 0
+
+        return self.level_quantities[index - 1]
+
+    def get_allowance(self, deposit):
+        '''
+        (allowed, unit) claims of a member with `deposit`, see
+        EnvelopeClaimManager.get_claim_allowance.
+        '''
+
+        if deposit == 0:
+            return (0, None)
+
+        # Get X time to claim amount
+        quantity = self.get_quantity(deposit)
+
+        if self.claim_frequency and quantity:
+            return self.claim_frequency
+
+        return (quantity, None)
+
+    def get_threshold_range(self, deposit):
+        '''
+        (min, max) claim amount of the highest threshold reached by
+        `deposit`, falling back to the event's default claim range.
+        '''
+
+        index = bisect_right(self.threshold_amounts, deposit)
+        if not index:
+            return self.default_threshold_range
+
+        return self.threshold_ranges[index - 1]
+
+    def get_amount_sampler(self, amount_threshold):
+        '''
+        Claim amount sampler of a (min, max) range, compiled once per range.
+        '''
+
+        sampler = self.amount_samplers.get(amount_threshold)
+        if sampler is None:
+            sampler = TieredAmountSampler(*amount_threshold,
+                                          self.amount_weights)
+            self.amount_samplers[amount_threshold] = sampler
+
+        return sampler
@@ -0,0 +1,51 @@
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from envelope.ledger import RecentWinners
+from envelope.models import EnvelopeClaim
+
+
+# Seconds between two updates of an event, whatever the number of claims.
+# Polling clients use it as their interval, the gateway streams coalesce
+# the claims of a tick into one update.
+STATUS_TICK = 1
+
+_statuses = {}
+
+
+def get_event_status(event_type):
+    '''
+    Remaining pool, open state and recent winners of an event, computed at
+    most once per STATUS_TICK in this process and shared by all of its
+    requests.
+    '''
+
+    cached = _statuses.get(event_type.id)
+    if cached is not None and time.monotonic() - cached[0] < STATUS_TICK:
+        return cached[1]
+
+    now = timezone.localtime(timezone.now())
+    snapshot = EnvelopeClaim.objects.get_snapshot(event_type)
+    status = {
+        'event_type': event_type.code,
+        'is_open': snapshot.is_open(now),
+        'winners': RecentWinners(event_type).list(),
+        'poll_interval': STATUS_TICK,
+    }
+
+    if not event_type.is_reward:
+        # Seeded from the database when the ledger is cold
+        status['remaining_pool_amount'] = max(round(
+            EnvelopeClaim.objects.remaining_pool_amount(event_type), 2), 0)
+
+    _statuses[event_type.id] = (time.monotonic(), status)
+
+    return status
+
+
+def get_status_payload(event_type):
+    return json.dumps(get_event_status(event_type), cls=DjangoJSONEncoder,
+                      separators=(',', ':'))
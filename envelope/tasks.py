@@ -1,12 +1,27 @@
+import json
 import logging
+import random
+import time
 
 from calendar import monthrange
 from datetime import datetime, timedelta
+from collections import defaultdict
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count
 from django.utils import timezone
 
 from grizzly.celery import app
-from envelope.models import (EnvelopeDeposit,
+from envelope.filters import EnvelopeClaimFilter
+from envelope.ledger import EligibleMembers, EnvelopeDeck, Leaderboard
+from envelope.simulator import PoolSimulation, get_synthetic_deposits
+from envelope.snapshot import get_version
+from envelope.writebehind import WriteBehindQueue
+from envelope.models import (EnvelopeClaim,
+                             EnvelopeDeposit,
+                             EnvelopeDepositRollup,
                              EventType,
                              RequestLog,
                              )
@@ -21,24 +36,36 @@ def envelope_deposit_import(import_data, user_id, event_type, request_log_id):
     event_type = EventType.objects.get(id=event_type)
     request_log = RequestLog.objects.get(id=request_log_id)
     deposits = []
+    rollup_amounts = defaultdict(float)
     logger.info(user)
 
-    for data in reversed(import_data):
-        logger.info(data)
-        deposits.append(
-            EnvelopeDeposit(
+    try:
+        # A malformed amount fails the request instead of the task
+        for data in reversed(import_data):
+            logger.info(data)
+            deposit = EnvelopeDeposit(
                 username=data.get('username'),
                 amount=data.get('amount', 0),
                 event_type=event_type,
                 created_by=user,
                 request=request_log,
             )
-        )
+            deposits.append(deposit)
 
-    try:
-        envelope_deposits = EnvelopeDeposit.objects.bulk_create(deposits)
+            if deposit.username:
+                rollup_amounts[deposit.username] += \
+                    float(deposit.amount or 0)
+
+        with transaction.atomic():
+            envelope_deposits = EnvelopeDeposit.objects.bulk_create(deposits)
+            EnvelopeDepositRollup.objects.add_amounts(
+                event_type.id,
+                EnvelopeDepositRollup.objects.get_business_date(),
+                rollup_amounts)
         logger.info(f'{len(envelope_deposits)} envelope deposits created')
 
+        load_eligible_members(event_type.id)
+
         request_log.status = 1
         request_log.save(update_fields=['status', 'updated_at'])
     except Exception as exc:
@@ -56,3 +83,368 @@ def cancel_request(request_log_id):
         request_log.status = 2
         request_log.memo = f'Request canceled'
         request_log.save(update_fields=['status', 'memo', 'updated_at'])
+
+
+@app.task(name='envelope_reconcile_pool_ledger')
+def reconcile_pool_ledger():
+    # Unflushed claims are counted as pending in the ledger, so the queue
+    # does not have to be drained first
+    event_types = EventType.objects.filter(is_active=True, is_reward=False)
+
+    for event_type in event_types:
+        if event_type.is_presplit and EnvelopeDeck(event_type).is_loaded():
+            # The deck holds the pool exactly, and its popped envelopes are
+            # not pending while they wait to be flushed
+            continue
+
+        reconciled = EnvelopeClaim.objects.reconcile_pool_amount(event_type)
+        if not reconciled:
+            logger.info(f'Pool ledger for {event_type.code} not reconciled')
+
+
+@app.task(name='envelope_reconcile_reward_stock')
+def reconcile_reward_stock():
+    updated = EnvelopeClaim.objects.reconcile_reward_stock()
+    if updated:
+        logger.info(f'Stock of {updated} rewards reconciled')
+
+
+@app.task(name='envelope_rebuild_deposit_rollup')
+def rebuild_deposit_rollup(event_type_id, business_date=None):
+    if business_date:
+        business_date = datetime.strptime(business_date, '%Y-%m-%d').date()
+    else:
+        business_date = EnvelopeDepositRollup.objects.get_business_date()
+
+    total = EnvelopeDepositRollup.objects.rebuild(event_type_id,
+                                                  business_date)
+    logger.info(f'{total} envelope deposit rollups rebuilt')
+
+
+@app.task(name='envelope_load_eligible_members')
+def load_eligible_members(event_type_id, business_date=None):
+    '''
+    Load the day's set of members with a deposit, unless deposits already
+    keep it up to date.
+    '''
+
+    if business_date:
+        business_date = datetime.strptime(business_date, '%Y-%m-%d').date()
+    else:
+        business_date = EnvelopeDepositRollup.objects.get_business_date()
+
+    if EligibleMembers(event_type_id, business_date).is_loaded():
+        return
+
+    total = EnvelopeDepositRollup.objects.load_eligible_members(
+        event_type_id, business_date)
+    if total is None:
+        logger.error(f'Eligible members of event {event_type_id} not loaded')
+        return
+
+    logger.info(f'{total} eligible members of event {event_type_id} loaded')
+
+
+@app.task(name='envelope_load_deck')
+def load_deck(event_type_id):
+    event_type = EventType.objects.get(id=event_type_id)
+
+    amounts = EnvelopeClaim.objects.load_deck(event_type)
+    if amounts is None:
+        logger.error(f'Envelope deck for {event_type.code} not loaded')
+        return
+
+    logger.info(f'Envelope deck for {event_type.code} loaded: '
+                f'{len(amounts)} envelopes, {sum(amounts):.2f} total')
+
+
+@app.task(name='envelope_schedule_decks')
+def schedule_decks():
+    '''
+    Load today's deck of pre-split events opening within DECK_LEAD_TIME
+    (or already open) that have none yet.
+    '''
+
+    DECK_LEAD_TIME = timedelta(minutes=15)
+    now = timezone.localtime(timezone.now())
+    event_types = EventType.objects.filter(is_active=True,
+                                           is_reward=False,
+                                           is_presplit=True)
+
+    for event_type in event_types:
+        if EnvelopeDeck(event_type).is_loaded():
+            continue
+
+        snapshot = EventType.objects.get_snapshot(event_type.code)
+        if snapshot.is_open(now) or snapshot.is_open(now + DECK_LEAD_TIME):
+            load_deck(event_type.id)
+
+
+@app.task(name='envelope_bulk_update_claims')
+def bulk_update_claims(request_log_id, user_id, filters, status, memo=None):
+    '''
+    Set the status of every pending claim matching EnvelopeClaimFilter
+    `filters`, in chunks of set-based UPDATEs. Progress is kept on the
+    request log.
+    '''
+
+    CHUNK_SIZE = 1000
+    STATUS_PENDING = 0
+    STATUS_REJECTED = 2
+    request_log = RequestLog.objects.get(id=request_log_id)
+
+    claim_filter = EnvelopeClaimFilter(
+        data=filters,
+        queryset=EnvelopeClaim.objects.filter(status=STATUS_PENDING))
+
+    try:
+        # Invalid filters are dropped by the filterset, never update all
+        if not claim_filter.is_valid():
+            raise ValueError(f'Invalid filters: {claim_filter.errors}')
+
+        queryset = claim_filter.qs
+        request_log.total = queryset.count()
+        request_log.save(update_fields=['total', 'updated_at'])
+
+        while True:
+            # Updated claims are no longer pending, so each chunk is new
+            claim_ids = list(queryset.order_by('id').
+                             values_list('id', flat=True)[:CHUNK_SIZE])
+            if not claim_ids:
+                break
+
+            if status == STATUS_REJECTED:
+                # Rejected rewards go back in stock
+                reward_counts = dict(EnvelopeClaim.objects.filter(
+                    id__in=claim_ids, status=STATUS_PENDING,
+                    reward__stock__isnull=False
+                ).values_list('reward').annotate(total=Count('id')))
+
+            updated = EnvelopeClaim.objects.filter(
+                id__in=claim_ids, status=STATUS_PENDING
+            ).update(status=status,
+                     memo=memo,
+                     updated_by_id=user_id,
+                     updated_at=timezone.now())
+
+            if status == STATUS_REJECTED:
+                EnvelopeClaim.objects.release_reward_stock(reward_counts)
+
+            request_log.processed += updated
+            request_log.save(update_fields=['processed', 'updated_at'])
+
+        logger.info(f'Queried pending EnvelopeClaim count: '
+                    f'{request_log.total}')
+        logger.info(f'Updated query count: {request_log.processed}')
+
+        request_log.status = 1
+        request_log.save(update_fields=['status', 'updated_at'])
+
+        if status == STATUS_REJECTED and request_log.event_type:
+            # Rejected claims no longer count as winnings
+            EnvelopeClaim.objects.rebuild_leaderboard(request_log.event_type)
+    except Exception as exc:
+        logger.error(exc)
+        request_log.status = 2
+        request_log.memo = f'Error: {exc}'
+        request_log.save(update_fields=['status', 'memo', 'updated_at'])
+
+
+@app.task(name='envelope_simulate_event')
+def simulate_event(request_log_id, options):
+    '''
+    Run the pool simulation of EventTypeAdminViewset.simulate and keep its
+    report as JSON in the request log's memo.
+    '''
+
+    request_log = RequestLog.objects.select_related('event_type').get(
+        id=request_log_id)
+    event_type = request_log.event_type
+
+    try:
+        snapshot = EventType.objects.get_snapshot(event_type.code)
+
+        if options.get('members'):
+            deposits = get_synthetic_deposits(
+                options['members'], options['deposit_median'],
+                options['deposit_sigma'], random.Random(options['seed']))
+        else:
+            business_date = datetime.strptime(
+                options['date'], '%Y-%m-%d').date() if options['date'] \
+                else EnvelopeDepositRollup.objects.get_business_date()
+            deposits = list(EnvelopeDepositRollup.objects.filter(
+                event_type=event_type,
+                business_date=business_date
+            ).values_list('amount', flat=True))
+
+        simulation = PoolSimulation(snapshot, deposits,
+                                    participation=options['participation'],
+                                    pool_amount=options['pool_amount'],
+                                    seed=options['seed'])
+        report = simulation.run(runs=options['runs'])
+
+        request_log.processed = options['runs']
+        request_log.status = 1
+        request_log.memo = json.dumps(report, cls=DjangoJSONEncoder)
+        request_log.save(update_fields=['processed', 'status', 'memo',
+                                        'updated_at'])
+    except Exception as exc:
+        logger.error(exc)
+        request_log.status = 2
+        request_log.memo = f'Error: {exc}'
+        request_log.save(update_fields=['status', 'memo', 'updated_at'])
+
+
+@app.task(name='envelope_rebuild_leaderboard')
+def rebuild_leaderboard(event_type_id, business_date=None):
+    event_type = EventType.objects.get(id=event_type_id)
+    if business_date:
+        business_date = datetime.strptime(business_date, '%Y-%m-%d').date()
+
+    if EnvelopeClaim.objects.rebuild_leaderboard(event_type, business_date):
+        logger.info(f'Leaderboard for {event_type.code} rebuilt')
+    else:
+        logger.error(f'Leaderboard for {event_type.code} not rebuilt')
+
+
+@app.task(name='envelope_flush_claims')
+def flush_claims():
+    '''
+    Write the write-behind claims queue to the database in batches, after
+    replaying any batch a crashed flush left behind.
+    '''
+
+    BATCH_SIZE = 500
+    FLUSH_TIMEOUT = 60
+    queue = WriteBehindQueue()
+
+    if not queue.is_available or \
+            not queue.acquire_flush_lock(FLUSH_TIMEOUT):
+        return
+
+    started_at = time.monotonic()
+    total = 0
+    try:
+        queue.recover()
+
+        # Leave room before the lock expires
+        while time.monotonic() - started_at < FLUSH_TIMEOUT / 2:
+            claims = queue.take_batch(BATCH_SIZE)
+            if not claims:
+                break
+
+            try:
+                with transaction.atomic():
+                    written = EnvelopeClaim.objects.write_claims(claims)
+                dead = []
+            except Exception as exc:
+                logger.error(f'Envelope claims batch not written: {exc}')
+                written, dead = write_claims_one_by_one(claims)
+
+            total += written
+            queue.ack_batch(claims, dead=dead)
+    except Exception as exc:
+        logger.error(exc)
+    finally:
+        queue.release_flush_lock()
+
+    if total:
+        logger.info(f'{total} envelope claims flushed')
+
+
+def write_claims_one_by_one(claims):
+    '''
+    Write a batch that failed claim by claim, so one bad claim does not hold
+    back the others. Returns the number written and the claims that failed.
+    '''
+
+    written = 0
+    dead = []
+    for claim in claims:
+        try:
+            with transaction.atomic():
+                written += EnvelopeClaim.objects.write_claims([claim])
+        except Exception as exc:
+            logger.error(f'Envelope claim {claim.get("uuid")} not written: '
+                         f'{exc}')
+            dead.append(claim)
+
+    return written, dead
+
+
+def get_warm_up_cache_key(event_type_id, business_date):
+    return f'envelope_warm_up_{event_type_id}_{business_date:%Y%m%d}'
+
+
+@app.task(name='envelope_warm_up_event')
+def warm_up_event(event_type_id):
+    '''
+    Fill the caches the claim path reads for today: compile the snapshot,
+    seed the pool ledger and the deck, cache every depositor's rollup and
+    load the eligible members and the leaderboard. Returns the seconds
+    each step took.
+    '''
+
+    event_type = EventType.objects.get(id=event_type_id)
+    business_date = EnvelopeDepositRollup.objects.get_business_date()
+    version = get_version()
+    timings = {}
+
+    def timed(step, warm):
+        started_at = time.monotonic()
+        result = warm()
+        timings[step] = round(time.monotonic() - started_at, 3)
+        return result
+
+    timed('snapshot', lambda: EventType.objects.get_snapshot(event_type.code))
+
+    if not event_type.is_reward:
+        timed('pool_ledger',
+              lambda: EnvelopeClaim.objects.remaining_pool_amount(event_type))
+
+        if event_type.is_presplit and not EnvelopeDeck(event_type).is_loaded():
+            timed('deck', lambda: EnvelopeClaim.objects.load_deck(event_type))
+
+    depositors = timed(
+        'deposit_rollups',
+        lambda: EnvelopeDepositRollup.objects.warm_cache(event_type.id,
+                                                         business_date))
+    timed('eligible_members',
+          lambda: EnvelopeDepositRollup.objects.load_eligible_members(
+              event_type.id, business_date))
+
+    if not Leaderboard(event_type).is_loaded():
+        timed('leaderboard',
+              lambda: EnvelopeClaim.objects.rebuild_leaderboard(event_type))
+
+    cache.set(get_warm_up_cache_key(event_type.id, business_date), version,
+              60 * 60 * 48)
+
+    logger.info(f'Envelope event {event_type.code} warmed up for '
+                f'{depositors} depositors in {sum(timings.values()):.3f}s: '
+                f'{timings}')
+
+    return timings
+
+
+@app.task(name='envelope_warm_up_events')
+def warm_up_events():
+    '''
+    Warm up the events opening within WARM_UP_LEAD_TIME (or already open)
+    that were not warmed up today with their current configuration.
+    '''
+
+    WARM_UP_LEAD_TIME = timedelta(minutes=5)
+    now = timezone.localtime(timezone.now())
+    business_date = EnvelopeDepositRollup.objects.get_business_date()
+    version = get_version()
+
+    for event_type in EventType.objects.filter(is_active=True):
+        warmed_version = cache.get(get_warm_up_cache_key(event_type.id,
+                                                         business_date))
+        if warmed_version == version:
+            continue
+
+        snapshot = EventType.objects.get_snapshot(event_type.code)
+        if snapshot.is_open(now) or snapshot.is_open(now + WARM_UP_LEAD_TIME):
+            warm_up_event(event_type.id)
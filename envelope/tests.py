@@ -1,3 +1,562 @@
-from django.test import TestCase
+import json
+import random
+import uuid
 
-# Create your tests here.
+from collections import Counter
+from datetime import date, time
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from redis.exceptions import RedisError
+from unittest import mock
+
+from envelope.ledger import (ClaimCounter,
+                             EnvelopeDeck,
+                             PoolLedger,
+                             get_redis)
+from envelope.models import (EnvelopeClaim,
+                             EnvelopeDepositRollup,
+                             EnvelopeLevel,
+                             EventType,
+                             Reward)
+from envelope.samplers import (AliasSampler,
+                               TieredAmountSampler,
+                               DEFAULT_TIER_WEIGHTS)
+from envelope.simulator import PoolSimulation, get_synthetic_deposits
+from envelope.snapshot import EventSnapshot
+from envelope.tasks import flush_claims
+from envelope.writebehind import WriteBehindQueue
+
+
+# Far from any live event's keys
+LEDGER_TEST_DATE = date(2000, 1, 1)
+LEDGER_TEST_EVENT_ID = 10 ** 9
+
+# Chi-square critical values at p = 0.001, by degrees of freedom
+CHI_SQUARE_CRITICAL = {1: 10.828, 2: 13.816, 3: 16.266, 4: 18.467}
+DRAWS = 200000
+
+
+def chi_square(observed, weights, draws):
+    total = sum(weights)
+    return sum((observed.get(i, 0) - draws * weight / total) ** 2 /
+               (draws * weight / total)
+               for i, weight in enumerate(weights) if weight)
+
+
+def legacy_claim_amount(min_claim, max_claim, rng):
+    '''
+    Claim amount sampler as it was before precompiled samplers, kept as the
+    reference distribution. Returns (tier, amount).
+    '''
+
+    amount_sizes = [0, 1, 2]
+    amount_size_choice = rng.choices(amount_sizes,
+                                     weights=DEFAULT_TIER_WEIGHTS)[0]
+
+    amounts = [n for n in range(int(min_claim), int(max_claim) + 1)]
+
+    amount_count = len(amounts)
+    chunks = int(amount_count / len(amount_sizes))
+
+    chunk_amounts = [
+        amounts[x:x + chunks] for x in range(0, amount_count, chunks)]
+    claim_amounts = chunk_amounts[amount_size_choice]
+
+    return amount_size_choice, round(rng.uniform(
+        claim_amounts[0], claim_amounts[-1]), 2)
+
+
+class AliasSamplerTest(SimpleTestCase):
+
+    def test_frequencies_follow_weights(self):
+        rng = random.Random(1)
+        weights = [50, 30, 15, 5]
+        sampler = AliasSampler(range(len(weights)), weights)
+
+        observed = Counter(sampler.sample(rng) for _ in range(DRAWS))
+
+        self.assertLess(chi_square(observed, weights, DRAWS),
+                        CHI_SQUARE_CRITICAL[len(weights) - 1])
+
+    def test_zero_weight_is_never_drawn(self):
+        rng = random.Random(3)
+        sampler = AliasSampler(['a', 'b', 'c'], [1, 0, 3])
+
+        observed = Counter(sampler.sample(rng) for _ in range(DRAWS))
+
+        self.assertNotIn('b', observed)
+        self.assertLess(chi_square({0: observed['a'], 2: observed['c']},
+                                   [1, 0, 3], DRAWS),
+                        CHI_SQUARE_CRITICAL[1])
+
+    def test_nothing_to_draw(self):
+        self.assertIsNone(AliasSampler([], []).sample())
+        self.assertIsNone(AliasSampler(['a', 'b'], [0, 0]).sample())
+
+
+class TieredAmountSamplerTest(SimpleTestCase):
+    RANGES = ((1, 100), (5, 17), (10, 10000), (3, 5), (2.5, 9.9))
+
+    def test_tier_bounds_match_legacy_chunks(self):
+        for min_claim, max_claim in self.RANGES:
+            sampler = TieredAmountSampler(min_claim, max_claim,
+                                          DEFAULT_TIER_WEIGHTS)
+            amounts = list(range(int(min_claim), int(max_claim) + 1))
+            chunks = int(len(amounts) / 3)
+
+            for tier in range(3):
+                chunk = amounts[tier * chunks:(tier + 1) * chunks]
+                self.assertEqual(sampler.get_tier_bounds(tier),
+                                 (chunk[0], chunk[-1]))
+
+    def test_tier_hit_rates_match_legacy(self):
+        rng = random.Random(3)
+        sampler = TieredAmountSampler(1, 100, DEFAULT_TIER_WEIGHTS)
+        bounds = [sampler.get_tier_bounds(tier) for tier in range(3)]
+
+        def get_tier(amount):
+            return next(tier for tier, (first, last) in enumerate(bounds)
+                        if first <= amount <= last)
+
+        observed = Counter(get_tier(sampler.sample(rng))
+                           for _ in range(DRAWS))
+        legacy = Counter(legacy_claim_amount(1, 100, rng)[0]
+                         for _ in range(DRAWS))
+
+        self.assertLess(chi_square(observed, DEFAULT_TIER_WEIGHTS, DRAWS),
+                        CHI_SQUARE_CRITICAL[2])
+        self.assertLess(chi_square(legacy, DEFAULT_TIER_WEIGHTS, DRAWS),
+                        CHI_SQUARE_CRITICAL[2])
+
+    def test_amounts_are_uniform_within_tier(self):
+        rng = random.Random(4)
+        sampler = TieredAmountSampler(1, 100, (1, 0, 0))
+        first, last = sampler.get_tier_bounds(0)
+
+        amounts = [sampler.sample(rng) for _ in range(DRAWS)]
+        deciles = Counter(int((amount - first) / (last - first) * 10) % 10
+                          for amount in amounts)
+
+        self.assertTrue(all(first <= amount <= last for amount in amounts))
+        self.assertLess(chi_square(deciles, [1] * 10, DRAWS), 27.877)
+
+    def test_mean_matches_legacy(self):
+        rng = random.Random(5)
+        sampler = TieredAmountSampler(10, 10000, DEFAULT_TIER_WEIGHTS)
+
+        mean = sum(sampler.sample(rng) for _ in range(DRAWS)) / DRAWS
+        # The legacy sampler builds the whole range per draw, keep it short
+        legacy_draws = 20000
+        legacy_mean = sum(legacy_claim_amount(10, 10000, rng)[1]
+                          for _ in range(legacy_draws)) / legacy_draws
+
+        # Both means estimate the same value, allow a few standard errors
+        self.assertAlmostEqual(mean / legacy_mean, 1, delta=0.04)
+
+    def test_configured_weights(self):
+        rng = random.Random(6)
+        weights = (0.5, 0.3, 0.2)
+        sampler = TieredAmountSampler(0, 299, weights)
+
+        observed = Counter(int(sampler.sample(rng) // 100)
+                           for _ in range(DRAWS))
+
+        self.assertLess(chi_square(observed, weights, DRAWS),
+                        CHI_SQUARE_CRITICAL[2])
+
+    def test_amounts_within_range_and_rounded(self):
+        rng = random.Random(7)
+
+        for min_claim, max_claim in self.RANGES + ((1, 2), (7, 7)):
+            sampler = TieredAmountSampler(min_claim, max_claim,
+                                          DEFAULT_TIER_WEIGHTS)
+            for _ in range(1000):
+                amount = sampler.sample(rng)
+                self.assertTrue(int(min_claim) <= amount <= int(max_claim))
+                self.assertEqual(amount, round(amount, 2))
+
+
+class PoolSimulationTest(SimpleTestCase):
+
+    def get_snapshot(self, pool_amount):
+        event_type = EventType(id=1, code='envelope', is_daily=True,
+                               time_from=time(10), time_to=time(22))
+        levels = [{'name': 'Level 1', 'amount': 100, 'quantity': 2},
+                  {'name': 'Level 2', 'amount': 1000, 'quantity': 10}]
+        amount_settings = [{'threshold_amount': 0,
+                            'min_amount': 1, 'max_amount': 30}]
+
+        return EventSnapshot(event_type, levels, amount_settings, [],
+                             {'envelope_pool_amount': str(pool_amount)})
+
+    def test_pool_is_never_overdrawn(self):
+        deposits = get_synthetic_deposits(2000, 200, 1, random.Random(1))
+        report = PoolSimulation(self.get_snapshot(5000), deposits,
+                                seed=1).run(runs=5)
+
+        self.assertEqual(report['runs'], 5)
+        self.assertEqual(report['depleted_runs'], 1)
+        self.assertEqual(report['total_payout']['p99'], 5000)
+        self.assertLess(report['depletion_seconds']['p90'], 12 * 60 * 60)
+
+    def test_tier_hit_rates_follow_weights(self):
+        deposits = [1000] * 2000
+        report = PoolSimulation(self.get_snapshot(10 ** 9), deposits,
+                                seed=2).run(runs=2)
+
+        self.assertEqual(report['depleted_runs'], 0)
+        for rate, weight in zip(report['tier_hit_rates']['1-30'],
+                                DEFAULT_TIER_WEIGHTS):
+            self.assertAlmostEqual(rate, weight, delta=0.01)
+
+
+class EnvelopeClaimMemberListTest(TestCase):
+    URL = '/v1/member/envelopeclaim/'
+
+    def setUp(self):
+        self.event_type = EventType.objects.create(name='Wheel',
+                                                   code='wheel',
+                                                   is_reward=True)
+        self.reward = Reward.objects.create(name='Prize',
+                                            event_type=self.event_type,
+                                            chance=1)
+        EnvelopeLevel.objects.create(name='Level 1', amount=100, quantity=200,
+                                     event_type=self.event_type)
+        EnvelopeDepositRollup.objects.add_amounts(
+            self.event_type.id,
+            EnvelopeDepositRollup.objects.get_business_date(),
+            {'member01': 100})
+
+    def create_claims(self, total):
+        EnvelopeClaim.objects.bulk_create([
+            EnvelopeClaim(username='member01',
+                          event_type=self.event_type,
+                          reward=self.reward)
+            for _ in range(total)
+        ])
+
+    def get_list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.URL, {'username': 'member01',
+                                                  'opt_expand': 'reward'})
+
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['data']
+
+    def test_claim_left_is_shared_per_user_and_event(self):
+        self.create_claims(3)
+
+        _, claims = self.get_list_queries()
+
+        self.assertEqual(len(claims), 3)
+        self.assertEqual({claim['claim_left'] for claim in claims}, {197})
+        self.assertEqual(claims[0]['reward'],
+                         {'id': self.reward.id, 'name': 'Prize'})
+
+    def test_list_queries_do_not_grow_with_claims(self):
+        self.create_claims(5)
+        self.get_list_queries()  # warm up the event snapshot and caches
+        few_queries, _ = self.get_list_queries()
+
+        self.create_claims(95)
+        many_queries, claims = self.get_list_queries()
+
+        self.assertEqual(len(claims), 100)
+        self.assertEqual(few_queries, many_queries)
+
+
+class RedisTestMixin(object):
+    '''
+    Run the ledger scripts against the cache's redis, skipping the tests
+    when the cache is not redis-backed or redis is down.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.redis = get_redis()
+
+        try:
+            available = self.redis is not None and self.redis.ping()
+        except RedisError:
+            available = False
+        if not available:
+            self.skipTest('Redis unavailable')
+
+    def delete_keys(self, *keys):
+        self.addCleanup(self.redis.delete, *keys)
+
+
+class PoolLedgerTest(RedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ledger = PoolLedger(EventType(id=LEDGER_TEST_EVENT_ID),
+                                 LEDGER_TEST_DATE)
+        self.redis.delete(self.ledger.key, self.ledger.pending_key)
+        self.delete_keys(self.ledger.key, self.ledger.pending_key)
+
+    def test_reserve_cold_ledger(self):
+        self.assertIsNone(self.ledger.reserve(1))
+
+    def test_reserve_never_overdraws(self):
+        self.ledger.seed(10)
+
+        self.assertEqual(self.ledger.reserve(6), 6)
+        self.assertEqual(self.ledger.reserve(6), 4)
+        self.assertEqual(self.ledger.reserve(0.01), 0)
+        self.assertEqual(self.ledger.remaining(), 0)
+        self.assertEqual(self.ledger.get_pending(), 1000)
+
+    def test_release_and_settle(self):
+        self.ledger.seed(10)
+        self.ledger.reserve(4)
+
+        self.ledger.release(1)
+        self.assertEqual(self.ledger.remaining(), 7)
+        self.assertEqual(self.ledger.get_pending(), 300)
+
+        self.ledger.settle(3)
+        self.assertEqual(self.ledger.remaining(), 7)
+        self.assertEqual(self.ledger.get_pending(), 0)
+
+    def test_reconcile_with_pending(self):
+        self.ledger.seed(10)
+        self.ledger.reserve(4)
+
+        # The database does not see the 4 reserved but not written yet
+        self.assertTrue(self.ledger.reconcile(lambda: 10))
+        self.assertEqual(self.ledger.remaining(), 6)
+
+        self.redis.set(self.ledger.key, 900)
+        self.assertTrue(self.ledger.reconcile(lambda: 10))
+        self.assertEqual(self.ledger.remaining(), 6)
+
+        # Written and settled
+        self.ledger.settle(4)
+        self.assertTrue(self.ledger.reconcile(lambda: 6))
+        self.assertEqual(self.ledger.remaining(), 6)
+
+    def test_reconcile_cold_ledger_with_pending(self):
+        self.ledger.seed(10)
+        self.ledger.reserve(4)
+        self.redis.delete(self.ledger.key)
+
+        self.assertTrue(self.ledger.reconcile(lambda: 10))
+        self.assertEqual(self.ledger.remaining(), 6)
+
+
+class EnvelopeDeckTest(RedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.deck = EnvelopeDeck(EventType(id=LEDGER_TEST_EVENT_ID),
+                                 LEDGER_TEST_DATE)
+        keys = [self.deck.key, self.deck.loaded_key, self.deck.pool.key,
+                self.deck.pool.pending_key]
+        self.redis.delete(*keys)
+        self.delete_keys(*keys)
+
+    def test_release_leaves_pending_alone(self):
+        self.deck.load([1, 2.5, 3])
+
+        amounts = self.deck.pop(2)
+        self.assertEqual(amounts, [1, 2.5])
+        self.assertEqual(self.deck.pool.remaining(), 3)
+
+        self.deck.release(amounts)
+        self.assertEqual(self.deck.size(), 3)
+        self.assertEqual(self.deck.pool.remaining(), 6.5)
+        self.assertIsNone(self.redis.get(self.deck.pool.pending_key))
+        self.assertEqual(self.deck.pool.get_pending(), 0)
+
+
+class ClaimCounterTest(RedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.counter = ClaimCounter('member01',
+                                    EventType(id=LEDGER_TEST_EVENT_ID),
+                                    now=timezone.localtime(timezone.now()))
+        self.redis.delete(self.counter.key)
+        self.delete_keys(self.counter.key)
+
+    def test_take_cold_counter(self):
+        self.assertIsNone(self.counter.take(3))
+
+    def test_take_up_to_allowed(self):
+        self.counter.seed(0)
+
+        self.assertEqual(self.counter.take(3), 3)
+        # Only the 2 left are taken
+        self.assertEqual(self.counter.take(3, count=5), 2)
+        self.assertEqual(self.counter.take(3), 0)
+        self.assertEqual(self.counter.count(), 3)
+
+        self.counter.release(2)
+        self.assertEqual(self.counter.take(3), 2)
+
+
+class ClaimLeftTest(TestCase):
+    def setUp(self):
+        self.event_type = EventType.objects.create(name='Eggs',
+                                                   code='eggs',
+                                                   is_reward=True)
+        self.reward = Reward.objects.create(name='Prize',
+                                            event_type=self.event_type,
+                                            chance=1)
+        EnvelopeLevel.objects.create(name='Level 1', amount=100, quantity=5,
+                                     event_type=self.event_type)
+        EnvelopeDepositRollup.objects.add_amounts(
+            self.event_type.id,
+            EnvelopeDepositRollup.objects.get_business_date(),
+            {'member01': 100})
+
+        counter = ClaimCounter('member01', self.event_type)
+        if counter.is_available:
+            self.addCleanup(counter.client.delete, counter.key)
+
+    def create_claims(self, total):
+        EnvelopeClaim.objects.bulk_create([
+            EnvelopeClaim(username='member01',
+                          event_type=self.event_type,
+                          reward=self.reward)
+            for _ in range(total)
+        ])
+
+    def get_claim_left(self):
+        return EnvelopeClaim.objects.get_quantity_left('member01',
+                                                       self.event_type)
+
+    def test_claim_left_after_claims(self):
+        self.create_claims(2)
+
+        self.assertEqual(self.get_claim_left(), 3)
+        self.assertEqual(EnvelopeClaim.objects.take_claim(
+            'member01', self.event_type, 2), 3)
+        self.create_claims(2)
+        self.assertEqual(self.get_claim_left(), 1)
+
+    def test_counter_matches_database_fallback(self):
+        self.create_claims(2)
+        EnvelopeClaim.objects.take_claim('member01', self.event_type, 1)
+        self.create_claims(1)
+        claim_left = self.get_claim_left()
+
+        with mock.patch('envelope.ledger.get_redis', return_value=None):
+            self.assertEqual(self.get_claim_left(), claim_left)
+            self.assertEqual(EnvelopeClaim.objects.take_claim(
+                'member01', self.event_type, 5), 2)
+
+        self.assertEqual(claim_left, 2)
+
+
+@override_settings(ENVELOPE_WRITE_BEHIND=False)
+class EnvelopeClaimBatchTest(TestCase):
+    URL = '/v1/member/envelopeclaim/batch/'
+
+    def setUp(self):
+        self.event_type = EventType.objects.create(name='Wheel',
+                                                   code='batch_wheel',
+                                                   is_reward=True)
+        Reward.objects.create(name='Prize', event_type=self.event_type,
+                              chance=1)
+        EnvelopeLevel.objects.create(name='Level 1', amount=100, quantity=3,
+                                     event_type=self.event_type)
+        EnvelopeDepositRollup.objects.add_amounts(
+            self.event_type.id,
+            EnvelopeDepositRollup.objects.get_business_date(),
+            {'member01': 100})
+
+        counter = ClaimCounter('member01', self.event_type)
+        if counter.is_available:
+            self.addCleanup(counter.client.delete, counter.key)
+
+    def claim(self, quantity):
+        return self.client.post(self.URL,
+                                {'username': 'member01',
+                                 'event_type': 'batch_wheel',
+                                 'quantity': quantity},
+                                content_type='application/json')
+
+    def test_batch_over_limit_is_partly_granted(self):
+        response = self.claim(5)
+
+        self.assertEqual(response.status_code, 200)
+        claims = response.json()['data']
+        self.assertEqual(len(claims), 3)
+        self.assertEqual(EnvelopeClaim.objects.filter(
+            username='member01', event_type=self.event_type).count(), 3)
+        self.assertEqual(EnvelopeClaim.objects.get_quantity_left(
+            'member01', self.event_type), 0)
+
+        self.assertEqual(self.claim(1).status_code, 400)
+        self.assertEqual(EnvelopeClaim.objects.count(), 3)
+
+    def test_batch_quantity_bounds(self):
+        self.assertEqual(self.claim(0).status_code, 400)
+        self.assertEqual(self.claim(51).status_code, 400)
+        self.assertFalse(EnvelopeClaim.objects.exists())
+
+
+class WriteBehindQueueTest(RedisTestMixin, TestCase):
+    KEYS = {
+        'PENDING_KEY': 'test:envelope:claims:pending',
+        'PROCESSING_KEY': 'test:envelope:claims:processing',
+        'FLUSH_LOCK_KEY': 'test:envelope:claims:flush_lock',
+        'DEAD_LETTER_KEY': 'test:envelope:claims:dead',
+    }
+
+    def setUp(self):
+        super().setUp()
+        # Away from the queue of a running flusher
+        patcher = mock.patch.multiple('envelope.writebehind', **self.KEYS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.event_type = EventType.objects.create(name='Envelope',
+                                                   code='write_behind')
+        self.queue = WriteBehindQueue()
+        keys = list(self.KEYS.values()) + \
+            ['envelope:claims:unflushed:member01']
+        self.redis.delete(*keys)
+        self.delete_keys(*keys)
+
+    def create_claims(self, amounts):
+        claims = [{'uuid': str(uuid.uuid4()),
+                   'username': 'member01',
+                   'amount': amount,
+                   'status': 0,
+                   'event_type': self.event_type.id,
+                   'reward': None,
+                   'created_at': timezone.now().isoformat(),
+                   'pool_reserved': False}
+                  for amount in amounts]
+        self.queue.push(claims)
+
+        return claims
+
+    def test_take_ack_and_recover(self):
+        claims = self.create_claims([1, 2, 3])
+
+        self.assertEqual(self.queue.take_batch(2), claims[:2])
+        # A flush that crashed before its ack is replayed in order
+        self.assertEqual(self.queue.recover(), 2)
+        self.assertEqual(self.queue.size(), 3)
+
+        batch = self.queue.take_batch(5)
+        self.assertEqual(batch, claims)
+        self.queue.ack_batch(batch)
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(self.queue.get_unflushed('member01'), [])
+
+    def test_poison_claim_does_not_block_the_queue(self):
+        claims = self.create_claims([1, 'not an amount', 3])
+
+        flush_claims()
+
+        self.assertEqual(self.queue.size(), 0)
+        self.assertEqual(
+            set(str(claim_uuid) for claim_uuid in EnvelopeClaim.objects
+                .values_list('uuid', flat=True)),
+            {claims[0]['uuid'], claims[2]['uuid']})
+        dead = self.redis.lrange(self.KEYS['DEAD_LETTER_KEY'], 0, -1)
+        self.assertEqual([json.loads(claim) for claim in dead], [claims[1]])
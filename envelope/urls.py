@@ -47,6 +47,8 @@ member_router.register(r'eventtypes',
 urlpatterns = [
     url(r'^manage/envelope/import/',
         envelope_view.import_file, name='envelope_deposit_import'),
+    url(r'^member/envelope/status/$',
+        envelope_view.event_status, name='envelope_status'),
     url(r'^manage/', include(manage_router.urls)),
     url(r'^member/', include(member_router.urls)),
 ]
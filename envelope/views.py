@@ -1,9 +1,12 @@
 import logging
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from django.db import transaction
 from django.db.models import Sum
 from rest_framework.response import Response
 from rest_framework.decorators import action
@@ -13,11 +16,14 @@ from rest_framework.decorators import (api_view,
                                        renderer_classes)
 from tablib import Dataset
 
+from grizzly.idempotency import idempotent
 from grizzly.lib import constants
-from grizzly.utils import (parse_request_for_token,
+from grizzly.utils import (get_username_list,
+                           parse_request_for_token,
                            GrizzlyRenderer)
 from loginsvc.permissions import IsAdmin, IsStaff
 from loginsvc.views import generate_response
+from envelope.claims import ClaimDraw
 from envelope.filters import (EnvelopeAmountSettingFilter,
                               EnvelopeClaimFilter,
                               EnvelopeDepositFilter,
@@ -27,11 +33,14 @@ from envelope.filters import (EnvelopeAmountSettingFilter,
                               RewardFilter)
 from envelope.models import (EnvelopeLevel,
                              EnvelopeDeposit,
+                             EnvelopeDepositRollup,
                              EnvelopeClaim,
                              EnvelopeAmountSetting,
                              EventType,
                              RequestLog,
+                             TYPE_ENVELOPE_CLAIM_UPDATE,
                              TYPE_ENVELOPE_DEPOSIT_IMPORT,
+                             TYPE_EVENT_SIMULATION,
                              Reward,
                              TYPE_WHEEL)
 from envelope.serializers import (EnvelopeClaimMemberSerializer,
@@ -49,8 +58,11 @@ from envelope.serializers import (EnvelopeClaimMemberSerializer,
 
 from configsetting.models import GlobalPreference
 
+from envelope.status import STATUS_TICK, get_event_status
 from envelope.tasks import (envelope_deposit_import,
-                            cancel_request,)
+                            bulk_update_claims,
+                            cancel_request,
+                            simulate_event,)
 
 
 logger = logging.getLogger(__name__)
@@ -73,63 +85,108 @@ class EnvelopeClaimMemberViewset(mixins.CreateModelMixin,
         if not username:  # username required
             return EnvelopeClaim.objects.none()
 
-        return EnvelopeClaim.objects.filter(**params).order_by('-created_at')
+        return EnvelopeClaim.objects.filter(**params).\
+            select_related('event_type', 'reward').order_by('-created_at')
 
+    # Most claims a member can use in one batch request
+    MAX_BATCH_CLAIMS = 50
+    LEADERBOARD_LIMIT = 10
+
+    @idempotent
     def create(self, request, *args, **kwargs):
-        username = request.data.get('username', '')
+        return self.claim(request)
+
+    @action(detail=False, methods=['post'])
+    @idempotent
+    def batch(self, request):
+        '''
+        Use several claims at once, e.g. on wheel and egg events.
+        '''
+
+        try:
+            quantity = int(request.data.get('quantity', 0))
+        except (TypeError, ValueError):
+            quantity = 0
+
+        if not 0 < quantity <= self.MAX_BATCH_CLAIMS:
+            return Response(constants.FIELD_ERROR, status=400)
+
+        return self.claim(request, quantity=quantity)
 
+    def claim(self, request, quantity=None):
         event_type = EnvelopeClaim.objects.get_event_type(
             request.data.get('event_type', 0))
         if not event_type:
             return Response(constants.INVALID_EVENT_TYPE, status=400)
 
-        # Get user claim left
-        user_claim_left = EnvelopeClaim.objects.get_quantity_left(
-            username, event_type)
-        if user_claim_left is None:
-            return Response(constants.CANNOT_CLAIM_YET, status=400)
-        elif user_claim_left == 0:
-            return Response(constants.NO_CLAIM_LEFT, status=400)
-
-        data = {
-            'username': username,
-            'amount': 0.0,
-            'status': 0,
-            'event_type': event_type.id
-        }
-
-        if event_type.is_reward:
-            reward = EnvelopeClaim.objects.get_reward(event_type)
-
-            data.update(reward=reward.id)
-        else:
-            remaining_amount = EnvelopeClaim.objects.remaining_pool_amount(
-                event_type)
-            if round(remaining_amount, 2) <= 0:
-                # No remaining pool
-                return Response(constants.NO_POOL_AMOUNT_LEFT, status=400)
-
-            amount_threshold = EnvelopeClaim.objects.get_threshold_range(
-                username, event_type)
-
-            if amount_threshold[0] == amount_threshold[1]:
-                return Response(constants.CANNOT_CLAIM_YET, status=400)
+        draw = ClaimDraw(request.data.get('username', ''), event_type)
+        data, error = draw.run(
+            quantity,
+            lambda claims, many: self.save_claims(request, draw, claims,
+                                                  many=many))
+        if error:
+            return Response(error, status=400)
+
+        return Response(data=data, status=200)
+
+    def save_claims(self, request, draw, claims, many=False):
+        if settings.ENVELOPE_WRITE_BEHIND:
+            data = draw.queue(claims, many=many)
+            if data is not None:
+                return data
+
+        if not many:
+            serializer = EnvelopeClaimMemberSerializer(
+                data=claims[0], context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+            draw.settle(claims)
+
+            return serializer.data
+
+        envelope_claims = EnvelopeClaim.objects.bulk_create([
+            EnvelopeClaim(username=claim['username'],
+                          amount=claim['amount'],
+                          status=claim['status'],
+                          event_type=draw.event_type,
+                          reward_id=claim.get('reward'))
+            for claim in claims
+        ])
+        draw.settle(claims)
+
+        return EnvelopeClaimMemberSerializer(
+            envelope_claims, many=True, context={'request': request}).data
+
+    @action(detail=False, methods=['get'])
+    def state(self, request):
+        '''
+        Event window, claim left, today's deposit, today's accepted claim
+        total, remaining pool and level ladder in one response.
+        '''
+
+        username = request.GET.get('username', '')
+        event_type = EnvelopeClaim.objects.get_event_type(
+            request.GET.get('event_type', 0))
+        if not event_type:
+            return Response(constants.INVALID_EVENT_TYPE, status=400)
 
-            claim_amount = EnvelopeClaim.objects.get_claim_amount(
-                event_type, amount_threshold)
+        return Response(EnvelopeClaim.objects.get_event_state(username,
+                                                              event_type))
 
-            if remaining_amount > claim_amount:
-                data.update(amount=claim_amount)
-            else:
-                if remaining_amount > 0:
-                    data.update(amount=round(remaining_amount, 2))
+    @action(detail=False, methods=['get'])
+    def leaderboard(self, request):
+        '''
+        Today's top winners of the event and the member's own rank.
+        '''
 
-        serializer = EnvelopeClaimMemberSerializer(
-            data=data, context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
+        event_type = EnvelopeClaim.objects.get_event_type(
+            request.GET.get('event_type', 0))
+        if not event_type:
+            return Response(constants.INVALID_EVENT_TYPE, status=400)
 
-        return Response(data=serializer.data, status=200)
+        return Response(EnvelopeClaim.objects.get_leaderboard(
+            event_type, limit=self.LEADERBOARD_LIMIT,
+            username=request.GET.get('username')))
 
     def list(self, request, *args, **kwargs):
         if request.query_params.get('total'):
@@ -175,6 +232,26 @@ class EnvelopeClaimAdminViewset(mixins.ListModelMixin,
     filter_class = EnvelopeClaimFilter
     renderer_classes = [GrizzlyRenderer]
 
+    MAX_STATUS_USERNAMES = 5000
+    STATUS_REJECTED = 2
+
+    def perform_update(self, serializer):
+        was_rejected = serializer.instance.status == self.STATUS_REJECTED
+        claim = serializer.save()
+        is_rejected = claim.status == self.STATUS_REJECTED
+
+        # Rejected claims no longer hold reward stock or count as winnings
+        if is_rejected and not was_rejected:
+            EnvelopeClaim.objects.release_claims([claim])
+        elif was_rejected and not is_rejected:
+            EnvelopeClaim.objects.restore_claims([claim])
+
+    def perform_destroy(self, instance):
+        instance.delete()
+
+        if instance.status != self.STATUS_REJECTED:
+            EnvelopeClaim.objects.release_claims([instance])
+
     @action(detail=False, methods=['put'])
     def approve_all(self, request):
         event_type = EnvelopeClaim.objects.get_event_type(
@@ -182,30 +259,101 @@ class EnvelopeClaimAdminViewset(mixins.ListModelMixin,
         if not event_type:
             return Response(constants.INVALID_EVENT_TYPE, status=400)
 
-        queryset = EnvelopeClaim.objects.filter(
-            status=0, event_type=event_type)
+        request_log = self.queue_bulk_update(
+            request, event_type, {'event_type': event_type.code},
+            status=1, memo='点击通过所有')
+        if request_log is None:
+            return Response(constants.FIELD_ERROR, status=400)
+
+        return Response(data=[{'request_log': request_log.id}], status=200)
+
+    @action(detail=False, methods=['put'])
+    def bulk_update(self, request):
+        '''
+        Approve or reject every pending claim matching the query filters.
+        '''
+
+        status = request.data.get('status')
+        if str(status) not in ('1', '2'):
+            return Response(constants.FIELD_ERROR, status=400)
 
-        total_before_update = queryset.count()
-        total_after_update = 0
+        event_type = EnvelopeClaim.objects.get_event_type(
+            request.GET.get('event_type', 0))
+        if not event_type:
+            return Response(constants.INVALID_EVENT_TYPE, status=400)
+
+        request_log = self.queue_bulk_update(
+            request, event_type, request.GET.dict(),
+            status=int(status), memo=request.data.get('memo'))
+        if request_log is None:
+            return Response(constants.FIELD_ERROR, status=400)
 
-        for envelope_claim in queryset:
-            try:
-                envelope_claim.status = 1
-                envelope_claim.memo = '点击通过所有'
-                envelope_claim.updated_by = request.user
-                envelope_claim.save()
-                total_after_update += 1
-            except Exception as e:
-                logger.error('An error occured in the middle of all approval')
-                logger.error(e)
+        return Response(data=[{'request_log': request_log.id}], status=200)
 
-        logger.info(f'Queried pending EnvelopeClaim count: \
-            {total_before_update}')
-        logger.info(f'Updated query count: {total_after_update}')
+    @action(detail=False, methods=['post'])
+    def member_status(self, request):
+        '''
+        Claim left of many members at once, for upstream systems.
+        '''
 
-        # Note: Possible scaling options (celery)
+        usernames = get_username_list(request.data,
+                                      self.MAX_STATUS_USERNAMES)
+        if usernames is None:
+            return Response(constants.FIELD_ERROR, status=400)
 
-        return Response(data=[{'total': total_after_update}], status=200)
+        event_type = EnvelopeClaim.objects.get_event_type(
+            request.data.get('event_type', 0))
+        if not event_type:
+            return Response(constants.INVALID_EVENT_TYPE, status=400)
+
+        quantities_left = EnvelopeClaim.objects.get_quantities_left(
+            usernames, event_type)
+
+        return Response([{'username': username,
+                          'claim_left': quantities_left[username]}
+                         for username in usernames])
+
+    @action(detail=False, methods=['get'])
+    def leaderboard(self, request):
+        event_type = EnvelopeClaim.objects.get_event_type(
+            request.GET.get('event_type', 0))
+        if not event_type:
+            return Response(constants.INVALID_EVENT_TYPE, status=400)
+
+        try:
+            limit = min(int(request.GET.get('limit', 100)), 1000)
+        except ValueError:
+            return Response(constants.FIELD_ERROR, status=400)
+
+        return Response(EnvelopeClaim.objects.get_leaderboard(
+            event_type, limit=limit, username=request.GET.get('username')))
+
+    def queue_bulk_update(self, request, event_type, filters, status,
+                          memo=None):
+        '''
+        Queue the bulk update, or return None when the filters are invalid,
+        which the filterset would otherwise ignore and update every claim.
+        '''
+
+        if not EnvelopeClaimFilter(
+                data=filters, queryset=EnvelopeClaim.objects.none()
+        ).is_valid():
+            return None
+
+        request_log = RequestLog.objects.create(
+            event_type=event_type,
+            request_type=TYPE_ENVELOPE_CLAIM_UPDATE,
+            created_by=request.user,
+        )
+
+        bulk_update_claims.apply_async((request_log.id,
+                                        request.user.id,
+                                        filters,
+                                        status,
+                                        memo),
+                                       queue='envelope_operations')
+
+        return request_log
 
 
 class EnvelopeDepositAdminViewset(mixins.ListModelMixin,
@@ -221,6 +369,24 @@ class EnvelopeDepositAdminViewset(mixins.ListModelMixin,
     filter_class = EnvelopeDepositFilter
     renderer_classes = [GrizzlyRenderer]
 
+    # Keep the daily deposit rollup in step with every deposit write
+
+    @transaction.atomic
+    def perform_create(self, serializer):
+        deposit = serializer.save()
+        EnvelopeDepositRollup.objects.add_deposit(deposit)
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        EnvelopeDepositRollup.objects.add_deposit(serializer.instance, sign=-1)
+        deposit = serializer.save()
+        EnvelopeDepositRollup.objects.add_deposit(deposit)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        EnvelopeDepositRollup.objects.add_deposit(instance, sign=-1)
+        instance.delete()
+
 
 class EnvelopeLevelAdminViewset(mixins.ListModelMixin,
                                 mixins.CreateModelMixin,
@@ -333,6 +499,55 @@ class EventTypeAdminViewset(mixins.ListModelMixin,
     filter_class = EventTypeFilter
     renderer_classes = [GrizzlyRenderer]
 
+    MAX_SIMULATION_RUNS = 100
+    MAX_SIMULATION_MEMBERS = 1000000
+
+    @action(detail=True, methods=['post'])
+    def simulate(self, request, pk=None):
+        '''
+        Queue a replay of a day of the event's current configuration with
+        today's (or `date`'s) deposits, or `members` synthetic log-normal
+        deposits of median `deposit_median`, to see how fast the pool runs
+        out. The report ends up in the request log's memo.
+        '''
+
+        event_type = self.get_object()
+        data = request.data
+
+        try:
+            pool_amount = data.get('pool_amount')
+            options = {
+                'runs': int(data.get('runs', 10)),
+                'participation': float(data.get('participation', 1)),
+                'pool_amount': float(pool_amount) if pool_amount else None,
+                'seed': data.get('seed'),
+                'members': int(data.get('members') or 0),
+                'deposit_median': float(data.get('deposit_median', 100)),
+                'deposit_sigma': float(data.get('deposit_sigma', 1)),
+                'date': data.get('date'),
+            }
+            if options['date']:
+                datetime.strptime(options['date'], '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return Response(constants.FIELD_ERROR, status=400)
+
+        if not 0 < options['runs'] <= self.MAX_SIMULATION_RUNS or \
+                not 0 < options['participation'] <= 1 or \
+                not 0 <= options['members'] <= self.MAX_SIMULATION_MEMBERS:
+            return Response(constants.FIELD_ERROR, status=400)
+
+        request_log = RequestLog.objects.create(
+            event_type=event_type,
+            request_type=TYPE_EVENT_SIMULATION,
+            total=options['runs'],
+            created_by=request.user,
+        )
+
+        simulate_event.apply_async((request_log.id, options),
+                                   queue='envelope_operations')
+
+        return Response(data=[{'request_log': request_log.id}], status=200)
+
 
 class EventTypeMemberViewset(mixins.ListModelMixin,
                              viewsets.GenericViewSet):
@@ -427,3 +642,25 @@ def import_file(request):
 
     return generate_response(constants.ALL_OK,
                              data=import_data.dict)
+
+
+@require_GET
+def event_status(request):
+    '''
+    An event's remaining pool, open state and recent winners, built once per
+    STATUS_TICK, for clients polling at that pace. The gateway streams the
+    same status as server-sent events.
+    '''
+
+    event_type = EnvelopeClaim.objects.get_event_type(
+        request.GET.get('event_type', 0))
+    if not event_type:
+        return generate_response(constants.INVALID_EVENT_TYPE,
+                                 msg=_('Invalid event type'))
+
+    status = get_event_status(event_type)
+
+    response = generate_response(constants.ALL_OK, data=status)
+    response['Cache-Control'] = f'max-age={STATUS_TICK}'
+
+    return response
@@ -0,0 +1,190 @@
+import json
+import logging
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from redis.exceptions import RedisError
+
+from envelope.ledger import LEDGER_KEY_TTL, PoolLedger, get_redis, to_cents
+
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'envelope:claims:pending'
+PROCESSING_KEY = 'envelope:claims:processing'
+FLUSH_LOCK_KEY = 'envelope:claims:flush_lock'
+# Claims that could not be written, kept for a look and a manual replay
+DEAD_LETTER_KEY = 'envelope:claims:dead'
+
+# Move up to ARGV[1] claims from the pending to the processing list
+TAKE_BATCH_SCRIPT = '''
+local claims = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #claims > 0 then
+    redis.call('LTRIM', KEYS[1], #claims, -1)
+    redis.call('RPUSH', KEYS[2], unpack(claims))
+end
+return claims
+'''
+
+
+def get_unflushed_key(username):
+    return f'envelope:claims:unflushed:{username}'
+
+
+class WriteBehindQueue(object):
+    '''
+    Durable queue of claims decided on the atomic counters but not yet
+    written to the database.
+
+    Claims are appended to a pending list and indexed per member so reads
+    can merge them in. A single flusher moves a batch to a processing list,
+    writes it and only then drops it, so a crashed flush is replayed. Claims
+    that cannot be written are set aside so they do not hold back the rest.
+    '''
+
+    def __init__(self):
+        self.client = get_redis()
+
+    @property
+    def is_available(self):
+        return self.client is not None
+
+    def push(self, claims):
+        '''
+        Append claims (dicts with a `uuid`) to the queue. Returns False when
+        redis is unavailable and the claims must be written directly.
+        '''
+
+        if not self.is_available:
+            return False
+
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            for claim in claims:
+                payload = json.dumps(claim)
+                unflushed_key = get_unflushed_key(claim['username'])
+                pipe.rpush(PENDING_KEY, payload)
+                pipe.hset(unflushed_key, claim['uuid'], payload)
+                pipe.expire(unflushed_key, LEDGER_KEY_TTL)
+            pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+        return True
+
+    def get_unflushed(self, username):
+        '''
+        Claims of a member that are still waiting to be written.
+        '''
+
+        if not self.is_available:
+            return []
+
+        try:
+            claims = self.client.hvals(get_unflushed_key(username))
+        except RedisError as exc:
+            logger.error(exc)
+            return []
+
+        return [json.loads(claim) for claim in claims]
+
+    def get_unflushed_many(self, usernames):
+        '''
+        {username: claims still waiting to be written} of many members, in
+        one round trip. Members without such claims are left out.
+        '''
+
+        if not self.is_available or not usernames:
+            return {}
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for username in usernames:
+                pipe.hvals(get_unflushed_key(username))
+            results = pipe.execute()
+        except RedisError as exc:
+            logger.error(exc)
+            return {}
+
+        return {username: [json.loads(claim) for claim in claims]
+                for username, claims in zip(usernames, results) if claims}
+
+    def size(self):
+        if not self.is_available:
+            return None
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.llen(PENDING_KEY)
+            pipe.llen(PROCESSING_KEY)
+            return sum(pipe.execute())
+        except RedisError as exc:
+            logger.error(exc)
+            return None
+
+    def acquire_flush_lock(self, timeout):
+        try:
+            return bool(self.client.set(FLUSH_LOCK_KEY, 1,
+                                        ex=timeout, nx=True))
+        except RedisError as exc:
+            logger.error(exc)
+            return False
+
+    def release_flush_lock(self):
+        try:
+            self.client.delete(FLUSH_LOCK_KEY)
+        except RedisError as exc:
+            logger.error(exc)
+
+    def recover(self):
+        '''
+        Put back the claims of a flush that did not finish. Only call this
+        while holding the flush lock.
+        '''
+
+        recovered = 0
+        while self.client.rpoplpush(PROCESSING_KEY, PENDING_KEY):
+            recovered += 1
+
+        if recovered:
+            logger.warning(f'{recovered} unflushed envelope claims replayed')
+
+        return recovered
+
+    def take_batch(self, size):
+        take = self.client.register_script(TAKE_BATCH_SCRIPT)
+        claims = take(keys=[PENDING_KEY, PROCESSING_KEY], args=[size])
+
+        return [json.loads(claim) for claim in claims]
+
+    def ack_batch(self, claims, dead=()):
+        '''
+        Drop a written batch from the processing list and the member index,
+        and settle the pool amounts the claims reserved, all at once so a
+        replayed batch is not settled twice. The `dead` claims of the batch,
+        which could not be written, go to the dead letter list instead.
+        '''
+
+        pending = {}
+        for claim in claims:
+            if claim.get('pool_reserved'):
+                business_date = timezone.localtime(
+                    parse_datetime(claim['created_at'])).date()
+                key = PoolLedger.get_pending_key(claim['event_type'],
+                                                 business_date)
+                pending[key] = pending.get(key, 0) + to_cents(claim['amount'])
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(PROCESSING_KEY)
+        for claim in claims:
+            pipe.hdel(get_unflushed_key(claim['username']), claim['uuid'])
+        for key, cents in pending.items():
+            pipe.decrby(key, cents)
+        for claim in dead:
+            pipe.rpush(DEAD_LETTER_KEY, json.dumps(claim))
+        pipe.execute()
+
+        if dead:
+            logger.error(f'{len(dead)} envelope claims moved to '
+                         f'{DEAD_LETTER_KEY}')
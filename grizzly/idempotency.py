@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import time
+
+from functools import wraps
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from grizzly.lib import constants
+
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+# How long a response is replayed for its key
+IDEMPOTENCY_TTL = 60 * 60 * 24
+# Longest a request holds its key, and a duplicate waits for the result
+IDEMPOTENCY_LOCK_TIMEOUT = 10
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+
+
+def build_idempotency_cache_key(scope, username, key):
+    # Keys are only unique per client, scope them to the member and view
+    digest = hashlib.sha1(f'{username}:{key}'.encode()).hexdigest()
+
+    return f'idempotency_{scope}_{digest}'
+
+
+def get_idempotency_cache_key(request, view):
+    key = request.META.get(IDEMPOTENCY_HEADER)
+    if not key:
+        return None
+
+    return build_idempotency_cache_key(view.__class__.__name__,
+                                       request.data.get('username', ''), key)
+
+
+def is_replay(request, view):
+    '''
+    Whether the request repeats an Idempotency-Key already answered.
+    '''
+
+    cache_key = get_idempotency_cache_key(request, view)
+
+    return cache_key is not None and cache.get(cache_key) is not None
+
+
+def wait_for_response(cache_key):
+    deadline = time.monotonic() + IDEMPOTENCY_LOCK_TIMEOUT
+
+    while time.monotonic() < deadline:
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    return None
+
+
+def run_once(cache_key, handler):
+    '''
+    Run `handler()`, which returns (data, status), at most once per
+    `cache_key` and cache its result. Returns (data, status, replayed), or
+    None when a duplicate is still running after IDEMPOTENCY_LOCK_TIMEOUT.
+    '''
+
+    cached = cache.get(cache_key)
+    if cached is None:
+        lock_key = f'{cache_key}_lock'
+        locked = cache.add(lock_key, 1, IDEMPOTENCY_LOCK_TIMEOUT)
+        if locked is None:
+            # The cache ignores its errors and answers None when down, run
+            # the request as if it had no key rather than turn it away
+            logger.warning(f'Idempotency cache unavailable: {cache_key}')
+            data, status = handler()
+            return data, status, False
+
+        if locked:
+            try:
+                data, status = handler()
+                if status < 500:
+                    cache.set(cache_key, (data, status), IDEMPOTENCY_TTL)
+                return data, status, False
+            finally:
+                cache.delete(lock_key)
+
+        cached = wait_for_response(cache_key)
+        if cached is None:
+            logger.warning(f'Idempotent request still running: {cache_key}')
+            return None
+
+    data, status = cached
+    return data, status, True
+
+
+def idempotent(view_method):
+    '''
+    Replay the first response of a POST for repeats of its Idempotency-Key
+    header, so client retries do not run it again. Concurrent duplicates
+    wait for the first one instead of running alongside it.
+
+    Requests without the header are handled as usual, and so are requests
+    that raised, so they can be retried.
+    '''
+
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        cache_key = get_idempotency_cache_key(request, self)
+        if cache_key is None:
+            return view_method(self, request, *args, **kwargs)
+
+        responses = []
+
+        def handler():
+            response = view_method(self, request, *args, **kwargs)
+            responses.append(response)
+            return response.data, response.status_code
+
+        result = run_once(cache_key, handler)
+        if result is None:
+            return Response(constants.ACTION_TOO_FREQUENT, status=400)
+
+        data, status, replayed = result
+        if not replayed:
+            return responses[0]
+
+        response = Response(data=data, status=status)
+        response['Idempotent-Replayed'] = 'true'
+
+        return response
+
+    return wrapper
@@ -23,6 +23,7 @@ NOT_ALLOWED = 7001
 NO_CLAIM_LEFT = 3001
 NO_POOL_AMOUNT_LEFT = 3002
 CANNOT_CLAIM_YET = 3003
+NO_REWARD_LEFT = 3004
 INVALID_EVENT_TYPE = 3010
 
 
@@ -55,6 +56,7 @@ ERROR_CODES = {
     3001: _('No claim left'),
     3002: _('No pool amount left'),
     3003: _('Cannot claim yet'),
+    3004: _('No reward left'),
     3010: _('Invalid event type.'),
     7001: _('Not Allowed'),
     9008: _('Unknown error has occurred. Please contact support.'),
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 
 import os
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -42,6 +44,9 @@ if 'WHITELIST' in os.environ:
 
 DEFAULT_REQUEST_RATE_LIMIT = '1/30.minute'
 
+# Answer envelope claims before they are written, a Celery task persists them
+ENVELOPE_WRITE_BEHIND = os.environ.get('ENVELOPE_WRITE_BEHIND') == '1'
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -190,6 +195,46 @@ MEDIA_URL = '/media/'
 
 CELERY_RESULT_BACKEND = 'rpc://'
 CELERY_TIMEZONE = TIME_ZONE
+CELERYBEAT_SCHEDULE = {
+    'envelope-reconcile-pool-ledger': {
+        'task': 'envelope_reconcile_pool_ledger',
+        'schedule': 300.0,  # 5 minutes
+        'options': {'queue': 'envelope_operations'},
+    },
+    'envelope-reconcile-reward-stock': {
+        'task': 'envelope_reconcile_reward_stock',
+        'schedule': 60.0,  # 1 minute
+        'options': {'queue': 'envelope_operations'},
+    },
+    'envelope-warm-up-events': {
+        'task': 'envelope_warm_up_events',
+        'schedule': 60.0,  # 1 minute
+        'options': {'queue': 'envelope_operations'},
+    },
+    'envelope-flush-claims': {
+        'task': 'envelope_flush_claims',
+        'schedule': 2.0,  # 2 seconds
+        'options': {'queue': 'envelope_operations'},
+    },
+    'envelope-schedule-decks': {
+        'task': 'envelope_schedule_decks',
+        'schedule': 60.0,  # 1 minute
+        'options': {'queue': 'envelope_operations'},
+    },
+    'promotion-rollover-summaries': {
+        'task': 'promotion_rollover_summaries',
+        # From the start of the week (CELERY_TIMEZONE), the hourly runs
+        # after the first one only catch up on a missed one
+        'schedule': crontab(minute=0, day_of_week='monday'),
+        'options': {'queue': 'bet_operations'},
+    },
+    'promotion-compute-dirty-bonus': {
+        'task': 'compute_total_bonus',
+        'schedule': crontab(hour=3, minute=0),  # Nightly
+        'kwargs': {'dirty_only': True},
+        'options': {'queue': 'bet_operations'},
+    },
+}
 
 RABBITMQ_DEFAULT_USER = os.environ.get('RABBITMQ_DEFAULT_USER')
 RABBITMQ_DEFAULT_PASS = os.environ.get('RABBITMQ_DEFAULT_PASS')
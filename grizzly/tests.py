@@ -0,0 +1,67 @@
+import threading
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+
+from grizzly.idempotency import run_once
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+})
+class RunOnceTest(SimpleTestCase):
+    CACHE_KEY = 'idempotency_test_key'
+
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    def handler(self):
+        self.calls += 1
+        return {'id': self.calls}, 200
+
+    def test_replay(self):
+        self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                         ({'id': 1}, 200, False))
+        self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                         ({'id': 1}, 200, True))
+        self.assertEqual(self.calls, 1)
+
+    def test_server_errors_are_not_replayed(self):
+        run_once(self.CACHE_KEY, lambda: (None, 500))
+
+        self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                         ({'id': 1}, 200, False))
+
+    def test_concurrent_duplicate_waits_for_the_first(self):
+        # The first request holds the lock and answers a moment later
+        cache.add(f'{self.CACHE_KEY}_lock', 1)
+        timer = threading.Timer(0.1, cache.set,
+                                (self.CACHE_KEY, ({'id': 0}, 200)))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                         ({'id': 0}, 200, True))
+        self.assertEqual(self.calls, 0)
+
+    @mock.patch('grizzly.idempotency.IDEMPOTENCY_LOCK_TIMEOUT', 0.1)
+    def test_concurrent_duplicate_gives_up(self):
+        cache.add(f'{self.CACHE_KEY}_lock', 1)
+
+        self.assertIsNone(run_once(self.CACHE_KEY, self.handler))
+        self.assertEqual(self.calls, 0)
+
+    def test_cache_unavailable(self):
+        # What django-redis answers with IGNORE_EXCEPTIONS when redis is down
+        with mock.patch('grizzly.idempotency.cache') as down_cache:
+            down_cache.get.return_value = None
+            down_cache.add.return_value = None
+
+            self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                             ({'id': 1}, 200, False))
+            self.assertEqual(run_once(self.CACHE_KEY, self.handler),
+                             ({'id': 2}, 200, False))
+
+        self.assertEqual(self.calls, 2)
@@ -2,6 +2,7 @@ import logging
 
 from rest_framework.throttling import AnonRateThrottle
 from configsetting.models import GlobalPreference
+from grizzly.idempotency import is_replay
 from grizzly.settings import DEFAULT_REQUEST_RATE_LIMIT
 
 
@@ -53,4 +54,7 @@ class CustomAnonThrottle(AnonRateThrottle):
         if request.method == 'GET':  # allow for GET request
             return True
 
+        if is_replay(request, view):  # retry answered from cache
+            return True
+
         return super().allow_request(request, view)
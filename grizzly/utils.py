@@ -156,6 +156,25 @@ def get_request_data(request):
     return data
 
 
+def get_username_list(data, limit):
+    '''
+    Usernames of a batch request, sent as a list or a comma separated
+    string. Returns None when there are none or more than `limit`.
+    '''
+
+    usernames = data.get('usernames') or []
+    if isinstance(usernames, str):
+        usernames = usernames.split(',')
+
+    usernames = list(dict.fromkeys(
+        str(username).strip() for username in usernames
+        if str(username).strip()))
+    if not 0 < len(usernames) <= limit:
+        return None
+
+    return usernames
+
+
 def verify_captcha(captcha_dict):
     """
         Verify captcha code.
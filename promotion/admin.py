@@ -12,8 +12,9 @@ from promotion.models import (Announcement,
                               PromotionBetLevel,
                               PromotionBetMonthly,
                               ImportExportLog,
-                              Summary)
-from promotion.tasks import compute_total_bonus
+                              Summary,
+                              SummaryRollover)
+from promotion.tasks import compute_total_bonus, mark_dirty_members
 
 
 class AnnouncementAdmin(admin.ModelAdmin):
@@ -35,6 +36,20 @@ class PromotionBetAdmin(admin.ModelAdmin):
                     'promotion_bet_level', 'game_type', 'created_by',
                     'created_at', 'active')
 
+    def save_model(self, request, obj, form, change):
+        dirty_members = [(obj.member_id, obj.game_type)]
+        if change:
+            # The bet may move to another member or game type
+            dirty_members.extend(PromotionBet.objects.filter(id=obj.id)
+                                 .values_list('member_id', 'game_type'))
+
+        super().save_model(request, obj, form, change)
+        mark_dirty_members(dirty_members)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        mark_dirty_members([(obj.member_id, obj.game_type)])
+
 
 class PromotionBetLevelAdmin(admin.ModelAdmin):
     list_display = ('name', 'game_type', 'total_bet', 'bonus', 'weekly_bonus',
@@ -118,6 +133,10 @@ class SummaryAdmin(admin.ModelAdmin):
         return redirect('/admin/promotion/summary/')
 
 
+class SummaryRolloverAdmin(admin.ModelAdmin):
+    list_display = ('cycle_begin', 'summaries', 'created_at')
+
+
 class ImportExportLogAdmin(admin.ModelAdmin):
     list_display = ('game_type', 'request_type', 'status', 'filename',
                     'memo', 'created_by', 'created_at', 'updated_at')
@@ -131,4 +150,5 @@ admin.site.register(PromotionBet, PromotionBetAdmin)
 admin.site.register(PromotionBetLevel, PromotionBetLevelAdmin)
 admin.site.register(PromotionBetMonthly, PromotionBetMonthlyAdmin)
 admin.site.register(Summary, SummaryAdmin)
+admin.site.register(SummaryRollover, SummaryRolloverAdmin)
 admin.site.register(ImportExportLog, ImportExportLogAdmin)
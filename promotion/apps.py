@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class PromotionConfig(AppConfig):
     name = 'promotion'
+
+    def ready(self):
+        import promotion.signals  # noqa: F401
@@ -0,0 +1,97 @@
+def first_week(cycle_begin):
+    return cycle_begin.day <= 7
+
+
+class MonthBonus(object):
+    '''
+    One PromotionBetMonthly row as the bonus engine computes it.
+    '''
+
+    def __init__(self, game_type, cycle_year, cycle_month):
+        self.game_type = game_type
+        self.cycle_year = cycle_year
+        self.cycle_month = cycle_month
+        self.cycle_begin = None
+        self.cycle_end = None
+        # All bets of the month, and those of the cycle running now
+        self.total_bet = 0.0
+        self.current_bet = 0.0
+        self.total_weekly_bonus = 0.0
+        self.month_bonus = 0.0
+        self.accumulated_bonus = 0.0
+        self.promotion_bet_level = None
+
+
+def compute_member_bonus(bets, get_ladder, now):
+    '''
+    Monthly bonuses and total bonus per game type of one member.
+
+    `bets` are (game_type, amount, cycle_begin, cycle_end) with local
+    datetimes, ordered by game type and cycle, and `now` is local too.
+    Returns ([MonthBonus], {game_type: total_bonus}); months only holding
+    bets of the running cycle are left out, their game type still gets a
+    total. Totals run on across game types, as they always have.
+    '''
+
+    today = now.date()
+    months = {}
+    counted_months = []
+    total_bonus = {}
+
+    total_bets = 0.0
+    old_cycle = None
+    old_bet_level = None
+    for game_type, amount, cycle_begin, cycle_end in bets:
+        key = (game_type, cycle_begin.year, cycle_begin.month)
+        month = months.get(key)
+        if month is None:
+            month = months[key] = MonthBonus(*key)
+
+        total_bonus.setdefault(game_type, 0.0)
+        month.total_bet += amount
+        if cycle_begin <= now <= cycle_end:
+            month.current_bet += amount
+
+        cycle_begin, cycle_end = cycle_begin.date(), cycle_end.date()
+        if cycle_begin <= today <= cycle_end:
+            continue
+
+        total_bets += amount
+
+        if month.cycle_begin is None:
+            month.cycle_begin = cycle_begin
+            counted_months.append(month)
+        month.cycle_end = cycle_end
+
+        bet_level = get_ladder(game_type).get_level(total_bets)
+        if bet_level:
+            if first_week(cycle_begin):
+                month.month_bonus = bet_level.monthly_bonus
+
+            # A later bet of the same cycle replaces its weekly bonus
+            if old_bet_level and old_cycle == cycle_begin:
+                month.total_weekly_bonus -= old_bet_level.weekly_bonus
+            month.total_weekly_bonus += bet_level.weekly_bonus
+
+            old_bet_level = bet_level
+
+        old_cycle = cycle_begin
+
+    last_total_bets = 0.0
+    for month in counted_months:
+        ladder = get_ladder(month.game_type)
+        total_bets = last_total_bets + month.total_bet - month.current_bet
+
+        month.accumulated_bonus = ladder.get_bonus(
+            total_bets, above=last_total_bets, include_above=True)
+        # The highest level between the two totals, if any
+        month_level = ladder.get_level(total_bets)
+        if month_level and month_level.total_bet >= last_total_bets:
+            month.promotion_bet_level = month_level
+
+        last_total_bets += month.total_bet
+
+        total_bonus[month.game_type] += month.accumulated_bonus + \
+            month.total_weekly_bonus + month.month_bonus
+
+    return counted_months, total_bonus
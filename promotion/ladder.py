@@ -0,0 +1,104 @@
+import time
+
+from bisect import bisect_left, bisect_right
+from django.core.cache import cache
+
+from promotion.models import PromotionBetLevel
+
+
+LADDER_VERSION_KEY = 'promotion_bet_level_version'
+
+# Reload even without a version bump, in case the cache was unreachable
+# when the bump happened
+LADDER_MAX_AGE = 60
+
+_ladders = {}
+
+
+def get_version():
+    return cache.get(LADDER_VERSION_KEY) or 0
+
+
+def bump_version():
+    if not cache.add(LADDER_VERSION_KEY, 1, None):
+        try:
+            cache.incr(LADDER_VERSION_KEY)
+        except ValueError:
+            cache.set(LADDER_VERSION_KEY, 1, None)
+
+
+def get_ladder(game_type):
+    '''
+    Return the BetLevelLadder of `game_type` from the process cache,
+    reloading it when a level was saved or it is older than LADDER_MAX_AGE.
+    '''
+
+    version = get_version()
+    cached = _ladders.get(game_type)
+
+    if cached is not None:
+        cached_version, loaded_at, ladder = cached
+        if cached_version == version and \
+                time.monotonic() - loaded_at < LADDER_MAX_AGE:
+            return ladder
+
+    ladder = BetLevelLadder(PromotionBetLevel.objects
+                            .filter(game_type=game_type)
+                            .order_by('total_bet', 'id'))
+    _ladders[game_type] = (version, time.monotonic(), ladder)
+
+    return ladder
+
+
+class BetLevelLadder(object):
+    '''
+    The bet levels of one game type sorted by total bet, with running sums
+    of their bonuses, so level and bonus lookups are bisects instead of
+    queries.
+    '''
+
+    def __init__(self, levels):
+        self.levels = sorted(levels, key=lambda level: level.total_bet)
+        self.thresholds = [level.total_bet for level in self.levels]
+
+        # bonus_sums[i] is the bonus of the first i levels
+        self.bonus_sums = [0.0]
+        for level in self.levels:
+            self.bonus_sums.append(self.bonus_sums[-1] + level.bonus)
+
+    def get_level(self, total_bet):
+        '''
+        The highest level reached with `total_bet`, None below the first.
+        '''
+
+        index = bisect_right(self.thresholds, total_bet)
+
+        return self.levels[index - 1] if index else None
+
+    def get_next_level(self, total_bet):
+        '''
+        The first level above `total_bet`, None past the last.
+        '''
+
+        index = bisect_right(self.thresholds, total_bet)
+
+        return self.levels[index] if index < len(self.levels) else None
+
+    def get_bonus(self, up_to, above=None, include_above=False):
+        '''
+        Sum of the bonuses of the levels reached with `up_to` but not with
+        `above` (or, with `include_above`, from `above` on).
+        '''
+
+        end = bisect_right(self.thresholds, up_to)
+        if above is None:
+            start = 0
+        elif include_above:
+            start = bisect_left(self.thresholds, above)
+        else:
+            start = bisect_right(self.thresholds, above)
+
+        if end <= start:
+            return 0.0
+
+        return round(self.bonus_sums[end] - self.bonus_sums[start], 2)
@@ -358,6 +358,42 @@ class Summary(models.Model):
             return 'Live'
 
 
+class DirtyMember(models.Model):
+    '''
+    A member's game type whose bets changed since its bonus was last
+    computed, for the dirty-only compute_total_bonus run.
+    '''
+    member = models.ForeignKey('account.Member',
+                               related_name='dirty_bonus',
+                               on_delete=models.CASCADE)
+    game_type = models.IntegerField(default=0,
+                                    choices=GAME_TYPE_OPTIONS)
+    marked_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'promote_dirtymember'
+        unique_together = ('member', 'game_type')
+
+    def __str__(self):
+        return f'{self.member} - {self.game_type}'
+
+
+class SummaryRollover(models.Model):
+    '''
+    One weekly rollover of the summaries, at most one per cycle.
+    '''
+    cycle_begin = models.DateTimeField(unique=True)
+    summaries = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'promote_summaryrollover'
+
+    def __str__(self):
+        cycle_begin = timezone.localtime(self.cycle_begin)
+        return f'{cycle_begin:%Y-%m-%d} - {self.summaries}'
+
+
 class ImportExportLog(models.Model):
     game_type = models.IntegerField(default=0,
                                     null=True, blank=True,
@@ -1,10 +1,11 @@
 import re
 
 from django.utils.translation import ugettext as _
-from django.db.models import Sum
 from rest_framework import serializers
 
 from grizzly.lib import constants
+from promotion.ladder import get_ladder
+from promotion.tasks import mark_dirty_members
 from promotion.models import (Announcement,
                               GAME_TYPE_LIVE,
                               Promotion,
@@ -218,11 +219,8 @@ class PromotionBetLevelAdminSerializer(serializers.ModelSerializer):
         game_type = request.GET.get('game_type', '0')
 
         if int(game_type) == GAME_TYPE_LIVE:
-            total_bonus = PromotionBetLevel.objects.\
-                filter(game_type=GAME_TYPE_LIVE,
-                       total_bet__lte=instance.total_bet).\
-                aggregate(Sum('bonus'))
-            ret['total_bonus'] = total_bonus.get('bonus__sum', 0.0)
+            ret['total_bonus'] = get_ladder(GAME_TYPE_LIVE).get_bonus(
+                instance.total_bet)
 
         return ret
 
@@ -232,13 +230,25 @@ class PromotionBetAdminSerializer(serializers.ModelSerializer):
         model = PromotionBet
         fields = '__all__'
 
+    def create(self, validated_data):
+        instance = super().create(validated_data)
+        mark_dirty_members([(instance.member_id, instance.game_type)])
+
+        return instance
+
     def update(self, instance, validated_data):
         request = self.context['request']
         updater = request.user
 
         validated_data['updated_by'] = updater
 
-        return super().update(instance, validated_data)
+        # The bet may move to another member or game type
+        dirty_members = [(instance.member_id, instance.game_type)]
+        instance = super().update(instance, validated_data)
+        dirty_members.append((instance.member_id, instance.game_type))
+        mark_dirty_members(dirty_members)
+
+        return instance
 
     def to_representation(self, instance):
         request = self.context.get('request')
@@ -368,11 +378,8 @@ class PromotionBetLevelSerializer(serializers.ModelSerializer):
         game_type = request.GET.get('game_type', '0')
 
         if int(game_type) == GAME_TYPE_LIVE:
-            total_bonus = PromotionBetLevel.objects.\
-                filter(game_type=GAME_TYPE_LIVE,
-                       total_bet__lte=instance.total_bet).\
-                aggregate(Sum('bonus'))
-            ret['total_bonus'] = total_bonus.get('bonus__sum', 0.0)
+            ret['total_bonus'] = get_ladder(GAME_TYPE_LIVE).get_bonus(
+                instance.total_bet)
 
         return ret
 
@@ -467,13 +474,11 @@ class SummarySerializer(serializers.ModelSerializer):
                 }
 
         if instance.promotion_bet_level:
-            bet_level = PromotionBetLevel.objects.filter(
-                game_type=instance.game_type,
-                total_bet__gt=instance.promotion_bet_level.total_bet)
+            bet_level = get_ladder(instance.game_type).get_next_level(
+                instance.promotion_bet_level.total_bet)
 
-            if bet_level.exists():
-                bet_diff = bet_level.first().total_bet - \
-                    instance.total_promotion_bet
+            if bet_level:
+                bet_diff = bet_level.total_bet - instance.total_promotion_bet
                 ret['bets_to_next_level'] = bet_diff
 
         return ret
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+
+from promotion.ladder import bump_version
+from promotion.models import PromotionBetLevel
+
+
+def invalidate_bet_level_ladder(sender, instance, **kwargs):
+    bump_version()
+
+
+post_save.connect(invalidate_bet_level_ladder, sender=PromotionBetLevel)
+post_delete.connect(invalidate_bet_level_ladder, sender=PromotionBetLevel)
@@ -1,25 +1,42 @@
 import logging
+import time
+import uuid
 
-from calendar import monthrange
+from celery import group
 from datetime import datetime, timedelta
 from django.contrib.auth.models import User
-from django.db.models import Sum, Q
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, F, Max, Sum, Value, When
+from django.db.models.functions import Cast
 from django.utils import timezone
+from itertools import groupby
+from operator import itemgetter
 
 from account.models import Member
 from grizzly.celery import app
-from promotion.models import (GAME_TYPE_ELECTRONICS,
+from promotion.bonus import compute_member_bonus, first_week
+from promotion.ladder import get_ladder
+from promotion.models import (DirtyMember,
+                              GAME_TYPE_ELECTRONICS,
                               PromotionBet,
-                              PromotionBetLevel,
                               PromotionBetMonthly,
                               ImportExportLog,
                               REQUEST_LOG_COMPLETED,
                               REQUEST_LOG_CANCELED,
-                              REQUEST_LOG_DELETED,
-                              Summary)
+                              Summary,
+                              SummaryRollover)
 
 logger = logging.getLogger(__name__)
 
+# Rows per query when an import reads and writes the members' rows
+IMPORT_CHUNK_SIZE = 1000
+# Parallel tasks computing the members' total bonus, by member id
+COMPUTE_BONUS_PARTITIONS = 8
+# Members whose results are written at once, and bets fetched at once
+COMPUTE_BONUS_CHUNK_SIZE = 500
+COMPUTE_BONUS_REPORT_TTL = 60 * 60 * 24
+
 
 @app.task(name='promotion_bet_import')
 def promotion_bet_import(import_data, user_id, game_type, request_log_id):
@@ -29,40 +46,38 @@ def promotion_bet_import(import_data, user_id, game_type, request_log_id):
     week_begin = (today - timedelta(days=today.weekday())).replace(
         hour=0, minute=0, second=0, microsecond=0)
     week_end = week_begin + timedelta(days=6)
-    cycle_year = week_begin.year
-    cycle_month = week_begin.month
-
-    member_bet_summary = Summary.objects \
-        .filter(game_type=game_type,
-                updated_at__lt=week_begin,
-                promotion_bet_level__isnull=False) \
-        .order_by('-updated_at')
-    update_members_summary(member_bet_summary, today)
 
-    deposits = []
+    rows = []
     for data in reversed(import_data):
-        logger.info(data)
         try:
             username = data.get('username')
             amount = float(data.get('amount'))
-            if amount < 0.0:
-                update_request_log(request_log,
-                                   REQUEST_LOG_CANCELED,
-                                   f'Negative amount found in imported data: '
-                                   f'{username} ({amount:,.2f})')
-                return None
-
-            member, created = Member.objects.get_or_create(
-                username=username)
-
-            if created:
-                member.created_by = user
-            else:
-                member.updated_by = user
+        except Exception as exc:
+            logger.error(f'Error: {exc} -- {data.get("username")}')
+            update_request_log(request_log,
+                               REQUEST_LOG_CANCELED,
+                               f'Error: {exc}')
+            return None
+
+        if amount < 0.0:
+            update_request_log(request_log,
+                               REQUEST_LOG_CANCELED,
+                               f'Negative amount found in imported data: '
+                               f'{username} ({amount:,.2f})')
+            return None
+
+        rows.append((username, amount))
 
-            deposits.append(
+    # The bets below go to this week, last week's bonuses must be rolled
+    # over first in case the beat has not run yet
+    rollover_summaries()
+
+    try:
+        with transaction.atomic():
+            members = get_import_members({username for username, _ in rows})
+            deposits = [
                 PromotionBet(
-                    member=member,
+                    member=members[username],
                     username=username,
                     amount=amount,
                     cycle_begin=week_begin,
@@ -71,17 +86,9 @@ def promotion_bet_import(import_data, user_id, game_type, request_log_id):
                     request_log=request_log,
                     created_by=user,
                 )
-            )
-        except Exception as exc:
-            logger.error(f'Error: {exc} -- {data.get("username")}')
-            update_request_log(request_log,
-                               REQUEST_LOG_CANCELED,
-                               f'Error: {exc}')
-            return None
-
-    try:
-        bet_deposits = PromotionBet.objects.bulk_create(deposits)
-        logger.info(f'{len(bet_deposits)} promotion bet deposits created.')
+                for username, amount in rows
+            ]
+            apply_import_bets(deposits, user, game_type, week_begin, week_end)
     except Exception as exc:
         logger.error(exc)
         update_request_log(request_log,
@@ -89,241 +96,463 @@ def promotion_bet_import(import_data, user_id, game_type, request_log_id):
                            f'Error: {exc}')
         return None
 
-    for bet in bet_deposits:
-        member = bet.member
-        game_type = bet.game_type
-        amount = bet.amount
-        logger.info(f'Processing: {member} -- {amount:,.2f}')
-        bet_summary, created = Summary.objects.get_or_create(
-            member=member, game_type=game_type)
+    logger.info(f'{len(deposits)} promotion bet deposits created.')
+    logger.info('Import complete.')
+    update_request_log(request_log, REQUEST_LOG_COMPLETED)
 
-        if created:
-            bet_summary.created_by = user
+
+def get_chunks(values, size=IMPORT_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def bulk_update(model, objs, fields, batch_size=IMPORT_CHUNK_SIZE):
+    '''
+    Save `fields` of the existing `objs` with one UPDATE per chunk, each
+    field set by a CASE on the primary key, as bulk_update does on newer
+    Django. auto_now fields are only written when listed, with the objects'
+    own values.
+    '''
+
+    fields = [model._meta.get_field(name) for name in fields]
+    updated = 0
+
+    for chunk in get_chunks(objs, batch_size):
+        values = {}
+        for field in fields:
+            value = Case(*[
+                When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                           output_field=field))
+                for obj in chunk
+            ], output_field=field)
+            # Postgres types the CASE from its first value otherwise
+            if connection.vendor == 'postgresql':
+                value = Cast(value, output_field=field)
+            values[field.name] = value
+
+        updated += model.objects.filter(
+            pk__in=[obj.pk for obj in chunk]).update(**values)
+
+    return updated
+
+
+def get_import_members(usernames):
+    '''
+    {username: member} of the imported usernames, creating the new ones.
+    '''
+
+    members = Member.objects.in_bulk(usernames, field_name='username')
+    new_usernames = [username for username in usernames
+                     if username not in members]
+
+    if new_usernames:
+        Member.objects.bulk_create(
+            [Member(username=username) for username in new_usernames],
+            batch_size=IMPORT_CHUNK_SIZE)
+        # bulk_create does not set the ids on every database
+        members.update(Member.objects.in_bulk(new_usernames,
+                                              field_name='username'))
+
+    return members
+
+
+def apply_import_bets(bets, user, game_type, week_begin, week_end):
+    '''
+    Save the imported bets and add them to the members' summaries and
+    monthly bets, bet by bet in import order as if each was saved on its
+    own, with the members' rows read and written in chunks.
+    '''
+
+    member_ids = {bet.member.id for bet in bets}
+    ladder = get_ladder(game_type)
+
+    summaries = {}
+    previous_bets = {}
+    monthly_bets = {}
+    for ids in get_chunks(member_ids):
+        summaries.update(
+            (summary.member_id, summary) for summary in Summary.objects
+            .filter(game_type=game_type, member_id__in=ids)
+            .select_related('promotion_bet_level')
+            .order_by('id'))
+        previous_bets.update(
+            (previous['member'], previous) for previous in PromotionBet
+            .objects
+            .filter(game_type=game_type,
+                    member_id__in=ids,
+                    cycle_begin__lt=week_begin,
+                    active=True)
+            .values('member')
+            .annotate(total_bet=Sum('amount'),
+                      last_cycle_begin=Max('cycle_begin'))
+            .order_by())
+        monthly_bets.update(
+            (monthly_bet.member_id, monthly_bet) for monthly_bet in
+            PromotionBetMonthly.objects
+            .filter(game_type=game_type,
+                    member_id__in=ids,
+                    cycle_year=week_begin.year,
+                    cycle_month=week_begin.month))
+
+    new_summaries = []
+    new_monthly_bets = []
+    for bet in bets:
+        member_id = bet.member.id
+        bet_summary = summaries.get(member_id)
+        if bet_summary is None:
+            bet_summary = summaries[member_id] = Summary(
+                member=bet.member, game_type=game_type, created_by=user)
+            new_summaries.append(bet_summary)
         else:
             bet_summary.updated_by = user
 
-        bet_summary.total_promotion_bet += amount
+        bet_summary.total_promotion_bet += bet.amount
 
-        previous_bets = PromotionBet.objects \
-            .filter(game_type=game_type,
-                    member=member,
-                    cycle_begin__lt=week_begin,
-                    active=True) \
-            .order_by('cycle_begin')
-        previous_total_bet_amount = previous_bets.aggregate(
-            Sum('amount')).get('amount__sum') or 0.0
+        previous = previous_bets.get(member_id)
+        previous_total_bet_amount = previous['total_bet'] if previous \
+            else 0.0
 
-        if previous_bets.exists() and new_cycle(previous_bets, week_begin):
-            if bet_summary.promotion_bet_level:
-                bet_summary.total_bonus += \
-                    bet_summary.promotion_bet_level.weekly_bonus
+        # The level and bonuses the last bet left the summary with
+        if previous and bet_summary.promotion_bet_level:
+            bet_summary.total_bonus += \
+                bet_summary.promotion_bet_level.weekly_bonus
 
-                if first_week(previous_bets.last().cycle_begin):
-                    bet_summary.total_bonus += \
-                        bet_summary.promotion_bet_level.monthly_bonus
+            if first_week(previous['last_cycle_begin']):
+                bet_summary.total_bonus += \
+                    bet_summary.promotion_bet_level.monthly_bonus
 
-        bet_levels = PromotionBetLevel.objects.filter(
-            game_type=game_type,
-            total_bet__lte=bet_summary.total_promotion_bet)
-        current_level = bet_levels.last()
+        current_level = ladder.get_level(bet_summary.total_promotion_bet)
 
         bet_summary.promotion_bet_level = current_level
         bet.promotion_bet_level = current_level
 
-        bet_summary.current_week_bonus = \
-            bet_levels.exclude(total_bet__lte=previous_total_bet_amount) \
-                      .aggregate(Sum('bonus')).get('bonus__sum') or 0.0
-
-        promotion_bet_monthly, created = PromotionBetMonthly.objects.\
-            get_or_create(member=member, cycle_year=cycle_year,
-                          cycle_month=cycle_month, game_type=game_type)
-        if created:
-            promotion_bet_monthly.cycle_year = cycle_year
-            promotion_bet_monthly.cycle_month = cycle_month
-            promotion_bet_monthly.cycle_begin = week_begin
-
-        promotion_bet_monthly.total_bet += amount
+        bet_summary.current_week_bonus = ladder.get_bonus(
+            bet_summary.total_promotion_bet,
+            above=previous_total_bet_amount)
+
+        promotion_bet_monthly = monthly_bets.get(member_id)
+        if promotion_bet_monthly is None:
+            promotion_bet_monthly = monthly_bets[member_id] = \
+                PromotionBetMonthly(member=bet.member,
+                                    cycle_year=week_begin.year,
+                                    cycle_month=week_begin.month,
+                                    cycle_begin=week_begin,
+                                    game_type=game_type)
+            new_monthly_bets.append(promotion_bet_monthly)
+
+        promotion_bet_monthly.total_bet += bet.amount
         promotion_bet_monthly.promotion_bet_level = current_level
         promotion_bet_monthly.cycle_end = week_end
 
-        promotion_bet_monthly.save()
-        bet_summary.save()
-        bet.save()
-
-    logger.info('Import complete.')
-    update_request_log(request_log, REQUEST_LOG_COMPLETED)
-
+    PromotionBet.objects.bulk_create(bets, batch_size=IMPORT_CHUNK_SIZE)
+    mark_dirty_members((member_id, game_type) for member_id in summaries)
+    Summary.objects.bulk_create(new_summaries, batch_size=IMPORT_CHUNK_SIZE)
+    PromotionBetMonthly.objects.bulk_create(new_monthly_bets,
+                                            batch_size=IMPORT_CHUNK_SIZE)
+
+    # No bulk_update on this Django, one UPDATE per member's existing rows
+    for bet_summary in summaries.values():
+        if bet_summary.id:
+            bet_summary.save(update_fields=['total_promotion_bet',
+                                            'total_bonus',
+                                            'promotion_bet_level',
+                                            'current_week_bonus',
+                                            'updated_by',
+                                            'updated_at'])
+
+    for promotion_bet_monthly in monthly_bets.values():
+        if promotion_bet_monthly.id:
+            promotion_bet_monthly.save(update_fields=['total_bet',
+                                                      'promotion_bet_level',
+                                                      'cycle_end'])
+
+
+@app.task(name='promotion_rollover_summaries')
+def rollover_summaries():
+    '''
+    Start the week of the summaries not updated yet this cycle: roll their
+    week's bonus into the total and keep their level as the previous
+    week's, and the previous month's for those last updated last month.
+    Runs once per cycle, recorded in SummaryRollover.
+    '''
 
-def update_members_summary(member_bet_summary, today):
-    for summary in member_bet_summary:
-        summary.total_bonus += summary.current_week_bonus
-        summary.current_week_bonus = 0
+    today = timezone.localtime(timezone.now())
+    week_begin = (today - timedelta(days=today.weekday())).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    last_month = today - timedelta(days=today.day)
 
-        summary.previous_week_bet_level = summary.promotion_bet_level
+    if SummaryRollover.objects.filter(cycle_begin=week_begin).exists():
+        return None
 
-        if summary.updated_at.month == \
-                (today - timedelta(days=today.day)).month:
-            summary.previous_month_bet_level = summary.promotion_bet_level
+    try:
+        with transaction.atomic():
+            rollover = SummaryRollover.objects.create(cycle_begin=week_begin)
 
-        summary.save(update_fields=['current_week_bonus',
-                                    'previous_week_bet_level',
-                                    'previous_month_bet_level',
-                                    'total_bonus',
-                                    'updated_at'])
+            summaries = Summary.objects.filter(
+                updated_at__lt=week_begin,
+                promotion_bet_level__isnull=False)
+            # Before the update below moves updated_at into this cycle
+            summaries.filter(updated_at__month=last_month.month) \
+                     .update(previous_month_bet_level=F(
+                         'promotion_bet_level'))
+            rollover.summaries = summaries.update(
+                total_bonus=F('total_bonus') + F('current_week_bonus'),
+                current_week_bonus=0,
+                previous_week_bet_level=F('promotion_bet_level'),
+                updated_at=timezone.now())
+            rollover.save(update_fields=['summaries'])
+    except IntegrityError:
+        # Another worker took this cycle
+        return None
 
+    logger.info(f'Summary rollover {week_begin:%Y-%m-%d}: '
+                f'{rollover.summaries} summaries')
 
-def new_cycle(previous_bets, week_begin):
-    return previous_bets.last().cycle_begin < week_begin
+    return rollover.summaries
 
 
 @app.task(name='compute_total_bonus')
-def compute_total_bonus():
-    today = timezone.localtime(timezone.now())
+def compute_total_bonus(partitions=COMPUTE_BONUS_PARTITIONS,
+                        dirty_only=False):
+    '''
+    Recompute the members' monthly bets and total bonus, split by member
+    id into `partitions` tasks that run in parallel. With `dirty_only`,
+    only members marked dirty since their last computation.
+    '''
+
+    run_id = uuid.uuid4().hex
+    logger.info(f'Compute total bonus {run_id}: {partitions} partitions'
+                f'{", dirty members only" if dirty_only else ""}')
+
+    group(compute_total_bonus_partition.s(run_id, partition, partitions,
+                                          dirty_only)
+          for partition in range(partitions)) \
+        .apply_async(queue='bet_operations')
+
+
+def mark_dirty_members(pairs):
+    '''
+    Mark (member_id, game_type) pairs for the next dirty-only bonus
+    computation, again if they are marked already.
+    '''
+
+    pairs = {(member_id, game_type) for member_id, game_type in pairs
+             if member_id is not None}
+    marked_at = timezone.now()
+    marked = set()
+
+    for member_ids in get_chunks({member_id for member_id, _ in pairs}):
+        dirty_members = DirtyMember.objects.filter(member_id__in=member_ids)
+        marked.update(pair for pair in dirty_members.values_list(
+            'member_id', 'game_type') if pair in pairs)
+        # A run already reading them clears only older marks
+        dirty_members.update(marked_at=marked_at)
+
+    new_dirty_members = [
+        DirtyMember(member_id=member_id, game_type=game_type,
+                    marked_at=marked_at)
+        for member_id, game_type in pairs - marked
+    ]
+    try:
+        with transaction.atomic():
+            DirtyMember.objects.bulk_create(new_dirty_members,
+                                            batch_size=IMPORT_CHUNK_SIZE)
+    except IntegrityError:
+        # Marked concurrently, one at a time then
+        for dirty_member in new_dirty_members:
+            DirtyMember.objects.update_or_create(
+                member_id=dirty_member.member_id,
+                game_type=dirty_member.game_type,
+                defaults={'marked_at': marked_at})
+
+
+def get_compute_bonus_cache_key(run_id, partition=None):
+    if partition is None:
+        return f'compute_total_bonus_{run_id}_done'
+
+    return f'compute_total_bonus_{run_id}_{partition}'
+
+
+@app.task(name='compute_total_bonus_partition')
+def compute_total_bonus_partition(run_id, partition, partitions,
+                                  dirty_only=False):
+    '''
+    Stream the bets of the members of one partition through the bonus
+    engine and save their monthly bets and summaries in chunks, clearing
+    the dirty marks of the members computed.
+    '''
+
+    started = time.monotonic()
+    now = timezone.localtime(timezone.now())
+    report = {'members': 0, 'bets': 0, 'created': 0, 'updated': 0,
+              'total_bonus': 0.0}
+
     members = Summary.objects.filter(promotion_bet_level__isnull=False) \
-                             .distinct('member') \
-                             .order_by('member')
-
-    logger.info(f'Member count: {members.count()}')
-
-    for i, member in enumerate(members):
-        logger.info(f'({i + 1}) {member.member.username}')
-
-        bets = PromotionBet.objects.filter(member=member.member) \
-                                   .order_by('game_type',
-                                             'created_at')
-
-        if not bets.exists():
-            continue
-
-        total_bets = 0
-        month_bonus = 0
-        old_cycle = None
-        old_bet_level = None
-        bet_summary = {}
-        for bet in bets:
-            game_type = bet.game_type
-            bet_summary.setdefault(game_type, {})
-            cycle_begin = timezone.localtime(bet.cycle_begin).date()
-            cycle_end = timezone.localtime(bet.cycle_end).date()
-
-            if cycle_begin <= today.date() <= cycle_end:
-                continue
-
-            total_bets += bet.amount
-
-            cycle_month = f'{cycle_begin:%Y%m}'
-            bet_summary[game_type].setdefault(
-                cycle_month, {
-                    'cycle_year': cycle_begin.year,
-                    'cycle_month': cycle_begin.month,
-                    'cycle_begin': cycle_begin,
-                    'total_weekly_bonus': 0})
-            bet_summary[game_type][cycle_month]['cycle_end'] = cycle_end
-
-            bet_levels = PromotionBetLevel.objects \
-                .filter(game_type=game_type, total_bet__lte=total_bets) \
-                .order_by('total_bet')
-
-            if bet_levels.exists():
-                month_summary = bet_summary[game_type][cycle_month]
-
-                bet_level = bet_levels.last()
-                if first_week(cycle_begin):
-                    month_bonus = bet_level.monthly_bonus
-                    month_summary['month_bonus'] = month_bonus
-
-                if old_bet_level and old_cycle == cycle_begin:
-                    month_summary['total_weekly_bonus'] -= \
-                        old_bet_level.weekly_bonus
-                month_summary['total_weekly_bonus'] += bet_level.weekly_bonus
-
-                old_bet_level = bet_level
-
-            old_cycle = cycle_begin
-
-        last_total_bets = 0
-        for game_type, summary in bet_summary.items():
-            total_bonus = 0
-            accumulated_bonus = 0
-            for key, month_summary in summary.items():
-                cycle_year = month_summary.get('cycle_year')
-                cycle_month = month_summary.get('cycle_month')
-                month_bets = bets.filter(game_type=game_type,
-                                         cycle_begin__year=cycle_year,
-                                         cycle_begin__month=cycle_month)
-
-                bet_amount_current_cycle = 0
-                bets_current_cycle = month_bets.filter(
-                    Q(cycle_begin__lte=today) & Q(cycle_end__gte=today))
-                if bets_current_cycle.exists():
-                    bet_amount_current_cycle = \
-                        bets_current_cycle.aggregate(Sum('amount')) \
-                                          .get('amount__sum') or 0
-
-                month_bets = month_bets.aggregate(Sum('amount')) \
-                                       .get('amount__sum') or 0
-
-                total_bets = last_total_bets + month_bets - \
-                    bet_amount_current_cycle
-                bet_levels = PromotionBetLevel.objects \
-                    .filter(game_type=game_type,
-                            total_bet__gte=last_total_bets,
-                            total_bet__lte=total_bets)
-                accumulated_bonus = bet_levels.aggregate(Sum('bonus')) \
-                                              .get('bonus__sum') or 0
-                last_total_bets += month_bets
-
-                try:
-                    monthly_bet, created = PromotionBetMonthly.objects \
-                        .get_or_create(member=member.member,
-                                       game_type=game_type,
-                                       cycle_year=cycle_year,
-                                       cycle_month=cycle_month)
-                    monthly_bet.total_bet = month_bets
-                    monthly_bet.accumulated_bonus = accumulated_bonus
-                    monthly_bet.total_weekly_bonus = \
-                        month_summary.get('total_weekly_bonus', 0)
-                    monthly_bet.month_bonus = \
-                        month_summary.get('month_bonus', 0)
-                    monthly_bet.cycle_begin = make_tz_aware(
-                        month_summary.get('cycle_begin'))
-                    monthly_bet.cycle_end = make_tz_aware(
-                        month_summary.get('cycle_end'))
-
-                    if created and bet_levels.exists():
-                        bet_level = bet_levels.last()
-                        monthly_bet.promotion_bet_level = bet_level
-
-                    monthly_bet.save(update_fields=['total_bet',
-                                                    'promotion_bet_level',
-                                                    'accumulated_bonus',
-                                                    'total_weekly_bonus',
-                                                    'month_bonus',
-                                                    'cycle_begin',
-                                                    'cycle_end'])
-                except Exception as exc:
-                    logger.error(exc)
-                    logger.info(month_summary)
-
-                total_bonus += accumulated_bonus + \
-                    month_summary.get('total_weekly_bonus', 0) + \
-                    month_summary.get('month_bonus', 0)
-
-            try:
-                member_summary, created = Summary.objects.get_or_create(
-                    member=member.member, game_type=game_type)
-                member_summary.total_bonus = total_bonus
-
-                member_summary.save()
-            except Exception as exc:
-                logger.error(exc)
-                logger.info(f'Member summary for {member} {game_type}')
-
-    logger.info(f'Compute total bonus completed.')
-
-
-def first_week(cycle_begin):
-    return cycle_begin.day <= 7
+                             .values('member_id')
+    # Members marked from now on are left for the next run
+    dirty_members = DirtyMember.objects \
+        .annotate(partition=F('member_id') % partitions) \
+        .filter(partition=partition, marked_at__lte=now)
+    bets = PromotionBet.objects \
+        .annotate(partition=F('member_id') % partitions) \
+        .filter(partition=partition, member_id__in=members)
+    if dirty_only:
+        # Game types share their running totals, so a member is computed
+        # whole for any of its dirty game types
+        bets = bets.filter(member_id__in=dirty_members.values('member_id'))
+
+    bets = bets \
+        .order_by('member_id', 'game_type', 'cycle_begin', 'created_at',
+                  'id') \
+        .values_list('member_id', 'game_type', 'amount',
+                     'cycle_begin', 'cycle_end') \
+        .iterator(chunk_size=COMPUTE_BONUS_CHUNK_SIZE)
+
+    results = {}
+    for member_id, member_bets in groupby(bets, key=itemgetter(0)):
+        member_bets = [(game_type, amount,
+                        timezone.localtime(cycle_begin),
+                        timezone.localtime(cycle_end))
+                       for _, game_type, amount, cycle_begin, cycle_end
+                       in member_bets]
+        results[member_id] = compute_member_bonus(member_bets, get_ladder,
+                                                  now)
+        report['bets'] += len(member_bets)
+
+        if len(results) >= COMPUTE_BONUS_CHUNK_SIZE:
+            save_member_bonuses(results, report, now)
+            results = {}
+
+    save_member_bonuses(results, report, now)
+
+    # Dirty members without a bet level are skipped like in a full run
+    DirtyMember.objects.filter(id__in=dirty_members.values('id')).delete()
+
+    report['total_bonus'] = round(report['total_bonus'], 2)
+    report['seconds'] = round(time.monotonic() - started, 3)
+    logger.info(f'Compute total bonus {run_id} partition {partition}: '
+                f'{report}')
+
+    report_compute_bonus(run_id, partition, partitions, report)
+
+    return report
+
+
+def save_member_bonuses(results, report, computed_at):
+    '''
+    Write {member_id: compute_member_bonus(...)} to the monthly bets and
+    summaries, creating the missing rows and updating the rows whose values
+    changed in bulk, and clear the members' dirty marks up to
+    `computed_at` in the same transaction.
+    '''
+
+    if not results:
+        return
+
+    member_ids = list(results)
+    monthly_bets = {
+        (monthly_bet.member_id, monthly_bet.game_type,
+         monthly_bet.cycle_year, monthly_bet.cycle_month): monthly_bet
+        for monthly_bet in PromotionBetMonthly.objects
+        .filter(member_id__in=member_ids).order_by('id')
+    }
+    summaries = {
+        (summary.member_id, summary.game_type): summary
+        for summary in Summary.objects
+        .filter(member_id__in=member_ids).order_by('id')
+    }
+
+    new_monthly_bets = []
+    new_summaries = []
+    changed_monthly_bets = []
+    changed_summaries = []
+    now = timezone.now()
+    with transaction.atomic():
+        for member_id, (months, total_bonus) in results.items():
+            report['members'] += 1
+
+            for month in months:
+                values = {
+                    'total_bet': month.total_bet,
+                    'accumulated_bonus': month.accumulated_bonus,
+                    'total_weekly_bonus': month.total_weekly_bonus,
+                    'month_bonus': month.month_bonus,
+                    'cycle_begin': make_tz_aware(month.cycle_begin),
+                    'cycle_end': make_tz_aware(month.cycle_end),
+                }
+                monthly_bet = monthly_bets.get(
+                    (member_id, month.game_type,
+                     month.cycle_year, month.cycle_month))
+
+                if monthly_bet is None:
+                    new_monthly_bets.append(PromotionBetMonthly(
+                        member_id=member_id,
+                        game_type=month.game_type,
+                        cycle_year=month.cycle_year,
+                        cycle_month=month.cycle_month,
+                        promotion_bet_level=month.promotion_bet_level,
+                        **values))
+                elif any(getattr(monthly_bet, field) != value
+                         for field, value in values.items()):
+                    for field, value in values.items():
+                        setattr(monthly_bet, field, value)
+                    changed_monthly_bets.append(monthly_bet)
+
+            for game_type, bonus in total_bonus.items():
+                report['total_bonus'] += bonus
+                summary = summaries.get((member_id, game_type))
+
+                if summary is None:
+                    new_summaries.append(Summary(member_id=member_id,
+                                                 game_type=game_type,
+                                                 total_bonus=bonus))
+                elif summary.total_bonus != bonus:
+                    summary.total_bonus = bonus
+                    summary.updated_at = now
+                    changed_summaries.append(summary)
+
+        PromotionBetMonthly.objects.bulk_create(
+            new_monthly_bets, batch_size=COMPUTE_BONUS_CHUNK_SIZE)
+        Summary.objects.bulk_create(new_summaries,
+                                    batch_size=COMPUTE_BONUS_CHUNK_SIZE)
+        bulk_update(PromotionBetMonthly, changed_monthly_bets,
+                    ['total_bet', 'accumulated_bonus', 'total_weekly_bonus',
+                     'month_bonus', 'cycle_begin', 'cycle_end'],
+                    batch_size=COMPUTE_BONUS_CHUNK_SIZE)
+        bulk_update(Summary, changed_summaries,
+                    ['total_bonus', 'updated_at'],
+                    batch_size=COMPUTE_BONUS_CHUNK_SIZE)
+        DirtyMember.objects.filter(member_id__in=member_ids,
+                                   marked_at__lte=computed_at).delete()
+
+    report['created'] += len(new_monthly_bets) + len(new_summaries)
+    report['updated'] += len(changed_monthly_bets) + len(changed_summaries)
+
+
+def report_compute_bonus(run_id, partition, partitions, report):
+    '''
+    Keep the partition's report and log the totals of the run once the
+    last partition is done. The rpc result backend cannot run a chord
+    callback, so the partitions count themselves done in the cache.
+    '''
+
+    cache.set(get_compute_bonus_cache_key(run_id, partition), report,
+              COMPUTE_BONUS_REPORT_TTL)
+    done_key = get_compute_bonus_cache_key(run_id)
+    cache.add(done_key, 0, COMPUTE_BONUS_REPORT_TTL)
+    if cache.incr(done_key) < partitions:
+        return
+
+    reports = cache.get_many([get_compute_bonus_cache_key(run_id, i)
+                              for i in range(partitions)]).values()
+    totals = {key: sum(report[key] for report in reports)
+              for key in ('members', 'bets', 'created', 'updated',
+                          'total_bonus', 'seconds')}
+    totals['total_bonus'] = round(totals['total_bonus'], 2)
+    totals['slowest_seconds'] = max(report['seconds'] for report in reports)
+
+    logger.info(f'Compute total bonus {run_id} completed: {totals}')
 
 
 def make_tz_aware(unaware_tz_cycle):
@@ -370,20 +599,17 @@ def update_member_bet_details(bet, user=None):
     today = timezone.localtime(timezone.now())
     week_begin = (today - timedelta(days=today.weekday())).replace(
         hour=0, minute=0, second=0, microsecond=0)
-    week_end = week_begin + timedelta(days=6)
 
     cycle_begin = timezone.localtime(bet.cycle_begin)
+    mark_dirty_members([(member.id, game_type)])
     member_summary = Summary.objects.get(member=member,
                                          game_type=game_type)
     member_summary.total_promotion_bet -= bet.amount
     member_summary.updated_by = user
 
-    bet_levels = PromotionBetLevel.objects \
-        .filter(game_type=game_type,
-                total_bet__lte=member_summary.total_promotion_bet) \
-        .order_by('total_bet')
-
-    member_summary.promotion_bet_level = bet_levels.last()
+    ladder = get_ladder(game_type)
+    member_summary.promotion_bet_level = ladder.get_level(
+        member_summary.total_promotion_bet)
 
     member_previous_bets = PromotionBet.objects \
         .filter(game_type=game_type, member=member,
@@ -399,48 +625,34 @@ def update_member_bet_details(bet, user=None):
     member_month_bet.total_bet -= bet.amount
 
     if week_begin == cycle_begin:
-        member_summary.current_week_bonus = bet_levels \
-            .filter(total_bet__gt=previous_total,
-                    total_bet__lte=member_summary.total_promotion_bet) \
-            .aggregate(Sum('bonus')) \
-            .get('bonus__sum') or 0
+        member_summary.current_week_bonus = ladder.get_bonus(
+            member_summary.total_promotion_bet, above=previous_total)
 
         if first_week(cycle_begin):
             member_month_bet.month_bonus = 0
     else:
-        bet_levels = PromotionBetLevel.objects \
-            .filter(game_type=game_type,
-                    total_bet__lte=previous_total + bet.amount) \
-            .order_by('total_bet')
+        bet_level = ladder.get_level(previous_total + bet.amount)
 
-        if bet_levels.exists():
-            accumulated_levels = bet_levels.filter(
-                total_bet__gt=previous_total,
-                total_bet__lte=previous_total + bet.amount)
-            accumulated_bonus = accumulated_levels.aggregate(
-                Sum('bonus')).get('bonus__sum') or 0
+        if bet_level:
+            accumulated_bonus = ladder.get_bonus(previous_total + bet.amount,
+                                                 above=previous_total)
 
             member_month_bet.accumulated_bonus -= accumulated_bonus
-            member_month_bet.total_weekly_bonus -= \
-                bet_levels.last().weekly_bonus
+            member_month_bet.total_weekly_bonus -= bet_level.weekly_bonus
 
             if member_summary.total_bonus <= accumulated_bonus + \
-                    bet_levels.last().weekly_bonus:
+                    bet_level.weekly_bonus:
                 member_summary.total_bonus = 0
             else:
                 member_summary.total_bonus -= accumulated_bonus + \
-                    bet_levels.last().weekly_bonus
+                    bet_level.weekly_bonus
 
             if first_week(cycle_begin):
-                if member_summary.total_bonus >= \
-                        bet_levels.last().monthly_bonus:
-                    member_summary.total_bonus -= \
-                        bet_levels.last().monthly_bonus
-
-                if member_month_bet.month_bonus >= \
-                        bet_levels.last().monthly_bonus:
-                    member_month_bet.month_bonus -= \
-                        bet_levels.last().monthly_bonus
+                if member_summary.total_bonus >= bet_level.monthly_bonus:
+                    member_summary.total_bonus -= bet_level.monthly_bonus
+
+                if member_month_bet.month_bonus >= bet_level.monthly_bonus:
+                    member_month_bet.month_bonus -= bet_level.monthly_bonus
 
     member_month_bet.save()
     member_summary.save()
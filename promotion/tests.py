@@ -1,3 +1,105 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from account.models import Member
+from promotion.bonus import compute_member_bonus
+from promotion.ladder import BetLevelLadder
+from promotion.models import (ImportExportLog,
+                              PromotionBetLevel,
+                              Summary,
+                              SummaryRollover)
+from promotion.tasks import promotion_bet_import
+
+
+class BetLevelLadderTest(SimpleTestCase):
+    def setUp(self):
+        self.levels = [
+            PromotionBetLevel(name=name, total_bet=total_bet, bonus=bonus)
+            for name, total_bet, bonus in (('3', 5000, 50.5),
+                                           ('1', 100, 1),
+                                           ('2', 1000, 10.25))
+        ]
+        self.ladder = BetLevelLadder(self.levels)
+
+    def test_get_level(self):
+        self.assertIsNone(self.ladder.get_level(99.99))
+        self.assertEqual(self.ladder.get_level(100).name, '1')
+        self.assertEqual(self.ladder.get_level(4999).name, '2')
+        self.assertEqual(self.ladder.get_level(10 ** 6).name, '3')
+
+    def test_get_next_level(self):
+        self.assertEqual(self.ladder.get_next_level(0).name, '1')
+        self.assertEqual(self.ladder.get_next_level(100).name, '2')
+        self.assertIsNone(self.ladder.get_next_level(5000))
+
+    def test_get_bonus(self):
+        self.assertEqual(self.ladder.get_bonus(50), 0.0)
+        self.assertEqual(self.ladder.get_bonus(1000), 11.25)
+        self.assertEqual(self.ladder.get_bonus(5000, above=100), 60.75)
+        self.assertEqual(self.ladder.get_bonus(5000, above=1000), 50.5)
+        self.assertEqual(
+            self.ladder.get_bonus(5000, above=1000, include_above=True),
+            60.75)
+        # Totals going down reach no new level
+        self.assertEqual(self.ladder.get_bonus(100, above=5000), 0.0)
+
+
+class ComputeMemberBonusTest(SimpleTestCase):
+    def setUp(self):
+        self.ladder = BetLevelLadder([
+            PromotionBetLevel(name='1', total_bet=100, bonus=10,
+                              weekly_bonus=1, monthly_bonus=5),
+            PromotionBetLevel(name='2', total_bet=1000, bonus=20,
+                              weekly_bonus=2, monthly_bonus=7),
+        ])
+
+    def test_compute_member_bonus(self):
+        bets = [
+            (0, 150, datetime(2026, 9, 7), datetime(2026, 9, 13)),
+            (0, 900, datetime(2026, 9, 14), datetime(2026, 9, 20)),
+            # The running cycle only counts once it is over
+            (0, 500, datetime(2026, 10, 12), datetime(2026, 10, 18)),
+        ]
+        months, total_bonus = compute_member_bonus(
+            bets, lambda game_type: self.ladder, datetime(2026, 10, 14, 12))
+
+        self.assertEqual(len(months), 1)
+        month = months[0]
+        self.assertEqual((month.cycle_year, month.cycle_month), (2026, 9))
+        self.assertEqual(month.total_bet, 1050)
+        self.assertEqual(month.month_bonus, 5)
+        self.assertEqual(month.total_weekly_bonus, 3)
+        self.assertEqual(month.accumulated_bonus, 30)
+        self.assertEqual(month.promotion_bet_level.name, '2')
+        self.assertEqual(total_bonus, {0: 38})
+
+
+class PromotionBetImportTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='admin')
+        self.level = PromotionBetLevel.objects.create(name='1', total_bet=100,
+                                                      bonus=10, game_type=0)
+        self.member = Member.objects.create(username='member01')
+        self.summary = Summary.objects.create(member=self.member,
+                                              game_type=0,
+                                              promotion_bet_level=self.level,
+                                              total_promotion_bet=150,
+                                              current_week_bonus=10)
+        # Last updated last week, before the weekly rollover ran
+        Summary.objects.filter(id=self.summary.id).update(
+            updated_at=timezone.now() - timedelta(days=7))
+        self.request_log = ImportExportLog.objects.create(
+            game_type=0, created_by=self.user)
+
+    def test_import_before_rollover(self):
+        promotion_bet_import([{'username': 'member01', 'amount': 10}],
+                             self.user.id, 0, self.request_log.id)
+
+        self.summary.refresh_from_db()
+        # Last week's bonus was rolled over before the import replaced it
+        self.assertEqual(self.summary.total_bonus, 10)
+        self.assertEqual(self.summary.total_promotion_bet, 160)
+        self.assertEqual(self.summary.previous_week_bet_level, self.level)
+        self.assertEqual(SummaryRollover.objects.get().summaries, 1)
@@ -18,9 +18,11 @@ from tablib import Dataset
 from time import time
 
 from configsetting.models import GlobalPreference
+from grizzly.idempotency import idempotent
 from grizzly.lib import constants
 from grizzly.throttling import CustomAnonThrottle
-from grizzly.utils import (parse_request_for_token,
+from grizzly.utils import (get_username_list,
+                           parse_request_for_token,
                            GrizzlyRenderer)
 from loginsvc.permissions import IsAdmin, IsStaff
 from loginsvc.views import generate_response
@@ -33,6 +35,7 @@ from promotion.filters import (AnnouncementFilter,
                                PromotionElementFilter,
                                ImportExportLogFilter,
                                SummaryFilter)
+from promotion.ladder import get_ladder
 from promotion.models import (Announcement,
                               EGAMES_DEPOSIT_IMPORT,
                               LIVE_DEPOSIT_IMPORT,
@@ -232,6 +235,10 @@ class PromotionClaimMemberViewset(mixins.CreateModelMixin,
 
         return PromotionClaim.objects.filter(**params)
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
 
 class PromotionBetLevelAdminViewset(mixins.ListModelMixin,
                                     mixins.CreateModelMixin,
@@ -388,6 +395,83 @@ class SummaryAdminViewset(mixins.ListModelMixin,
     serializer_class = SummaryAdminSerializer
     renderer_classes = [GrizzlyRenderer]
 
+    MAX_STATUS_USERNAMES = 5000
+
+    @action(detail=False, methods=['post'])
+    def member_status(self, request):
+        '''
+        Summary of many members of a game type at once, for upstream
+        systems. One query per metric whatever the number of members.
+        '''
+
+        usernames = get_username_list(request.data,
+                                      self.MAX_STATUS_USERNAMES)
+        if usernames is None:
+            return Response(constants.FIELD_ERROR, status=400)
+
+        try:
+            game_type = int(request.data.get('game_type', 0))
+        except (TypeError, ValueError):
+            return Response(constants.FIELD_ERROR, status=400)
+
+        summaries = {
+            summary.member.username: summary
+            for summary in Summary.objects.filter(
+                game_type=game_type,
+                member__username__in=usernames
+            ).select_related('member', 'promotion_bet_level').order_by('id')
+        }
+        last_bets = dict(PromotionBet.objects.filter(
+            game_type=game_type,
+            member__username__in=usernames
+        ).values_list('member__username').annotate(
+            last_bet=Max('created_at')).order_by())
+        ladder = get_ladder(game_type)
+
+        max_day_diff = GlobalPreference.objects.get_value('max_no_bet_days')
+        today = timezone.localtime(timezone.now())
+
+        data = []
+        for username in usernames:
+            summary = summaries.get(username)
+            last_bet = last_bets.get(username)
+            status = {
+                'username': username,
+                'promotion_bet_level': None,
+                'total_promotion_bet': None,
+                'total_promotion_bonus': None,
+                'bets_to_next_level': 0.0,
+                'last_bet_at': last_bet,
+                # Members who stopped betting cannot claim
+                'can_claim': not (
+                    last_bet and max_day_diff and
+                    (today - timezone.localtime(last_bet)).days >
+                    int(max_day_diff)),
+            }
+
+            if summary:
+                status.update(
+                    total_promotion_bet=summary.total_promotion_bet,
+                    total_promotion_bonus=summary.total_promotion_bonus)
+
+            if summary and summary.promotion_bet_level:
+                level = summary.promotion_bet_level
+                status['promotion_bet_level'] = {
+                    'id': level.id,
+                    'name': level.name,
+                    'weekly_bonus': level.weekly_bonus,
+                    'monthly_bonus': level.monthly_bonus
+                }
+
+                next_level = ladder.get_next_level(level.total_bet)
+                if next_level:
+                    status['bets_to_next_level'] = \
+                        next_level.total_bet - summary.total_promotion_bet
+
+            data.append(status)
+
+        return Response(data)
+
 
 class SummaryViewset(mixins.RetrieveModelMixin,
                      mixins.ListModelMixin,